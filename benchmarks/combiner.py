@@ -0,0 +1,82 @@
+"""
+Measures peak RSS and wall time of combining large synthetic video parts.
+Each strategy runs in its own process so the peak RSS is not shared.
+
+python benchmarks/combiner.py [megabytes per part]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from pinthesky.combiner import VideoCombiner, append_file
+
+
+class NoEvents():
+    def fire_event(self, event_name, context={}):
+        pass
+
+
+def write_part(file_name, megabytes):
+    block = os.urandom(1024 * 1024)
+    with open(file_name, 'wb') as f:
+        for _ in range(0, megabytes):
+            f.write(block)
+
+
+def legacy_combine(event, combine_dir):
+    file_name = os.path.join(combine_dir, f'{event["start_time"]}.motion.h264')
+    with open(file_name, 'wb') as o:
+        for n in ['before', 'after']:
+            part_name = f'{event["start_time"]}.{n}.h264'
+            with open(part_name, 'rb') as i:
+                o.write(i.read())
+            os.remove(part_name)
+
+
+def chunked_combine(event, combine_dir):
+    file_name = os.path.join(combine_dir, f'{event["start_time"]}.motion.h264')
+    with open(file_name, 'wb', buffering=0) as o:
+        for n in ['before', 'after']:
+            part_name = f'{event["start_time"]}.{n}.h264'
+            append_file(part_name, o, copies=[])
+            os.remove(part_name)
+
+
+def child(strategy, megabytes):
+    event = {'start_time': 1}
+    combine_dir = 'combined'
+    os.mkdir(combine_dir)
+    for n in ['before', 'after']:
+        write_part(f'{event["start_time"]}.{n}.h264', megabytes)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if strategy == 'legacy':
+        legacy_combine(event, combine_dir)
+    elif strategy == 'chunked':
+        chunked_combine(event, combine_dir)
+    else:
+        VideoCombiner(NoEvents(), combine_dir, strategy).on_flush_end(event)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{strategy:>8} {elapsed:>10.3f} {peak:>10} {peak - baseline:>10}')
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+        return
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    print(f'{"strategy":>8} {"seconds":>10} {"peak KB":>10} {"growth KB":>10}')
+    for strategy in ['legacy', 'chunked', 'copy', 'append']:
+        with tempfile.TemporaryDirectory() as work_dir:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', strategy, str(megabytes)],
+                cwd=work_dir,
+                check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Measures the frames per second and end-to-end latency of streaming live
+view frames through a ConnectionThread to a local HTTP stand-in for the
+API Gateway management API, comparing a post per read against coalesced
+posts. The stand-in delays every post to simulate the uplink round trip.
+
+python benchmarks/connection.py [framerate] [kilobits per second] [post ms]
+"""
+import statistics
+import struct
+import sys
+import threading
+import time
+
+from base64 import b64decode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pinthesky.connection import ConnectionBuffer, ConnectionManager, ConnectionThread
+from pinthesky.events import EventThread
+from pinthesky.session import Session
+
+CREDENTIALS = {
+    'accessKeyId': 'accessKeyId',
+    'secretAccessKey': 'secretAccessKey',
+    'sessionToken': 'sessionToken',
+    'expiration': '2999-01-01T00:00:00Z',
+}
+FRAME_HEADER = struct.Struct('>dI')
+SECONDS = 5
+
+
+class FrameBuffer(ConnectionBuffer):
+    """
+    Produces frames stamped with the time they were encoded, at the
+    framerate and bitrate of a live view conversion.
+    """
+    def __init__(self, framerate, bitrate):
+        self.interval = 1 / framerate
+        self.frame_size = bitrate * 1000 // 8 // framerate
+        self.frames = framerate * SECONDS
+        self.next_frame = time.perf_counter()
+
+    def read1(self, size):
+        if self.frames == 0:
+            return b''
+        delay = self.next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame += self.interval
+        self.frames -= 1
+        return FRAME_HEADER.pack(time.perf_counter(), self.frame_size) + b'\x00' * self.frame_size
+
+    def poll(self):
+        return 0 if self.frames == 0 else None
+
+
+class StandIn(BaseHTTPRequestHandler):
+    delay = 0
+    latencies = []
+    posts = []
+
+    def do_POST(self):
+        body = b64decode(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay)
+        arrived = time.perf_counter()
+        offset = 0
+        while offset < len(body):
+            encoded, size = FRAME_HEADER.unpack_from(body, offset)
+            self.latencies.append((arrived - encoded) * 1000)
+            offset += FRAME_HEADER.size + size
+        self.posts.append(len(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(server, framerate, bitrate, **kwargs):
+    StandIn.latencies = []
+    StandIn.posts = []
+    session = Session(
+        cert_path=None,
+        key_path=None,
+        cacert_path=None,
+        thing_name='thing_name',
+        role_alias='role_alias',
+        credentials_endpoint=None)
+    session.credentials = CREDENTIALS
+    manager = ConnectionManager(
+        session=session,
+        enabled=True,
+        endpoint_url=f'http://127.0.0.1:{server.server_port}',
+        region_name='us-east-1')
+    connection = ConnectionThread(
+        buffer=FrameBuffer(framerate, bitrate),
+        manager=manager,
+        event_data={'connection': {'id': 'connection'}},
+        events=EventThread(),
+        **kwargs)
+    started = time.perf_counter()
+    connection.start()
+    connection.join()
+    elapsed = time.perf_counter() - started
+    latencies = sorted(StandIn.latencies)
+    return (
+        len(latencies) / elapsed,
+        len(StandIn.posts),
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99)])
+
+
+def main():
+    framerate = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bitrate = int(sys.argv[2]) if len(sys.argv) > 2 else 800
+    StandIn.delay = (int(sys.argv[3]) if len(sys.argv) > 3 else 60) / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'{"method":>10} {"fps":>8} {"posts":>8} {"p50 ms":>10} {"p99 ms":>10}')
+    try:
+        for method, kwargs in [
+                ('per-read', {'max_batch_size': 1, 'window': 1}),
+                ('coalesced', {})]:
+            fps, posts, p50, p99 = measure(server, framerate, bitrate, **kwargs)
+            print(f'{method:>10} {fps:>8.1f} {posts:>8} {p50:>10.1f} {p99:>10.1f}')
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
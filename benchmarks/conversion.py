@@ -0,0 +1,107 @@
+"""
+Measures the pipe throughput and CPU time of feeding live view frames to
+the conversion process, with and without a FrameDecimation, at several
+camera resolutions. A fake camera writes padded YUV420 frames as fast as
+they are consumed. The consumer is ffmpeg when it is installed, otherwise
+`cat` into /dev/null isolates the cost of the pipe itself.
+
+python benchmarks/conversion.py [frames]
+"""
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from pinthesky.conversion import FrameDecimation
+
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+# name, scale, skip, resizer
+DECIMATIONS = [
+    ('none', 1, 1, 'stride'),
+    ('gpu/2', 2, 1, 'gpu'),
+    ('stride/2', 2, 1, 'stride'),
+    ('stride/2 skip/2', 2, 2, 'stride'),
+    ('stride/4', 4, 1, 'stride'),
+]
+FRAMERATE = 20
+
+
+class FakeCamera:
+    """
+    Produces frames the way picamera does for unencoded output, padded to
+    multiples of 32x16 and already resized when the GPU resizer is used.
+    """
+    def __init__(self, resolution, resize=None):
+        (width, height) = resize or resolution
+        padded = ((width + 31) & ~31) * ((height + 15) & ~15)
+        rng = np.random.default_rng(0)
+        self.frame = rng.integers(0, 256, size=padded * 3 // 2, dtype=np.uint8).tobytes()
+
+    def frames(self, count):
+        for _ in range(count):
+            yield self.frame
+
+
+def consumer(size):
+    if shutil.which('ffmpeg'):
+        return subprocess.Popen([
+            'ffmpeg', '-loglevel', 'quiet',
+            '-f', 'rawvideo', '-pix_fmt', 'yuv420p',
+            '-s', '%dx%d' % size, '-r', str(FRAMERATE), '-i', '-',
+            '-f', 'mpeg1video', '-b', '800k', '-y', '/dev/null'],
+            stdin=subprocess.PIPE)
+    return subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+
+def run(resolution, scale, skip, resizer, frames):
+    decimation = FrameDecimation(resolution, scale=scale, skip=skip, resizer=resizer)
+    camera = FakeCamera(resolution, decimation.resize)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    process = consumer(decimation.size)
+    written = 0
+    cpu = time.process_time()
+    started = time.perf_counter()
+    for index, frame in enumerate(camera.frames(frames)):
+        if index % decimation.skip != 0:
+            continue
+        frame = decimation.decimate(frame)
+        process.stdin.write(frame)
+        written += len(frame)
+    process.stdin.close()
+    process.wait()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    child_cpu = (after.ru_utime + after.ru_stime) - (children.ru_utime + children.ru_stime)
+    return {
+        'size': '%dx%d' % decimation.size,
+        'fps': frames / elapsed,
+        'pipe': written / elapsed / 1024 / 1024,
+        'pipe_per_second': written / frames * FRAMERATE / 1024 / 1024,
+        'cpu': cpu / frames * 1000,
+        'child_cpu': child_cpu / frames * 1000,
+    }
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f'Consumer: {"ffmpeg" if shutil.which("ffmpeg") else "cat"}, {frames} frames')
+    print(
+        f'{"camera":>10} {"decimation":>16} {"output":>10} {"frames/s":>9} '
+        f'{"pipe MB/s":>10} {"MB/s@20fps":>11} {"ms/frame":>9} {"child ms":>9}')
+    for resolution in RESOLUTIONS:
+        for name, scale, skip, resizer in DECIMATIONS:
+            result = run(resolution, scale, skip, resizer, frames)
+            print(
+                f'{"%dx%d" % resolution:>10} {name:>16} {result["size"]:>10} '
+                f'{result["fps"]:>9.1f} {result["pipe"]:>10.1f} '
+                f'{result["pipe_per_second"]:>11.1f} {result["cpu"]:>9.3f} '
+                f'{result["child_cpu"]:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
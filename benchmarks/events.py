@@ -0,0 +1,59 @@
+"""
+Measures how long a live view `record` request waits on the event thread
+while the queue is flooded with file_change, health and upload_end events,
+comparing a FIFO queue against the priority queue with coalescing.
+
+python benchmarks/events.py [flood events] [handler microseconds]
+"""
+import statistics
+import sys
+import time
+
+from pinthesky.events import EventThread
+
+FLOOD_EVENTS = ['file_change', 'health', 'upload_end']
+RECORD_EVERY = 50
+
+
+def busy(microseconds):
+    deadline = time.perf_counter() + microseconds / 1000000
+    while time.perf_counter() < deadline:
+        pass
+
+
+def measure(events, flood, microseconds):
+    latencies = []
+    for event_name in FLOOD_EVENTS:
+        events.on_event(event_name, lambda e: busy(microseconds), 'Flood')
+    events.on_event(
+        'record',
+        lambda e: latencies.append((time.perf_counter() - e['fired']) * 1000),
+        'Record')
+    events.start()
+    for index in range(0, flood):
+        events.fire_event(FLOOD_EVENTS[index % len(FLOOD_EVENTS)])
+        if index % RECORD_EVERY == 0:
+            events.fire_event('record', {'fired': time.perf_counter()})
+    events.event_queue.join()
+    events.stop()
+    latencies.sort()
+    return (
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99)],
+        latencies[-1],
+        events.event_queue.coalesced)
+
+
+def main():
+    flood = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    microseconds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    print(f'{"queue":>10} {"p50 ms":>10} {"p99 ms":>10} {"max ms":>10} {"coalesced":>10}')
+    for method, events in [
+            ('fifo', EventThread(priorities={}, policies={}, maxsize=0)),
+            ('priority', EventThread())]:
+        p50, p99, worst, coalesced = measure(events, flood, microseconds)
+        print(f'{method:>10} {p50:>10.3f} {p99:>10.3f} {worst:>10.3f} {coalesced:>10}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares the legacy float motion vector analysis against the integer-only
+VectorAnalysis on synthetic motion_dtype frames.
+
+python benchmarks/motion_analysis.py [frames]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from pinthesky.motion import VectorAnalysis, motion_dtype
+
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+
+
+def legacy_detect(a, sensitivity=10):
+    a = np.sqrt(
+        np.square(a['x'].astype(np.float64)) +
+        np.square(a['y'].astype(np.float64))
+        ).clip(0, 255).astype(np.uint8)
+    return (a > 60).sum() > sensitivity
+
+
+def synthetic_frames(resolution, count=32, seed=0):
+    (width, height) = resolution
+    cols = (width + 15) // 16 + 1
+    rows = (height + 15) // 16
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(0, count):
+        frame = np.zeros((rows, cols), dtype=motion_dtype)
+        frame['x'] = rng.integers(-128, 128, size=(rows, cols))
+        frame['y'] = rng.integers(-128, 128, size=(rows, cols))
+        frames.append(frame)
+    return frames
+
+
+def measure(detect, frames, iterations):
+    # Warm up any lazily allocated buffers before measuring
+    detect(frames[0])
+    start = time.perf_counter()
+    for i in range(0, iterations):
+        detect(frames[i % len(frames)])
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    for i in range(0, len(frames)):
+        detect(frames[i])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return iterations / elapsed, peak
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f'{"resolution":>12} {"engine":>8} {"frames/s":>10} {"peak bytes":>12}')
+    for resolution in RESOLUTIONS:
+        frames = synthetic_frames(resolution)
+        engines = [
+            ('legacy', legacy_detect),
+            ('vector', VectorAnalysis(sensitivity=10).detect),
+        ]
+        for name, detect in engines:
+            fps, peak = measure(detect, frames, iterations)
+            label = 'x'.join(map(str, resolution))
+            print(f'{label:>12} {name:>8} {fps:>10.0f} {peak:>12}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Compares the vector and background motion detection engines for CPU time
+and false positive rate. Fixtures are synthetic scenes unless recorded
+fixtures are provided as .npz files containing `luma` (frames of the
+downscaled luma plane), `vectors` (motion_dtype frames) and `motion`
+(the expected detection per frame).
+
+python benchmarks/motion_detection.py [fixture.npz ...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from pinthesky.motion import BackgroundAnalysis, VectorAnalysis, motion_dtype
+
+
+FRAMERATE = 20
+FRAMES = 400
+ROWS, COLS = 30, 40
+
+
+def vector_noise(rng, frames):
+    vectors = np.zeros((frames, ROWS, COLS + 1), dtype=motion_dtype)
+    vectors['x'] = rng.integers(-8, 9, size=vectors.shape)
+    vectors['y'] = rng.integers(-8, 9, size=vectors.shape)
+    # Encoder outliers on flat, noisy regions
+    outliers = rng.random(vectors.shape) < 0.01
+    vectors['x'][outliers] = rng.integers(-128, 128, size=outliers.sum())
+    return vectors
+
+
+def luma_noise(rng, frames, scene):
+    noise = rng.integers(-6, 7, size=(frames, ROWS, COLS))
+    return np.clip(scene + noise, 0, 255).astype(np.uint8)
+
+
+def static_scene(rng, scene):
+    luma = luma_noise(rng, FRAMES, scene)
+    return luma, vector_noise(rng, FRAMES), np.zeros(FRAMES, dtype=bool)
+
+
+def camera_shake(rng, scene):
+    luma = luma_noise(rng, FRAMES, scene)
+    vectors = vector_noise(rng, FRAMES)
+    for i in range(0, FRAMES, 10):
+        # Shake of a few camera pixels is a sub-pixel shift once downscaled
+        dx, dy = rng.integers(-1, 2, size=2)
+        shifted = np.roll(luma[i:i + 3], (dy, dx), axis=(1, 2))
+        luma[i:i + 3] = (luma[i:i + 3] * 0.7 + shifted * 0.3).astype(np.uint8)
+        vectors['x'][i:i + 3] += np.int8(rng.integers(-70, 71))
+        vectors['y'][i:i + 3] += np.int8(rng.integers(-70, 71))
+    return luma, vectors, np.zeros(FRAMES, dtype=bool)
+
+
+def ir_switch(rng, scene):
+    luma = luma_noise(rng, FRAMES, scene)
+    vectors = vector_noise(rng, FRAMES)
+    # Night mode darkens the scene between the two switches
+    luma[100:300] //= 3
+    for i in [100, 300]:
+        transition = rng.random((ROWS, COLS + 1)) < 0.3
+        vectors['x'][i][transition] = rng.integers(-128, 128, size=transition.sum())
+    return luma, vectors, np.zeros(FRAMES, dtype=bool)
+
+
+def moving_object(rng, scene):
+    luma = luma_noise(rng, FRAMES, scene)
+    vectors = vector_noise(rng, FRAMES)
+    motion = np.zeros(FRAMES, dtype=bool)
+    for i in range(100, 300):
+        x = (i - 100) * (COLS - 6) // 200
+        luma[i, 10:22, x:x + 6] = 250
+        vectors['x'][i, 10:22, x:x + 6] = 90
+        motion[i] = True
+    return luma, vectors, motion
+
+
+def synthetic_fixtures():
+    rng = np.random.default_rng(0)
+    # Smooth scene of large regions, like walls, lawns and sky
+    regions = rng.integers(30, 200, size=(ROWS // 5, COLS // 5))
+    scene = np.kron(regions, np.ones((5, 5), dtype=regions.dtype))
+    return [
+        ('static', *static_scene(rng, scene)),
+        ('shake', *camera_shake(rng, scene)),
+        ('ir_switch', *ir_switch(rng, scene)),
+        ('moving', *moving_object(rng, scene)),
+    ]
+
+
+def recorded_fixtures(paths):
+    fixtures = []
+    for path in paths:
+        with np.load(path) as data:
+            fixtures.append((path, data['luma'], data['vectors'], data['motion']))
+    return fixtures
+
+
+def run(detect, frames, motion):
+    detected = np.zeros(len(frames), dtype=bool)
+    start = time.perf_counter()
+    for i in range(0, len(frames)):
+        detected[i] = detect(frames[i])
+    elapsed = time.perf_counter() - start
+    false_positives = np.count_nonzero(detected & ~motion)
+    true_positives = np.count_nonzero(detected & motion)
+    fp_rate = false_positives / max(1, np.count_nonzero(~motion))
+    tp_rate = true_positives / max(1, np.count_nonzero(motion))
+    cpu = elapsed / len(frames) * FRAMERATE * 100
+    return cpu, fp_rate, tp_rate
+
+
+def main():
+    if len(sys.argv) > 1:
+        fixtures = recorded_fixtures(sys.argv[1:])
+    else:
+        fixtures = synthetic_fixtures()
+    print(f'{"fixture":>12} {"engine":>10} {"cpu %":>8} {"fp rate":>8} {"tp rate":>8}')
+    for name, luma, vectors, motion in fixtures:
+        engines = [
+            ('vector', VectorAnalysis(sensitivity=10).detect, vectors),
+            ('background', BackgroundAnalysis(sensitivity=10).detect, luma),
+        ]
+        for engine, detect, frames in engines:
+            cpu, fp_rate, tp_rate = run(detect, frames, motion)
+            print(f'{name:>12} {engine:>10} {cpu:>8.3f} {fp_rate:>8.3f} {tp_rate:>8.3f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures throughput and peak traced memory of muxing synthetic H.264 clips
+into fragmented MP4 at increasing clip lengths. Constant memory shows as a
+flat peak, and the real-time factor is seconds of video muxed per second.
+
+python benchmarks/mp4.py [framerate] [kilobits per second]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pinthesky.mp4 import FragmentedMP4Writer, iter_nal_units
+
+START_CODE = b'\x00\x00\x00\x01'
+# Baseline 1920x1080 sequence and picture parameter sets
+SPS = b'\x67\x42\xc0\x1f\xda\x01\xe0\x08\x9f\x96\x10\x00\x00\x03\x00\x10\x00\x00\x03\x03\xc8\xf1\x83\x2a'
+PPS = b'\x68\xce\x3c\x80'
+NO_ZEROS = bytes.maketrans(b'\x00', b'\x01')
+
+
+def write_clip(file_name, seconds, framerate, bitrate):
+    frame_size = bitrate * 1000 // 8 // framerate
+    with open(file_name, 'wb') as f:
+        for frame in range(0, seconds * framerate):
+            sync = frame % framerate == 0
+            if sync:
+                f.write(START_CODE + SPS + START_CODE + PPS)
+            # Key frames are several times larger than predicted frames
+            size = frame_size * 5 if sync else frame_size
+            payload = os.urandom(size).translate(NO_ZEROS)
+            f.write(START_CODE + (b'\x65' if sync else b'\x41') + b'\x88' + payload)
+
+
+def mux(file_name, output_name, framerate):
+    with open(file_name, 'rb') as i, open(output_name, 'wb') as o:
+        writer = FragmentedMP4Writer(o, framerate=framerate)
+        for nal in iter_nal_units(i):
+            writer.write(nal)
+        writer.close()
+
+
+def main():
+    framerate = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bitrate = int(sys.argv[2]) if len(sys.argv) > 2 else 17000
+    print(f'{"seconds":>8} {"MB":>8} {"MB/s":>8} {"realtime":>9} {"peak KB":>9}')
+    with tempfile.TemporaryDirectory() as work_dir:
+        clip_name = os.path.join(work_dir, 'clip.h264')
+        output_name = os.path.join(work_dir, 'clip.mp4')
+        for seconds in [10, 30, 60, 120]:
+            write_clip(clip_name, seconds, framerate, bitrate)
+            size = os.path.getsize(clip_name) / (1024 * 1024)
+            tracemalloc.start()
+            start = time.perf_counter()
+            mux(clip_name, output_name, framerate)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f'{seconds:>8} {size:>8.1f} {size / elapsed:>8.1f} '
+                f'{seconds / elapsed:>8.1f}x {peak // 1024:>9}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures the per-call latency of acquiring AWS clients, comparing a fresh
+boto3 session and client per call against the cached Session.client.
+No requests are sent, so this isolates client construction.
+
+python benchmarks/session.py [calls]
+"""
+import statistics
+import sys
+import time
+
+import boto3
+
+from pinthesky.session import Session
+
+CREDENTIALS = {
+    'accessKeyId': 'accessKeyId',
+    'secretAccessKey': 'secretAccessKey',
+    'sessionToken': 'sessionToken',
+    'expiration': '2999-01-01T00:00:00Z',
+}
+SERVICES = [
+    ('s3', None, None),
+    ('logs', 'us-east-1', None),
+    ('apigatewaymanagementapi', 'us-east-1', 'https://example.com'),
+]
+
+
+def fresh_client(service_name, region_name, endpoint_url):
+    session = boto3.Session(
+        CREDENTIALS['accessKeyId'],
+        CREDENTIALS['secretAccessKey'],
+        CREDENTIALS['sessionToken'])
+    return session.client(service_name, region_name=region_name, endpoint_url=endpoint_url)
+
+
+def measure(acquire, service, calls):
+    timings = []
+    for _ in range(0, calls):
+        start = time.perf_counter()
+        acquire(*service)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    session = Session(
+        cert_path=None,
+        key_path=None,
+        cacert_path=None,
+        thing_name='thing_name',
+        role_alias='role_alias',
+        credentials_endpoint=None)
+    session.credentials = CREDENTIALS
+    print(f'{"service":>24} {"method":>8} {"p50 ms":>10} {"max ms":>10}')
+    for service in SERVICES:
+        for method, acquire in [('fresh', fresh_client), ('cached', session.client)]:
+            p50, worst = measure(acquire, service, calls)
+            print(f'{service[0]:>24} {method:>8} {p50:>10.3f} {worst:>10.3f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Measures throughput and peak traced memory of uploading a clip to a local
+S3 stand-in, comparing boto3's default TransferConfig against the tuned
+synchronous upload and the resumable spooled multipart upload. Requires
+moto, which keeps uploaded objects in memory, so the peak includes the
+stored clip in every mode and only the difference between modes is the
+cost of the transfer itself.
+
+pip install moto
+python benchmarks/upload.py [clip MB] [part MB] [concurrency]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import boto3
+
+from boto3.s3.transfer import TransferConfig
+from pinthesky.events import EventThread
+from pinthesky.session import Session
+from pinthesky.spool import UploadSpool
+from pinthesky.upload import S3Upload
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+BUCKET_NAME = 'bucket_name'
+CREDENTIALS = {
+    'accessKeyId': 'accessKeyId',
+    'secretAccessKey': 'secretAccessKey',
+    'sessionToken': 'sessionToken',
+    'expiration': '2999-01-01T00:00:00Z',
+}
+MEGABYTE = 1024 * 1024
+
+
+def new_session():
+    session = Session(
+        cert_path=None,
+        key_path=None,
+        cacert_path=None,
+        thing_name='thing_name',
+        role_alias='role_alias',
+        credentials_endpoint=None)
+    session.credentials = CREDENTIALS
+    return session
+
+
+def new_event(clip_name):
+    return {
+        'name': 'combine_end',
+        'start_time': int(time.time()),
+        'trigger': 'motion',
+        'combine_video': clip_name,
+    }
+
+
+def boto_default(work_dir, clip_name, part_size, concurrency):
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.upload_file(clip_name, BUCKET_NAME, 'boto_default', Config=TransferConfig())
+    os.remove(clip_name)
+
+
+def tuned(work_dir, clip_name, part_size, concurrency):
+    upload = S3Upload(
+        events=EventThread(),
+        bucket_name=BUCKET_NAME,
+        bucket_prefix='tuned',
+        session=new_session(),
+        part_size=part_size,
+        max_concurrency=concurrency)
+    upload.on_combine_end(new_event(clip_name))
+
+
+def resumable(work_dir, clip_name, part_size, concurrency):
+    spool = UploadSpool(os.path.join(work_dir, 'spool'))
+    upload = S3Upload(
+        events=EventThread(),
+        bucket_name=BUCKET_NAME,
+        bucket_prefix='resumable',
+        session=new_session(),
+        spool=spool,
+        part_size=part_size,
+        max_concurrency=concurrency)
+    upload.start()
+    while not os.path.exists(spool.spool_dir):
+        time.sleep(0.001)
+    upload.on_combine_end(new_event(clip_name))
+    while spool.report()['upload_pending'] > 0:
+        time.sleep(0.001)
+    upload.stop()
+    upload.join()
+
+
+def main():
+    if mock_aws is None:
+        print('moto is required: pip install moto')
+        return
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    part_size = int(sys.argv[2]) * MEGABYTE if len(sys.argv) > 2 else 8 * MEGABYTE
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    print(f'{"method":>14} {"MB":>6} {"MB/s":>8} {"peak MB":>9}')
+    with mock_aws(), tempfile.TemporaryDirectory() as work_dir:
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET_NAME)
+        for method in [boto_default, tuned, resumable]:
+            clip_name = os.path.join(work_dir, f'{method.__name__}.motion.h264')
+            with open(clip_name, 'wb') as f:
+                for _ in range(0, size):
+                    f.write(os.urandom(MEGABYTE))
+            tracemalloc.start()
+            start = time.perf_counter()
+            method(work_dir, clip_name, part_size, concurrency)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f'{method.__name__:>14} {size:>6} {size / elapsed:>8.1f} '
+                f'{peak / MEGABYTE:>9.1f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 from datetime import timedelta
 
 from pinthesky import VERSION, input, output, upload, set_stream_logger
-from pinthesky.camera import CameraThread
+from pinthesky.camera import MOTION_DETECTIONS, CameraThread
 from pinthesky.cloudwatch import CloudWatchManager
-from pinthesky.combiner import VideoCombiner
+from pinthesky.combiner import COMBINE_CONTAINERS, COMBINE_STRATEGIES, VideoCombiner
 from pinthesky.connection import ConnectionManager, ConnectionHandler
 from pinthesky.config import ShadowConfig
 from pinthesky.events import EventThread
 from pinthesky.health import DeviceHealth
+from pinthesky.metrics import MetricsRegistry
 from pinthesky.session import Session
+from pinthesky.spool import UploadSpool
+from pinthesky.throttle import BandwidthThrottle
 import argparse
 import os
 import sys
@@ -68,6 +71,11 @@ def create_parser():
         help="buffer size in seconds, defaults to 15",
         type=int,
         default=15)
+    camera.add_argument(
+        "--max-clip-duration",
+        help="max seconds a flush is extended before chaining clips, default 60",
+        type=int,
+        default=60)
     camera.add_argument(
         "--buffer-size",
         help="buffer size in bytes, unset by default and uses buffer",
@@ -79,6 +87,27 @@ def create_parser():
         help="sensitivity of the motion detection math, default 10",
         type=int,
         default=10)
+    camera.add_argument(
+        "--motion-detection",
+        help="motion detection mode, valid arguments [vector, background]," +
+        " default vector",
+        choices=MOTION_DETECTIONS,
+        default="vector")
+    camera.add_argument(
+        "--motion-confirm-frames",
+        help="frames detecting motion to start a motion event, default 3",
+        type=int,
+        default=3)
+    camera.add_argument(
+        "--motion-window-frames",
+        help="window of frames to confirm a motion event, default 5",
+        type=int,
+        default=5)
+    camera.add_argument(
+        "--motion-cooldown",
+        help="seconds without motion to end a motion event, default 2",
+        type=float,
+        default=2)
     camera.add_argument(
         "--recording-window",
         help="the recording window for the camera relative to the host time," +
@@ -164,10 +193,50 @@ def create_parser():
         help="the prefix to upload the latest images, default capture_images",
         default="capture_images",
         required=False)
+    storage.add_argument(
+        "--bandwidth-limit",
+        help="kilobytes per second shared by uploads, logs and live streams, default unlimited",
+        type=int,
+        default=None)
+    storage.add_argument(
+        "--upload-spool-dir",
+        help="the directory to queue uploads for retries, default uploads run once",
+        default=None,
+        required=False)
+    storage.add_argument(
+        "--upload-spool-size",
+        help="the megabytes of pending uploads to keep, default 512",
+        type=int,
+        default=512)
+    storage.add_argument(
+        "--upload-part-size",
+        help="the megabytes of each multipart upload part, default sized to throughput or 8",
+        type=int,
+        default=None)
+    storage.add_argument(
+        "--upload-concurrency",
+        help="the number of parts uploaded at once, default 2",
+        type=int,
+        default=2)
+    storage.add_argument(
+        "--upload-multipart-threshold",
+        help="the megabytes over which uploads are multipart, default 8",
+        type=int,
+        default=8)
     storage.add_argument(
         "--combine-dir",
         help="the directory to combine video, defaults to motion_videos",
         default="motion_videos")
+    storage.add_argument(
+        "--combine-strategy",
+        help="how video parts are combined: copy, append, parts, default copy",
+        choices=COMBINE_STRATEGIES,
+        default="copy")
+    storage.add_argument(
+        "--combine-container",
+        help="the container of combined video: h264, mp4, default h264",
+        choices=COMBINE_CONTAINERS,
+        default="h264")
     cloudwatch = parser.add_argument_group(
         title="CloudWatch",
         description="Configuration for CloudWatch logging")
@@ -232,12 +301,16 @@ def create_parser():
 
 
 def main():
-    parsed = create_parser().parse_args(sys.argv[1:])
+    parser = create_parser()
+    parsed = parser.parse_args(sys.argv[1:])
+    if parsed.combine_container == 'mp4' and parsed.combine_strategy == 'parts':
+        parser.error('--combine-container mp4 muxes the parts, it cannot be used with --combine-strategy parts')
     if parsed.version:
         print(VERSION)
         exit(0)
     set_stream_logger("pinthesky", level=parsed.log_level)
-    event_thread = EventThread()
+    registry = MetricsRegistry()
+    event_thread = EventThread(registry=registry)
     device_health = DeviceHealth(
         events=event_thread,
         flush_delta=timedelta(seconds=parsed.health_interval))
@@ -252,22 +325,42 @@ def main():
         role_alias=parsed.role_alias,
         thing_name=parsed.thing_name,
         credentials_endpoint=parsed.credentials_endpoint)
+    throttle = BandwidthThrottle(
+        rate=parsed.bandwidth_limit * 1024 if parsed.bandwidth_limit else None)
+    device_health.add_metric(throttle)
     connection_manager = ConnectionManager(
         session=auth_session,
+        throttle=throttle,
         enabled=parsed.dataplane,
         endpoint_url=parsed.dataplane_endpoint,
         region_name=parsed.dataplane_region)
     connection_handler = ConnectionHandler(manager=connection_manager)
+    upload_spool = None
+    if parsed.upload_spool_dir is not None:
+        upload_spool = UploadSpool(
+            spool_dir=parsed.upload_spool_dir,
+            max_bytes=parsed.upload_spool_size * 1024 * 1024)
+        device_health.add_metric(upload_spool)
     video_uploader = upload.S3Upload(
         events=event_thread,
         bucket_name=parsed.bucket_name,
         bucket_prefix=parsed.bucket_prefix,
         bucket_image_prefix=parsed.bucket_image_prefix,
-        session=auth_session)
+        session=auth_session,
+        spool=upload_spool,
+        throttle=throttle,
+        part_size=parsed.upload_part_size * 1024 * 1024 if parsed.upload_part_size else None,
+        max_concurrency=parsed.upload_concurrency,
+        multipart_threshold=parsed.upload_multipart_threshold * 1024 * 1024,
+        registry=registry)
     camera_thread = CameraThread(
         device_health=device_health,
         events=event_thread,
         sensitivity=parsed.sensitivity,
+        motion_detection=parsed.motion_detection,
+        motion_confirm_frames=parsed.motion_confirm_frames,
+        motion_window_frames=parsed.motion_window_frames,
+        motion_cooldown=parsed.motion_cooldown,
         resolution=tuple(map(int, parsed.resolution.split('x'))),
         rotation=parsed.rotation,
         framerate=parsed.framerate,
@@ -277,13 +370,18 @@ def main():
         recording_window=parsed.recording_window,
         capture_dir=parsed.capture_dir,
         buffer_size=parsed.buffer_size,
-        connection_manager=connection_manager)
+        max_clip_duration=parsed.max_clip_duration,
+        connection_manager=connection_manager,
+        registry=registry)
     video_combiner = VideoCombiner(
         events=event_thread,
-        combine_dir=parsed.combine_dir)
+        combine_dir=parsed.combine_dir,
+        combine_strategy=parsed.combine_strategy,
+        combine_container=parsed.combine_container)
     event_input_handler = input.InputHandler(events=event_thread)
     cloudwatch_manager = CloudWatchManager(
         session=auth_session,
+        registry=registry,
         log_level=parsed.log_level,
         delineate_stream=not parsed.disable_cloudwatch_stream_split,
         threaded=parsed.cloudwatch_thread,
@@ -291,21 +389,25 @@ def main():
         log_group_name=parsed.cloudwatch_log_group,
         namespace=parsed.cloudwatch_metric_namespace,
         event_type=parsed.cloudwatch_event_type,
-        region_name=parsed.cloudwatch_region)
+        region_name=parsed.cloudwatch_region,
+        throttle=throttle)
+    device_health.add_metric(cloudwatch_manager.metrics)
     event_thread.on(camera_thread)
-    event_thread.on(video_combiner)
-    event_thread.on(video_uploader)
+    # Disk and network heavy handlers get their own thread
+    event_thread.on(video_combiner, threaded=True)
+    event_thread.on(video_uploader, threaded=True)
     event_thread.on(event_output)
     event_thread.on(event_input_handler)
     event_thread.on(auth_session)
     event_thread.on(device_health)
     event_thread.on(cloudwatch_manager)
     event_thread.on(connection_manager)
-    event_thread.on(connection_handler)
+    event_thread.on(connection_handler, threaded=True)
     shadow_update = ShadowConfig(
         events=event_thread,
         configure_input=parsed.configure_input,
-        configure_output=parsed.configure_output)
+        configure_output=parsed.configure_output,
+        registry=registry)
     event_thread.on(shadow_update)
     shadow_update.add_handler(camera_thread)
     shadow_update.add_handler(auth_session)
@@ -323,6 +425,7 @@ def main():
     event_thread.start()
     camera_thread.start()
     notify_thread.start()
+    video_uploader.start()
 
     # Trigger an initial health metric on process start
     device_health.emit_health(force=True)
@@ -330,6 +433,7 @@ def main():
     def signal_handler(signum, frame):
         notify_thread.stop()
         camera_thread.stop()
+        video_uploader.stop()
         event_thread.stop()
         event_output.reset()
         cloudwatch_manager.stop()
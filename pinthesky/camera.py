@@ -1,10 +1,13 @@
 from datetime import datetime
 from collections import namedtuple
+from math import floor
 from pinthesky.config import ConfigUpdate, ShadowConfigHandler
 from pinthesky.handler import Handler
 from pinthesky.health import DeviceHealth
-from pinthesky.conversion import VideoConversion, JSMPEGHeader
-from pinthesky.connection import ProcessBuffer, ConnectionThread
+from pinthesky.conversion import ConversionBuffer, VideoConversion, JSMPEGHeader
+from pinthesky.conversion import DECIMATION_RESIZERS, FrameDecimation
+from pinthesky.connection import BroadcastBuffer, ConnectionThread
+from pinthesky.motion import MotionState
 import logging
 import time
 import threading
@@ -13,6 +16,11 @@ import threading
 logger = logging.getLogger(__name__)
 
 
+MOTION_SPLITTER_PORT = 2
+LIVE_SPLITTER_PORT = 3
+MOTION_DETECTIONS = ['vector', 'background']
+
+
 CameraConfig = namedtuple('CameraConfig', [
     'rotation',
     'framerate',
@@ -36,7 +44,14 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
             capture_dir=None,
             device_health=None,
             buffer_size=None,
-            connection_manager=None):
+            connection_manager=None,
+            motion_zones=None,
+            motion_confirm_frames=3,
+            motion_window_frames=5,
+            motion_cooldown=2,
+            motion_detection='vector',
+            max_clip_duration=60,
+            registry=None):
         super().__init__(daemon=True)
         self.__camera_class = camera_class
         self.__stream_class = stream_class
@@ -46,12 +61,32 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
         self.flushing_ts = None
         self.flushing_buffer = None
         self.flushing_trigger = None
-        self.recording_thread = None
+        self.flushing_framerate = None
+        self.flushing_deadline = None
+        self.flushing_started = None
+        self.flushing_chain = None
+        self.flushing_chain_event = None
+        self.max_clip_duration = max_clip_duration
+        self.motion_recording = False
+        self.live_broadcast = None
+        self.live_conversion = None
+        self.live_viewers = {}
+        self.registry = registry
         self.connection_manager = connection_manager
         self.buffer_size = buffer_size
         self.events = events
         self.buffer = buffer
         self.sensitivity = sensitivity
+        self.motion_zones = motion_zones
+        self.motion_detection = motion_detection
+        self.motion_confirm_frames = motion_confirm_frames
+        self.motion_window_frames = motion_window_frames
+        self.motion_cooldown = motion_cooldown
+        self.motion_state = MotionState(
+            events=events,
+            confirm_frames=motion_confirm_frames,
+            window_frames=motion_window_frames,
+            cooldown=motion_cooldown)
         self.encoding_bitrate = encoding_bitrate
         self.encoding_profile = encoding_profile
         self.encoding_level = encoding_level
@@ -67,6 +102,7 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
         self.device_health = device_health
         if self.device_health is None:
             self.device_health = DeviceHealth(events=events)
+        self.device_health.add_metric(self.motion_state)
         self.configuration_lock = threading.Lock()
         self.__set_recording_window()
 
@@ -76,11 +112,21 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
                 int, self.recording_window.split('-'))
 
     def __new_motion_detect(self):
-        if self.__motion_detection_class is None:
+        motion_detection_class = self.__motion_detection_class
+        if motion_detection_class is None:
             from pinthesky.motion_detect import MotionDetector
-            self.__motion_detection_class = MotionDetector
-        return self.__motion_detection_class(
-            self.camera, self.events, self.sensitivity)
+            motion_detection_class = MotionDetector
+            if self.motion_detection == 'background':
+                from pinthesky.motion_detect import BackgroundMotionDetector
+                motion_detection_class = BackgroundMotionDetector
+        self.motion_state.configure(
+            confirm_frames=self.motion_confirm_frames,
+            window_frames=self.motion_window_frames,
+            cooldown=self.motion_cooldown)
+        return motion_detection_class(
+            self.camera, self.events, self.sensitivity,
+            zones=self.motion_zones,
+            state=self.motion_state)
 
     def __new_stream_buffer(self):
         if self.__stream_class is None:
@@ -106,7 +152,11 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
         self_types = {
             "buffer": int,
             "buffer_size": int,
+            "max_clip_duration": int,
             "sensitivity": int,
+            "motion_confirm_frames": int,
+            "motion_window_frames": int,
+            "motion_cooldown": float,
             "encoding_bitrate": int,
             "rotation": int,
             "framerate": int
@@ -126,16 +176,31 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
                     self.__set_recording_window()
 
     def __flush_start(self, trigger, event):
+        duration = event.get('duration', self.buffer)
         if not self.flushing_stream:
             logger.info(
                 f'Starting a flush on {trigger} video from {event["timestamp"]}')
             self.flushing_ts = event['timestamp']
-            self.flushing_buffer = self.buffer
-            if 'duration' in event:
-                self.flushing_buffer = event['duration']
+            self.flushing_buffer = duration
             self.flushing_stream = True
             self.flushing_trigger = trigger
             self.flushing_event = event
+        elif self.flushing_deadline is None:
+            self.flushing_buffer = max(self.flushing_buffer, duration)
+        else:
+            logger.debug(f'Extending the flush on {self.flushing_ts} by {trigger}')
+            self.__flush_schedule(time.monotonic() + duration, trigger, event)
+
+    def __flush_schedule(self, end, trigger=None, event=None):
+        # Clips are extended up to the max duration, the rest is chained
+        limit = self.flushing_started + self.max_clip_duration
+        if end > limit:
+            self.flushing_chain = max(self.flushing_chain or 0, end - limit)
+            self.flushing_chain_event = (
+                trigger if trigger is not None else self.flushing_trigger,
+                event if event is not None else self.flushing_event)
+            end = limit
+        self.flushing_deadline = max(self.flushing_deadline or 0, end)
 
     def on_capture_image(self, event):
         result = f'{self.capture_dir}/img-{event["timestamp"]}.jpg'
@@ -152,17 +217,60 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
     def on_record(self, event):
         with self.configuration_lock:
             if event['session']['start']:
-                self.pause()
                 self.record(event)
             elif event['session']['stop']:
-                self.pause()
+                self.__leave(event)
 
     def on_record_end(self, event):
         with self.configuration_lock:
-            self.pause()
+            self.__leave(event)
+
+    def __leave(self, event):
+        connection_id = event.get('connection', {}).get('id')
+        if connection_id is not None:
+            viewer = self.live_viewers.pop(connection_id, None)
+            if viewer is not None:
+                logger.info(f'Viewer {connection_id} left the live recording')
+                viewer.buffer.close()
+            if self.live_viewers:
+                return
+        # The last viewer to leave, or a stop for everyone, ends the live view
+        self.__stop_live()
+
+    def __end_live(self):
+        # The conversion was flushed with its encoder, finishing every viewer
+        self.live_broadcast.join()
+        for viewer in self.live_viewers.values():
+            viewer.join()
+        self.live_broadcast = None
+        self.live_conversion = None
+        self.live_viewers = {}
+
+    def __stop_live(self):
+        if self.live_broadcast is None:
+            return False
+        try:
+            self.camera.stop_recording(splitter_port=LIVE_SPLITTER_PORT)
+        except Exception as e:
+            logger.warning(f'Failed to stop the live recording, pausing the camera: {e}')
+            return self.pause()
+        self.__end_live()
+        logger.info('Camera live recording has ended')
+        if not self.motion_recording:
+            self.events.fire_event('recording_change', {
+                'recording': False
+            })
+        return True
 
     def on_motion_start(self, event):
-        self.__flush_start('motion', event)
+        with self.configuration_lock:
+            self.__flush_start('motion', event)
+
+    def on_motion_end(self, event):
+        with self.configuration_lock:
+            if self.flushing_deadline is not None:
+                # Record the buffer beyond the end of the motion
+                self.__flush_schedule(time.monotonic() + self.buffer)
 
     def on_capture_video(self, event):
         # Make sure to lock on other configuration changes before mutating camera state
@@ -175,10 +283,16 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
             'buffer': self.buffer,
             'buffer_size': self.buffer_size,
             'sensitivity': self.sensitivity,
+            'motion_zones': self.motion_zones,
+            'motion_detection': self.motion_detection,
+            'motion_confirm_frames': self.motion_confirm_frames,
+            'motion_window_frames': self.motion_window_frames,
+            'motion_cooldown': self.motion_cooldown,
             'rotation': self.camera.rotation,
             'resolution': 'x'.join(map(str, self.camera.resolution)),
             'framerate': self.camera.framerate.numerator,
             'recording_window': self.recording_window,
+            'max_clip_duration': self.max_clip_duration,
             'encoding_level': self.encoding_level,
             'encoding_profile': self.encoding_profile,
             'encoding_bitrate': self.encoding_bitrate
@@ -188,6 +302,11 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
         if "current" in event["content"]:
             cam_obj = event["content"]["current"]["state"]["desired"]["camera"]
             logger.info(f'Update camera fields in {cam_obj}')
+            if cam_obj.get('motion_detection', self.motion_detection) not in MOTION_DETECTIONS:
+                logger.warning(
+                    f'Ignoring unknown motion_detection {cam_obj["motion_detection"]}, '
+                    f'valid arguments {MOTION_DETECTIONS}')
+                cam_obj = {k: v for k, v in cam_obj.items() if k != 'motion_detection'}
             # Hold potentially dangerous mutations if the camera is flushing
             with self.configuration_lock:
                 # Pause any active recording on config update
@@ -209,7 +328,13 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
                     "buffer",
                     "buffer_size",
                     "sensitivity",
+                    "motion_zones",
+                    "motion_detection",
+                    "motion_confirm_frames",
+                    "motion_window_frames",
+                    "motion_cooldown",
                     "recording_window",
+                    "max_clip_duration",
                     "encoding_bitrate",
                     "encoding_profile",
                     "encoding_level"
@@ -217,25 +342,70 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
                 if previsouly_recording:
                     self.resume()
 
+    def __flush_begin(self):
+        self.camera.split_recording(f'{self.flushing_ts}.after.h264')
+        self.historical_stream.copy_to(f'{self.flushing_ts}.before.h264')
+        self.historical_stream.clear()
+        logger.debug("Flushed buffered contents")
+        self.flushing_framerate = float(self.camera.framerate)
+        self.flushing_started = time.monotonic()
+        self.__flush_schedule(self.flushing_started + self.flushing_buffer)
+
+    def __flush_complete(self):
+        self.events.fire_event('flush_end', {
+            'start_time': self.flushing_ts,
+            'trigger': self.flushing_trigger,
+            'framerate': self.flushing_framerate,
+            **self.flushing_event,
+        })
+        self.flushing_deadline = None
+        self.flushing_chain = None
+        self.flushing_chain_event = None
+        self.flushing_stream = False
+
+    def __flush_chain(self):
+        # The next clip continues from the split, so it has no buffered part
+        remaining = self.flushing_chain
+        trigger, event = self.flushing_chain_event
+        start_time = max(floor(time.time()), self.flushing_ts + 1)
+        self.camera.split_recording(f'{start_time}.after.h264')
+        self.__flush_complete()
+        logger.info(f'Chaining a flush on {trigger} video from {start_time}')
+        self.flushing_ts = start_time
+        self.flushing_trigger = trigger
+        self.flushing_event = event
+        self.flushing_stream = True
+        self.flushing_started = time.monotonic()
+        self.__flush_schedule(self.flushing_started + remaining)
+
     def __flush_video(self):
-        # Want to flush when it is safe to flush
+        # Only hold the lock for the split operations, recording continues
+        # in between while the run loop keeps ticking
         with self.configuration_lock:
-            self.camera.split_recording(f'{self.flushing_ts}.after.h264')
-            self.historical_stream.copy_to(f'{self.flushing_ts}.before.h264')
-            self.historical_stream.clear()
-            logger.debug("Flushed buffered contents")
-            time.sleep(self.flushing_buffer)
-            self.camera.split_recording(self.historical_stream)
-            self.events.fire_event('flush_end', {
-                'start_time': self.flushing_ts,
-                'trigger': self.flushing_trigger,
-                **self.flushing_event,
-            })
-            self.flushing_stream = False
+            if not self.flushing_stream:
+                return
+            if self.flushing_deadline is None:
+                self.__flush_begin()
+                return
+            now = time.monotonic()
+            if now >= self.flushing_deadline and self.motion_state.active:
+                # An active motion episode keeps extending the clip
+                self.__flush_schedule(now + self.buffer)
+            if now < self.flushing_deadline:
+                return
+            if self.flushing_chain is not None:
+                self.__flush_chain()
+            else:
+                self.camera.split_recording(self.historical_stream)
+                self.__flush_complete()
+
+    def __wait_timeout(self):
+        if self.flushing_deadline is None:
+            return 1
+        return min(1, max(0, self.flushing_deadline - time.monotonic()))
 
     def __enable_default_recording(self):
         return (
-            self.recording_thread is None and
             not self.flushing_stream and
             self.recording_window
         )
@@ -249,13 +419,19 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
                 if self.__enable_default_recording():
                     now = datetime.now()
                     if now.hour < self.start_hour or now.hour > self.end_hour:
-                        self.pause()
-                        time.sleep(1)
-                        continue
+                        if self.live_broadcast is None:
+                            self.pause()
+                            time.sleep(1)
+                            continue
+                        # Viewers keep watching on the live port outside the window
+                        self.__stop_motion()
                     else:
                         self.resume()
             try:
-                self.camera.wait_recording(1)
+                if self.motion_recording or self.live_broadcast is None:
+                    self.camera.wait_recording(self.__wait_timeout())
+                else:
+                    self.camera.wait_recording(self.__wait_timeout(), splitter_port=LIVE_SPLITTER_PORT)
                 if self.flushing_stream:
                     self.__flush_video()
             except Exception as e:
@@ -266,15 +442,22 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
                 self.pause()
 
     def pause(self):
-        if self.camera.recording or self.recording_thread is not None:
+        if self.camera.recording or self.live_broadcast is not None:
             # Have to tear down camera completely to reinstall encoders
             try:
                 self.camera.close()
             except Exception as e:
                 logger.warning(f'Failed to close, but killed the camera {e}')
-            if self.recording_thread is not None:
-                self.recording_thread.join()
-                self.recording_thread = None
+            if self.flushing_deadline is not None:
+                # Closing the camera closed the clip, so it ends early
+                self.__flush_complete()
+            elif self.flushing_stream:
+                # The buffer closed with the camera, there is nothing to split
+                logger.info(f'Dropping the pending flush from {self.flushing_ts}')
+                self.flushing_stream = False
+            if self.live_broadcast is not None:
+                self.__end_live()
+            self.motion_recording = False
             logger.info("Camera recording is now paused")
             self.events.fire_event('recording_change', {
                 'recording': False
@@ -283,16 +466,44 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
             return True
         return False
 
+    def __stop_motion(self):
+        if not self.motion_recording:
+            return False
+        self.camera.stop_recording()
+        if self.motion_detection == 'background':
+            self.camera.stop_recording(splitter_port=MOTION_SPLITTER_PORT)
+        self.motion_recording = False
+        logger.info('Camera motion recording is now paused, live recording continues')
+        return True
+
+    def __recording(self):
+        # The live view records on its own splitter port alongside motion
+        if self.live_broadcast is not None:
+            return self.motion_recording
+        return self.camera.recording
+
     def resume(self):
-        if not self.camera.recording:
+        if not self.__recording():
             self.historical_stream = self.__new_stream_buffer()
+            motion_detect = self.__new_motion_detect()
+            motion_output = motion_detect
+            if self.motion_detection == 'background':
+                motion_output = None
             self.camera.start_recording(
                 self.historical_stream,
                 format='h264',
                 bitrate=self.encoding_bitrate,
                 profile=self.encoding_profile,
                 level=self.encoding_level,
-                motion_output=self.__new_motion_detect())
+                motion_output=motion_output)
+            if motion_output is None:
+                # Background model analyses low resolution frames on its own port
+                self.camera.start_recording(
+                    motion_detect,
+                    format='yuv',
+                    splitter_port=MOTION_SPLITTER_PORT,
+                    resize=motion_detect.size)
+            self.motion_recording = True
             logger.info("Camera is now recording")
             self.events.fire_event('recording_change', {
                 'recording': True
@@ -300,26 +511,68 @@ class CameraThread(threading.Thread, Handler, ShadowConfigHandler):
             return True
         return False
 
+    def __new_decimation(self, session):
+        options = {'scale': 1, 'skip': 1, 'resizer': 'gpu'}
+        for field in ['scale', 'skip']:
+            try:
+                value = int(session.get(field, 1))
+                if value < 1:
+                    raise ValueError(f'{field} must be positive')
+                options[field] = value
+            except (TypeError, ValueError) as e:
+                logger.warning(f'Ignoring live {field} {session[field]}: {e}')
+        resizer = session.get('resizer', 'gpu')
+        if resizer in DECIMATION_RESIZERS:
+            options['resizer'] = resizer
+        else:
+            logger.warning(
+                f'Ignoring unknown live resizer {resizer}, '
+                f'valid arguments {DECIMATION_RESIZERS}')
+        return FrameDecimation(self.camera.resolution, **options)
+
     def record(self, event):
-        if not self.camera.recording:
-            # Recording event was initated with a valid session connection
-            # Pump the magic header into the connection for streaming
-            JSMPEGHeader(self.connection_manager, event, self.camera).send()
-            conversion = VideoConversion(self.camera)
-            self.recording_thread = ConnectionThread(
-                buffer=ProcessBuffer(conversion.process),
-                manager=self.connection_manager,
-                events=self.events,
-                event_data=event,
-            )
-            self.camera.start_recording(conversion, 'yuv')
-            self.recording_thread.start()
+        connection_id = event['connection']['id']
+        if self.live_broadcast is None:
+            decimation = self.__new_decimation(event['session'])
+            self.live_conversion = VideoConversion(
+                self.camera,
+                decimation=decimation,
+                registry=self.registry)
+            self.live_broadcast = BroadcastBuffer(
+                ConversionBuffer(self.live_conversion),
+                feedback=self.live_conversion.adapt,
+                registry=self.registry)
+            self.camera.start_recording(
+                self.live_conversion,
+                format='yuv',
+                splitter_port=LIVE_SPLITTER_PORT,
+                resize=decimation.resize)
+            self.live_broadcast.start()
             logger.info("Camera is now live recording")
-            self.events.fire_event('recording_change', {
-                'recording': True
-            })
-            return True
-        return False
+            if not self.motion_recording:
+                self.events.fire_event('recording_change', {
+                    'recording': True
+                })
+        elif connection_id in self.live_viewers:
+            return False
+        else:
+            logger.info(
+                f'Viewer {connection_id} joined the live recording with '
+                f'{len(self.live_viewers)} others at the current settings')
+        # Recording event was initated with a valid session connection
+        # Pump the magic header into the connection for streaming
+        JSMPEGHeader(self.connection_manager, event, self.live_conversion.resolution).send()
+        subscriber = self.live_broadcast.subscribe()
+        viewer = ConnectionThread(
+            buffer=subscriber,
+            manager=self.connection_manager,
+            events=self.events,
+            event_data=event,
+            feedback=subscriber.report,
+        )
+        self.live_viewers[connection_id] = viewer
+        viewer.start()
+        return True
 
     def stop(self):
         self.running = False
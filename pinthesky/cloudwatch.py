@@ -1,13 +1,20 @@
-import boto3
 import logging
 import threading
 import queue
 import json
 import datetime
+import time
 from math import floor
 from pinthesky import VERSION
 from pinthesky.handler import Handler
 from pinthesky.config import ConfigUpdate, ShadowConfigHandler
+from pinthesky.health import DeviceHealthMetric
+from pinthesky.metrics import MetricsRegistry
+
+# Service limits of a single PutLogEvents call
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26
 
 
 class CloudWatchManager(Handler, ShadowConfigHandler):
@@ -16,7 +23,8 @@ class CloudWatchManager(Handler, ShadowConfigHandler):
     plugging directly into the shadow update process. When changes are
     detected, it'll readapt CloudWatch logging as necessary. This includes
     the background thread and event type filter, as well as dynamic enable
-    and disable.
+    and disable. Metrics recorded into the MetricsRegistry are flushed as
+    EMF on every `health_end`, so they follow the health interval.
     """
     def __init__(
             self,
@@ -28,7 +36,9 @@ class CloudWatchManager(Handler, ShadowConfigHandler):
             threaded=False,
             namespace='Pits/Device',
             event_type='logs',
-            region_name=None):
+            region_name=None,
+            throttle=None,
+            registry=None):
         self.session = session
         self.log_group_name = log_group_name
         self.log_level = log_level
@@ -38,10 +48,13 @@ class CloudWatchManager(Handler, ShadowConfigHandler):
         self.threaded = threaded
         self.event_type = event_type
         self.region_name = region_name
+        self.throttle = throttle
+        self.registry = registry if registry is not None else MetricsRegistry()
         self.event_handler = None
         self.log_handler = None
         self.log_thread = None
         self.refresh_lock = threading.Lock()
+        self.metrics = LogShippingMetrics()
 
     def adapt_logging(self):
         with self.refresh_lock:
@@ -60,7 +73,8 @@ class CloudWatchManager(Handler, ShadowConfigHandler):
                 enabled=self.enabled,
                 log_group_name=self.log_group_name,
                 session=self.session,
-                region_name=self.region_name)
+                region_name=self.region_name,
+                throttle=self.throttle)
             # Create handler that writes logs to CW
             if self.log_handler is not None:
                 root.removeHandler(self.log_handler)
@@ -81,7 +95,7 @@ class CloudWatchManager(Handler, ShadowConfigHandler):
             self.event_handler.setFormatter(format)
             if self.enabled and self.threaded:
                 # Replace stream to be backed by thread
-                self.log_thread = ThreadedStream(stream=log_stream)
+                self.log_thread = ThreadedStream(stream=log_stream, metrics=self.metrics)
                 self.log_handler.setStream(self.log_thread)
                 self.event_handler.setStream(self.log_thread)
                 self.log_thread.start()
@@ -125,7 +139,26 @@ class CloudWatchManager(Handler, ShadowConfigHandler):
             self.region_name = cloudwatch.get("region_name", self.region_name)
             self.adapt_logging()
 
+    def flush_metrics(self):
+        groups = self.registry.collect()
+        with self.refresh_lock:
+            handler = self.event_handler
+        if handler is None or not groups:
+            return
+        documents = handler.formatter.format_metrics(groups)
+        handler.acquire()
+        try:
+            for document in documents:
+                handler.stream.write(document + handler.terminator)
+            handler.flush()
+        finally:
+            handler.release()
+
+    def on_health_end(self, event):
+        self.flush_metrics()
+
     def stop(self):
+        self.flush_metrics()
         if self.log_thread is not None:
             self.log_thread.stop()
 
@@ -147,10 +180,12 @@ class CloudWatchLoggingStream():
             log_group_name=None,
             enabled=False,
             delineate_stream=True,
-            region_name=None):
+            region_name=None,
+            throttle=None):
         self.session = session
         self.log_group_name = log_group_name
         self.log_stream_name = None
+        self.throttle = throttle
         self.enabled = enabled
         self.delineate_stream = delineate_stream
         self.region_name = region_name
@@ -165,38 +200,63 @@ class CloudWatchLoggingStream():
             resp = cloudwatch.describe_log_streams(
                 logGroupName=self.log_group_name,
                 logStreamNamePrefix=desired_stream)
+            exists = False
             for log_stream in resp['logStreams']:
                 if log_stream['logStreamName'] == desired_stream:
-                    self.log_stream_name = desired_stream
+                    exists = True
                     break
-            if not self.log_stream_name:
+            if not exists:
                 cloudwatch.create_log_stream(
                     logGroupName=self.log_group_name,
                     logStreamName=desired_stream)
-                self.log_stream_name = desired_stream
+            self.log_stream_name = desired_stream
         return self.log_stream_name
 
     def write(self, message, ingest=None):
-        credentials = self.session.login()
-        if not self.enabled or not credentials or not self.log_group_name:
+        self.write_batch([{'message': message, 'timestamp': ingest}])
+
+    def write_batch(self, logs):
+        """
+        Puts the logs in as few calls as the service limits allow. A call
+        is split when it would exceed the event count or payload size, or
+        when the logs cross into the log stream of the next day.
+        """
+        if not self.enabled or not self.log_group_name or not logs:
             return
-        now = ingest if ingest is not None else datetime.datetime.now()
-        session = boto3.Session(
-            credentials['accessKeyId'],
-            credentials['secretAccessKey'],
-            credentials['sessionToken'])
-        cloudwatch = session.client('logs', region_name=self.region_name)
-        log_stream_name = self._log_stream_name(now, cloudwatch)
+        cloudwatch = self.session.client('logs', region_name=self.region_name)
+        if cloudwatch is None:
+            return
+        batch = []
+        batch_bytes = 0
+        batch_stream = None
+        for log in logs:
+            now = log['timestamp'] if log['timestamp'] is not None else datetime.datetime.now()
+            message = log['message'].rstrip('\n')
+            size = len(message.encode('utf-8')) + EVENT_OVERHEAD_BYTES
+            log_stream_name = self._log_stream_name(now, cloudwatch)
+            if batch and (
+                    len(batch) >= MAX_BATCH_EVENTS
+                    or batch_bytes + size > MAX_BATCH_BYTES
+                    or batch_stream != log_stream_name):
+                self._put_log_events(cloudwatch, batch_stream, batch)
+                batch = []
+                batch_bytes = 0
+            batch_stream = log_stream_name
+            batch_bytes += size
+            batch.append({
+                'message': message,
+                'timestamp': floor(now.timestamp()) * 1000
+            })
+        self._put_log_events(cloudwatch, batch_stream, batch)
+
+    def _put_log_events(self, cloudwatch, log_stream_name, log_events):
+        if self.throttle is not None:
+            size = sum([len(e['message']) + EVENT_OVERHEAD_BYTES for e in log_events])
+            self.throttle.acquire(size, 'logs')
         cloudwatch.put_log_events(
             logGroupName=self.log_group_name,
             logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'message': message.rstrip('\n'),
-                    'timestamp': floor(now.timestamp()) * 1000
-                }
-            ]
-        )
+            logEvents=log_events)
 
 
 class CloudWatchEventFilter():
@@ -276,39 +336,163 @@ class CloudWatchEventFormat():
         emf.update(existing_emf)
         return json.dumps(emf)
 
+    def format_metrics(self, groups, timestamp=None):
+        """
+        Converts groups collected from a MetricsRegistry into one EMF
+        document per set of dimensions, rolled up by each dimension.
+        """
+        timestamp = timestamp if timestamp is not None else time.time()
+        documents = []
+        for group in groups:
+            documents.append(json.dumps({
+                '_aws': {
+                    'Timestamp': int(timestamp) * 1000,
+                    'CloudWatchMetrics': [
+                        {
+                            'Namespace': self.namespace,
+                            'Dimensions': [
+                                ['ThingName', name] for name in group['dimensions']
+                            ] or [['ThingName']],
+                            'Metrics': group['metrics'],
+                        }
+                    ],
+                },
+                'ThingName': self.session.thing_name,
+                'Version': VERSION,
+                **group['dimensions'],
+                **group['values'],
+            }))
+        return documents
+
+
+class LogShippingMetrics(DeviceHealthMetric):
+    """
+    Counts the batches shipped by a ThreadedStream. The metrics outlive the
+    thread, so totals carry over when logging is reconfigured.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.events = 0
+        self.max_batch = 0
+        self.flush_time = 0
+        self.max_flush_time = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def flushed(self, events, seconds, failed=False):
+        with self.lock:
+            self.batches += 1
+            self.events += events
+            self.max_batch = max(self.max_batch, events)
+            self.flush_time += seconds
+            self.max_flush_time = max(self.max_flush_time, seconds)
+            if failed:
+                self.failed += events
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def report(self):
+        with self.lock:
+            return {
+                'log_batches': self.batches,
+                'log_batch_events_avg': self.events / max(1, self.batches),
+                'log_batch_events_max': self.max_batch,
+                'log_flush_latency_avg': self.flush_time / max(1, self.batches),
+                'log_flush_latency_max': self.max_flush_time,
+                'log_dropped': self.dropped,
+                'log_failed': self.failed,
+            }
+
 
 class ThreadedStream(threading.Thread):
     """
     An optional queue backed logging.StreamHandler stream to prevent
     foreground interactions to block other threads from logging
-    activities.
+    activities. Messages are shipped in batches, flushed when the batch
+    reaches the service limits or the oldest message is `max_batch_age`
+    seconds old. The queue is bounded, and messages logged while it is full
+    are dropped rather than blocking the logger.
 
     stream_thread = ThreadStream(stream=CloudWatchLoggingStream())
     stream_thread.run()
     handler = logging.StreamHandler(stream=stream_thread)
     logging.getLogger(__name__).addHandler(handler)
     """
-    def __init__(self, stream):
+    def __init__(
+            self,
+            stream,
+            max_queue_size=MAX_BATCH_EVENTS,
+            max_batch_events=MAX_BATCH_EVENTS,
+            max_batch_bytes=MAX_BATCH_BYTES,
+            max_batch_age=5,
+            metrics=None):
         super().__init__(daemon=True)
         self.stream = stream
-        self.queue = queue.Queue()
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.max_batch_events = max_batch_events
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_age = max_batch_age
+        self.metrics = metrics if metrics is not None else LogShippingMetrics()
         self.running = False
 
     def write(self, message):
-        self.queue.put_nowait({
-            'message': message,
-            'timestamp': datetime.datetime.now(),
-        })
+        try:
+            self.queue.put_nowait({
+                'message': message,
+                'timestamp': datetime.datetime.now(),
+            })
+        except queue.Full:
+            self.metrics.drop()
+
+    def __next_batch(self):
+        log = self.queue.get()
+        if log is None:
+            return [], True
+        batch = [log]
+        batch_bytes = len(log['message']) + EVENT_OVERHEAD_BYTES
+        deadline = time.monotonic() + self.max_batch_age
+        while len(batch) < self.max_batch_events and batch_bytes < self.max_batch_bytes:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                log = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if log is None:
+                return batch, True
+            batch.append(log)
+            batch_bytes += len(log['message']) + EVENT_OVERHEAD_BYTES
+        return batch, False
+
+    def __flush(self, batch):
+        start = time.monotonic()
+        failed = False
+        try:
+            self.stream.write_batch(batch)
+        except Exception:
+            # Logging the failure would loop back into this stream
+            failed = True
+        finally:
+            self.metrics.flushed(len(batch), time.monotonic() - start, failed)
+            for _ in batch:
+                self.queue.task_done()
 
     def run(self) -> None:
         self.running = True
         while self.running:
-            log = self.queue.get()
-            try:
-                self.stream.write(log['message'], log['timestamp'])
-            finally:
+            batch, stopped = self.__next_batch()
+            if batch:
+                self.__flush(batch)
+            if stopped:
+                self.running = False
                 self.queue.task_done()
 
     def stop(self):
-        self.queue.join()
+        if self.is_alive():
+            self.queue.put(None)
+            self.queue.join()
         self.running = False
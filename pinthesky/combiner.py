@@ -1,8 +1,51 @@
 from pinthesky.handler import Handler
+from pinthesky.mp4 import FragmentedMP4Writer, iter_nal_units
 import logging
 import os
 
 logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+COMBINE_STRATEGIES = ['copy', 'append', 'parts']
+COMBINE_CONTAINERS = ['h264', 'mp4']
+
+
+def _copy_file_range(in_fd, out_fd, count):
+    return os.copy_file_range(in_fd, out_fd, count)
+
+
+def _sendfile(in_fd, out_fd, count):
+    return os.sendfile(out_fd, in_fd, None, count)
+
+
+def append_file(part_name, output, chunk_size=CHUNK_SIZE, copies=None):
+    """
+    Appends the content of a file onto the current position of an unbuffered
+    output file. The copy happens in the kernel with copy_file_range or
+    sendfile when available, and falls back to a chunked copy through a
+    single reused buffer, so memory stays constant regardless of file size.
+    """
+    if copies is None:
+        copies = [_copy_file_range, _sendfile]
+    with open(part_name, 'rb', buffering=0) as i:
+        in_fd, out_fd = i.fileno(), output.fileno()
+        size = os.fstat(in_fd).st_size
+        for copy in copies:
+            try:
+                while os.lseek(in_fd, 0, os.SEEK_CUR) < size:
+                    if copy(in_fd, out_fd, chunk_size) == 0:
+                        break
+                return
+            except (AttributeError, OSError) as e:
+                # Offsets are shared, so the next method resumes any progress
+                logger.debug(f'Falling back from {copy.__name__}: {e}')
+        buffer = memoryview(bytearray(chunk_size))
+        while True:
+            read = i.readinto(buffer)
+            if not read:
+                break
+            written = 0
+            while written < read:
+                written += output.write(buffer[written:read])
 
 
 class VideoCombiner(Handler):
@@ -10,10 +53,50 @@ class VideoCombiner(Handler):
     Combines motion video by concatenating video buffering in memory with
     real-time video. The result of this handle will fire a `combine_end`
     event to signal waiters to do something with the video.
+
+    The `copy` strategy streams both parts into a new file. The `append`
+    strategy moves the buffered part into place and only appends the
+    real-time part, writing the buffered video once. The `parts` strategy
+    skips combining entirely and lists the parts in `combine_parts` for
+    the uploader to stream back to back as the object `combine_name`, with
+    no `combine_video` as none is written.
+
+    The `mp4` container muxes the parts into a fragmented MP4 timed from
+    the camera framerate instead of concatenating raw H.264.
     """
-    def __init__(self, events, combine_dir):
+    def __init__(self, events, combine_dir, combine_strategy='copy', combine_container='h264'):
         self.events = events
         self.combine_dir = combine_dir
+        self.combine_strategy = combine_strategy
+        self.combine_container = combine_container
+        if combine_container == 'mp4' and combine_strategy == 'parts':
+            logger.warning('The parts strategy uploads raw parts, ignoring the mp4 container')
+
+    def __move_part(self, part_name, file_name):
+        if not os.path.exists(part_name):
+            return False
+        try:
+            os.replace(part_name, file_name)
+            return True
+        except OSError as e:
+            # Parts on another file system have to be copied
+            logger.debug(f'Failed to move {part_name} to {file_name}: {e}')
+            return False
+
+    def __mux(self, file_name, part_names, framerate):
+        with open(file_name, 'wb') as o:
+            writer = FragmentedMP4Writer(o, framerate=framerate)
+            for part_name in part_names:
+                # Chained clips continue from a split without a buffered part
+                if not os.path.exists(part_name):
+                    continue
+                with open(part_name, 'rb') as i:
+                    for nal in iter_nal_units(i):
+                        writer.write(nal)
+            writer.close()
+        for part_name in part_names:
+            if os.path.exists(part_name):
+                os.remove(part_name)
 
     def on_flush_end(self, event):
         """
@@ -26,11 +109,46 @@ class VideoCombiner(Handler):
         file_name = os.path.join(
             self.combine_dir,
             f'{event["start_time"]}.motion.h264')
-        with open(file_name, 'wb') as o:
-            for n in ['before', 'after']:
+        parts = ['before', 'after']
+        if self.combine_container == 'mp4' and self.combine_strategy != 'parts':
+            file_name = os.path.join(
+                self.combine_dir,
+                f'{event["start_time"]}.motion.mp4')
+            self.__mux(
+                file_name,
+                [f'{event["start_time"]}.{n}.h264' for n in parts],
+                event.get('framerate') or 20)
+            self.events.fire_event('combine_end', {
+                'start_time': event['start_time'],
+                'combine_video': file_name,
+                **event,
+            })
+            logger.debug(f'Finish muxing to {file_name}')
+            return
+        if self.combine_strategy == 'parts':
+            part_names = [f'{event["start_time"]}.{n}.h264' for n in parts]
+            self.events.fire_event('combine_end', {
+                'start_time': event['start_time'],
+                'combine_name': os.path.basename(file_name),
+                'combine_parts': [p for p in part_names if os.path.exists(p)],
+                **event,
+            })
+            logger.debug(f'Skipping concatination to {file_name}')
+            return
+        mode = 'wb'
+        if self.combine_strategy == 'append':
+            before_name = f'{event["start_time"]}.before.h264'
+            if self.__move_part(before_name, file_name):
+                parts = ['after']
+                mode = 'r+b'
+        with open(file_name, mode, buffering=0) as o:
+            o.seek(0, os.SEEK_END)
+            for n in parts:
                 part_name = f'{event["start_time"]}.{n}.h264'
-                with open(part_name, 'rb') as i:
-                    o.write(i.read())
+                # Chained clips continue from a split without a buffered part
+                if not os.path.exists(part_name):
+                    continue
+                append_file(part_name, o)
                 os.remove(part_name)
         self.events.fire_event('combine_end', {
             'start_time': event['start_time'],
@@ -4,6 +4,7 @@ import logging
 import os
 
 from pinthesky.handler import Handler
+from pinthesky.metrics import MetricsRegistry
 
 
 logger = logging.getLogger(__name__)
@@ -27,8 +28,10 @@ class ShadowConfig(Handler):
             self,
             events,
             configure_input,
-            configure_output) -> None:
+            configure_output,
+            registry=None) -> None:
         self.__events = events
+        self.__registry = registry if registry is not None else MetricsRegistry()
         self.__configure_input = configure_input
         self.__configure_output = configure_output
         self.__handlers = []
@@ -95,22 +98,5 @@ class ShadowConfig(Handler):
                 with open(self.__configure_input, 'w') as f:
                     f.write("")
         elif event['file_name'] == self.__configure_input:
-            logger.info(
-                f'Config update received on {event["timestamp"]}',
-                extra={
-                    'emf': {
-                        'CloudWatchMetrics': [
-                            {
-                                'Dimensions': ['ThingName', 'Operation'],
-                                'Metrics': [
-                                    {
-                                        'Name': 'Shadow',
-                                        'Unit': 'Count'
-                                    }
-                                ]
-                            }
-                        ],
-                        'Shadow': 1,
-                        'Operation': 'ConfigUpdate',
-                    }
-                })
+            self.__registry.counter('Shadow', Operation='ConfigUpdate').add()
+            logger.info(f'Config update received on {event["timestamp"]}')
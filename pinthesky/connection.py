@@ -1,14 +1,19 @@
-import boto3
 import json
 import logging
+import queue
+import time
 from base64 import b64encode
 from botocore.exceptions import ClientError
+from collections import deque
 from pinthesky.config import ConfigUpdate, ShadowConfigHandler
 from pinthesky.handler import Handler
-from threading import Thread
+from pinthesky.metrics import MetricsRegistry
+from threading import Condition, Lock, Thread
 
 
 FRAME_SIZE = 32768
+# API Gateway WebSocket frames are limited to 128KB, and base64 adds a third
+MAX_BATCH_SIZE = 131072 // 4 * 3
 
 logger = logging.getLogger(__name__)
 
@@ -54,30 +59,244 @@ class ProcessBuffer(ConnectionBuffer):
         return self.process.poll()
 
 
+class SubscriberBuffer(ConnectionBuffer):
+    """
+    A viewer's share of a BroadcastBuffer, holding at most `window` chunks.
+    A viewer that falls behind loses its oldest chunks rather than holding
+    up the broadcast or the other viewers. The ConnectionThread of the
+    viewer reports its latency and backlog here, as its `feedback`.
+    """
+    def __init__(self, broadcast, window, dropped) -> None:
+        self.broadcast = broadcast
+        self.chunks = deque(maxlen=window)
+        self.condition = Condition()
+        self.dropped = dropped
+        self.closed = False
+        self.signal = None
+
+    def report(self, latency, backlog):
+        self.signal = (latency, backlog)
+        self.broadcast.report()
+
+    def offer(self, chunk):
+        with self.condition:
+            if len(self.chunks) == self.chunks.maxlen:
+                self.dropped.add()
+            self.chunks.append(chunk)
+            self.condition.notify()
+
+    def finish(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def read1(self, size, timeout=0.1):
+        with self.condition:
+            if not self.chunks and not self.closed:
+                self.condition.wait(timeout)
+            if not self.chunks:
+                return b''
+            chunk = self.chunks.popleft()
+            if len(chunk) > size:
+                self.chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            return chunk
+
+    def close(self):
+        self.broadcast.unsubscribe(self)
+
+    def poll(self):
+        with self.condition:
+            return 0 if self.closed and not self.chunks else None
+
+
+class BroadcastBuffer(Thread):
+    """
+    Reads a buffer once and fans every chunk out to the SubscriberBuffer of
+    each viewer, so a single encoder serves any number of connections.
+    Viewers subscribe and unsubscribe while the broadcast is running, and
+    every subscriber is finished when the buffer ends.
+
+    The encoder is shared, so `feedback` gets the latency and backlog of the
+    median viewer rather than of each one, and a single slow viewer does
+    not lower the quality for everyone else.
+
+    broadcast = BroadcastBuffer(ConversionBuffer(conversion), feedback=conversion.adapt)
+    subscriber = broadcast.subscribe()
+    ConnectionThread(buffer=subscriber, feedback=subscriber.report, ...).start()
+    """
+    def __init__(self, buffer, window=64, feedback=None, registry=None) -> None:
+        super().__init__(daemon=True)
+        self.buffer = buffer
+        self.window = window
+        self.feedback = feedback
+        self.lock = Lock()
+        self.subscribers = []
+        self.closed = False
+        registry = registry if registry is not None else MetricsRegistry()
+        self.viewers = registry.gauge('LiveViewers', Operation='LiveView')
+        self.dropped = registry.counter('LiveChunksDropped', Operation='LiveView')
+
+    def subscribe(self) -> SubscriberBuffer:
+        subscriber = SubscriberBuffer(self, self.window, self.dropped)
+        with self.lock:
+            if self.closed:
+                subscriber.finish()
+            else:
+                self.subscribers.append(subscriber)
+                self.viewers.set(len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+                self.viewers.set(len(self.subscribers))
+        subscriber.finish()
+
+    def report(self):
+        with self.lock:
+            signals = sorted(s.signal for s in self.subscribers if s.signal is not None)
+        if self.feedback is not None and signals:
+            # The lower median, so one of two viewers lagging changes nothing
+            self.feedback(*signals[(len(signals) - 1) // 2])
+
+    def run(self):
+        try:
+            while True:
+                buf = self.buffer.read1(FRAME_SIZE)
+                if buf:
+                    with self.lock:
+                        subscribers = list(self.subscribers)
+                    for subscriber in subscribers:
+                        subscriber.offer(buf)
+                elif self.buffer.poll() is not None:
+                    break
+        except (OSError, ValueError) as e:
+            logger.warning(f'Failed to read from the broadcast buffer: {e}')
+        finally:
+            with self.lock:
+                self.closed = True
+                subscribers, self.subscribers = self.subscribers, []
+                self.viewers.set(0)
+            for subscriber in subscribers:
+                subscriber.finish()
+            self.buffer.close()
+
+
 class ConnectionThread(Thread):
-    def __init__(self, buffer, manager, event_data, events):
+    """
+    Streams a buffer to a connection. A reader thread pulls chunks off the
+    buffer into a bounded queue of `window` chunks, while this thread
+    coalesces them into posts of up to `max_batch_size` bytes, waiting at
+    most `max_batch_delay` seconds to fill one. Reads continue while a post
+    is in flight, but posts are sent one at a time to keep frames in order.
+    After every post, `feedback` is called with the seconds from reading to
+    posting and the fraction of the read-ahead queue that is full.
+    """
+    def __init__(
+            self,
+            buffer,
+            manager,
+            event_data,
+            events,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_batch_delay=0.02,
+            window=16,
+            feedback=None):
         super().__init__()
         self.buffer = buffer
         self.manager = manager
         self.event_data = event_data
         self.events = events
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.feedback = feedback
+        self.chunks = queue.Queue(maxsize=window)
+        self.carry = None
+        self.finished = False
+        self.running = True
+        self.posts = 0
+        self.posted_bytes = 0
+        self.latency = 0
+        self.reader = Thread(target=self.__read, daemon=True)
 
-    def run(self):
-        logger.info('Starting connection background thread')
+    def __put(self, chunk):
+        while self.running:
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __read(self):
         try:
-            while True:
+            while self.running:
                 buf = self.buffer.read1(FRAME_SIZE)
                 if buf:
-                    if not self.manager.post_to_connection(
-                        connection_id=self.event_data['connection']['id'],
-                        data=buf,
-                        binary=True
-                    ):
-                        break
+                    self.__put((time.monotonic(), buf))
                 elif self.buffer.poll() is not None:
                     break
+        except (OSError, ValueError) as e:
+            # The buffer is closed from under the reader when posting stops
+            if self.running:
+                logger.warning(f'Failed to read from the connection buffer: {e}')
+        finally:
+            self.__put(None)
+
+    def __next_batch(self):
+        if self.carry is not None:
+            chunk, self.carry = self.carry, None
+        elif self.finished:
+            return None, None
+        else:
+            chunk = self.chunks.get()
+        if chunk is None:
+            return None, None
+        read_time, buf = chunk
+        batch = [buf]
+        size = len(buf)
+        deadline = read_time + self.max_batch_delay
+        while size < self.max_batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                chunk = self.chunks.get(timeout=timeout) if timeout > 0 else self.chunks.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                self.finished = True
+                break
+            if size + len(chunk[1]) > self.max_batch_size:
+                self.carry = chunk
+                break
+            batch.append(chunk[1])
+            size += len(chunk[1])
+        return read_time, b''.join(batch)
+
+    def run(self):
+        logger.info('Starting connection background thread')
+        self.reader.start()
+        try:
+            while True:
+                read_time, batch = self.__next_batch()
+                if batch is None:
+                    break
+                if not self.manager.post_to_connection(
+                    connection_id=self.event_data['connection']['id'],
+                    data=batch,
+                    binary=True
+                ):
+                    break
+                self.posts += 1
+                self.posted_bytes += len(batch)
+                # Seconds from reading the oldest chunk to posting it
+                self.latency = time.monotonic() - read_time
+                if self.feedback is not None:
+                    self.feedback(self.latency, self.chunks.qsize() / self.chunks.maxsize)
         finally:
             logger.info('Recording on camera has ended')
+            self.running = False
             self.buffer.close()
             self.events.fire_event('record_end', {
                 **self.event_data,
@@ -88,11 +307,14 @@ class ConnectionThread(Thread):
 
 
 class ConnectionManager(ShadowConfigHandler, Handler):
-    def __init__(self, session, enabled=False, endpoint_url=None, region_name=None) -> None:
+    def __init__(
+            self, session, enabled=False, endpoint_url=None, region_name=None,
+            throttle=None) -> None:
         self.session = session
         self.endpoint_url = endpoint_url
         self.enabled = enabled
         self.region_name = region_name
+        self.throttle = throttle
 
     def update_document(self) -> ConfigUpdate:
         return ConfigUpdate("dataplane", {
@@ -115,23 +337,20 @@ class ConnectionManager(ShadowConfigHandler, Handler):
         endpoint_url = endpoint_override if endpoint_override is not None else self.endpoint_url
         if endpoint_url is None:
             return False
-        credentials = self.session.login()
-        if credentials is None:
-            return False
-        session = boto3.Session(
-            aws_access_key_id=credentials['accessKeyId'],
-            aws_secret_access_key=credentials['secretAccessKey'],
-            aws_session_token=credentials['sessionToken'],
-        )
-        management = session.client(
+        management = self.session.client(
             'apigatewaymanagementapi',
             endpoint_url=endpoint_url,
             region_name=self.region_name,
         )
+        if management is None:
+            return False
+        payload = data if not binary else b64encode(data)
+        if self.throttle is not None and isinstance(payload, (bytes, str)):
+            self.throttle.acquire(len(payload), 'live' if binary else 'control')
         try:
             management.post_to_connection(
                 ConnectionId=connection_id,
-                Data=data if not binary else b64encode(data),
+                Data=payload,
             )
         except ClientError as e:
             logger.error(f'Failed to post to {connection_id}: {e}', exc_info=e)
@@ -1,8 +1,12 @@
 import io
 import logging
 import os
+import threading
+import time
+import numpy as np
 from subprocess import Popen, PIPE
-from pinthesky.connection import ProtocolData
+from pinthesky.connection import ConnectionBuffer, ProtocolData
+from pinthesky.metrics import MetricsRegistry
 from struct import Struct
 
 
@@ -11,38 +15,195 @@ logger = logging.getLogger(__name__)
 
 JSMPEG_MAGIC = b'jsmp'
 JSMPEG_HEADER = Struct('>4sHH')
+# Highest quality first, skipping frames lowers the framerate encoded
+QUALITY_TIERS = [
+    {'bitrate': '800k', 'skip': 1},
+    {'bitrate': '500k', 'skip': 2},
+    {'bitrate': '250k', 'skip': 4},
+]
+DECIMATION_RESIZERS = ['gpu', 'stride']
 
 
 class JSMPEGHeader(ProtocolData):
-    def __init__(self, manager, event_data, camera) -> None:
+    def __init__(self, manager, event_data, resolution) -> None:
         super().__init__(manager, event_data)
-        self.camera = camera
+        self.resolution = resolution
 
     def protocol(self):
-        (width, height) = self.camera.resolution
+        (width, height) = self.resolution
         return JSMPEG_HEADER.pack(JSMPEG_MAGIC, width, height)
 
 
+class FrameDecimation():
+    """
+    Shrinks raw YUV420 frames before they are piped to ffmpeg, by keeping
+    every `skip` frame and every `scale` pixel of each plane. Frames from
+    the camera are padded to multiples of 32x16, so the planes are sliced
+    as views over the frame and copied once into a reused output frame at
+    exactly `size`. Frames that are already the right size pass through
+    untouched.
+
+    The `gpu` resizer has the camera scale frames on the splitter port
+    instead, leaving only the padding to remove here.
+
+    decimation = FrameDecimation((1920, 1080), scale=2, skip=2)
+    frame = decimation.decimate(b)
+    """
+    def __init__(self, resolution, scale=1, skip=1, resizer='gpu') -> None:
+        self.scale = scale
+        self.skip = skip
+        self.resizer = resizer
+        (width, height) = resolution
+        # Chroma planes are half the size, so the output stays even
+        self.size = ((width // scale) & ~1, (height // scale) & ~1)
+        if resizer == 'gpu':
+            self.resize = None if scale == 1 else self.size
+            resolution = self.size
+            scale = 1
+        else:
+            self.resize = None
+        (width, height) = resolution
+        self.input_scale = scale
+        self.padded_width = (width + 31) & ~31
+        self.padded_height = (height + 15) & ~15
+        self.passthrough = scale == 1 and self.size == (self.padded_width, self.padded_height)
+        (out_width, out_height) = self.size
+        luma_size = out_width * out_height
+        self.frame = np.empty(luma_size * 3 // 2, dtype=np.uint8)
+        self.planes = [
+            (0, self.padded_width, self.padded_height, self.frame[:luma_size].reshape((out_height, out_width))),
+        ]
+        chroma_size = luma_size // 4
+        padded_chroma = (self.padded_width // 2) * (self.padded_height // 2)
+        for plane in range(0, 2):
+            start = luma_size + plane * chroma_size
+            self.planes.append((
+                self.padded_width * self.padded_height + plane * padded_chroma,
+                self.padded_width // 2,
+                self.padded_height // 2,
+                self.frame[start:start + chroma_size].reshape((out_height // 2, out_width // 2)),
+            ))
+
+    def decimate(self, b):
+        if self.passthrough:
+            return b
+        buf = np.frombuffer(b, dtype=np.uint8)
+        scale = self.input_scale
+        for offset, width, height, out in self.planes:
+            (rows, cols) = out.shape
+            plane = buf[offset:offset + width * height].reshape((height, width))
+            out[:] = plane[:rows * scale:scale, :cols * scale:scale]
+        return self.frame
+
+
 class VideoConversion():
-    def __init__(self, camera) -> None:
-        self.process = Popen([
+    """
+    Converts raw YUV frames from the camera into MPEG1 for the live view, at
+    one of the QUALITY_TIERS. The ConnectionThread feeds `adapt` with its
+    post latency and backlog: falling behind steps down a tier, at most once
+    per `cooldown` seconds, and keeping up for `recover_seconds` steps back
+    up. Lower tiers drop frames before they reach ffmpeg, and a tier change
+    restarts ffmpeg at the tier bitrate and framerate. Frames are shrunk by
+    the FrameDecimation of the live request before they are piped.
+    """
+    def __init__(
+            self,
+            camera,
+            tiers=QUALITY_TIERS,
+            degrade_latency=0.5,
+            recover_latency=0.2,
+            recover_seconds=10,
+            cooldown=2,
+            decimation=None,
+            registry=None,
+            clock=time.monotonic) -> None:
+        self.camera = camera
+        self.decimation = decimation
+        if self.decimation is None:
+            self.decimation = FrameDecimation(camera.resolution, resizer='stride')
+        self.resolution = self.decimation.size
+        self.tiers = tiers
+        self.degrade_latency = degrade_latency
+        self.recover_latency = recover_latency
+        self.recover_seconds = recover_seconds
+        self.cooldown = cooldown
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tier = 0
+        self.target_tier = 0
+        self.changed_at = clock()
+        self.keeping_up_since = None
+        self.frame = 0
+        registry = registry if registry is not None else MetricsRegistry()
+        self.tier_gauge = registry.gauge('LiveTier', Operation='LiveView')
+        self.dropped = registry.counter('LiveFramesDropped', Operation='LiveView')
+        self.latency = registry.histogram('LiveLatency', Operation='LiveView')
+        self.process = self.__start()
+
+    def __start(self):
+        tier = self.tiers[self.tier]
+        framerate = float(self.camera.framerate) / self.__skip()
+        process = Popen([
             'ffmpeg',
             '-f', 'rawvideo',
             '-pix_fmt', 'yuv420p',
-            '-s', '%dx%d' % camera.resolution,
-            '-r', str(float(camera.framerate)),
+            '-s', '%dx%d' % self.resolution,
+            '-r', str(framerate),
             '-i', '-',
             '-f', 'mpeg1video',
-            '-b', '800k',
-            '-r', str(float(camera.framerate)),
+            '-b', tier['bitrate'],
+            '-r', str(framerate),
             '-'],
             stdin=PIPE, stdout=PIPE, stderr=io.open(os.devnull, 'wb'),
             shell=False, close_fds=True)
-        logger.info('Started ffmpeg conversion process')
+        logger.info(f'Started ffmpeg conversion process at {tier["bitrate"]}')
+        return process
+
+    def __skip(self):
+        return self.decimation.skip * self.tiers[self.tier]['skip']
+
+    def adapt(self, latency, backlog):
+        """
+        Records the seconds a post took from read to sent, and the fraction
+        of the read-ahead window that is full.
+        """
+        self.latency.observe(latency * 1000)
+        now = self.clock()
+        with self.lock:
+            if latency > self.degrade_latency or backlog >= 0.5:
+                self.keeping_up_since = None
+                if self.target_tier < len(self.tiers) - 1 and now - self.changed_at >= self.cooldown:
+                    self.target_tier += 1
+                    self.changed_at = now
+                    logger.info(f'Live view is behind by {latency:.2f}s, lowering quality')
+            elif latency < self.recover_latency and backlog == 0:
+                if self.keeping_up_since is None:
+                    self.keeping_up_since = now
+                elif self.target_tier > 0 and now - self.keeping_up_since >= self.recover_seconds:
+                    self.target_tier -= 1
+                    self.changed_at = now
+                    self.keeping_up_since = now
+                    logger.info('Live view is keeping up, raising quality')
+            else:
+                self.keeping_up_since = None
 
     def write(self, b):
+        # The camera writes a whole unencoded frame at a time
+        with self.lock:
+            if self.target_tier != self.tier:
+                previous = self.process
+                self.tier = self.target_tier
+                self.tier_gauge.set(self.tier)
+                self.process = self.__start()
+                # The buffer reads the previous process to the end first
+                previous.stdin.close()
+            self.frame += 1
+            if self.frame % self.__skip() != 0:
+                self.dropped.add()
+                return
+            process = self.process
         try:
-            self.process.stdin.write(b)
+            process.stdin.write(self.decimation.decimate(b))
         except:
             logger.warning('Tried to write to a broken pipe. Skipping.')
 
@@ -50,3 +211,31 @@ class VideoConversion():
         logger.info('Closing ffmpeg conversion process')
         self.process.stdin.close()
         self.process.wait()
+
+
+class ConversionBuffer(ConnectionBuffer):
+    """
+    Reads the output of a VideoConversion, moving on to the process that
+    replaced it once the previous one drained.
+    """
+    def __init__(self, conversion) -> None:
+        self.conversion = conversion
+        self.process = conversion.process
+
+    def read1(self, size):
+        while True:
+            buf = self.process.stdout.read1(size)
+            current = self.conversion.process
+            if buf or current is self.process:
+                return buf
+            self.process.stdout.close()
+            self.process.wait()
+            self.process = current
+
+    def close(self):
+        self.process.stdout.close()
+
+    def poll(self):
+        if self.process is not self.conversion.process:
+            return None
+        return self.process.poll()
@@ -1,4 +1,5 @@
 from math import floor
+import heapq
 import logging
 import threading
 import time
@@ -6,10 +7,12 @@ import queue
 
 from functools import partial
 from pinthesky.handler import Handler
+from pinthesky.metrics import MetricsRegistry
 
 logger = logging.getLogger(__name__)
 event_names = [
     'motion_start',
+    'motion_end',
     'flush_end',
     'combine_end',
     'upload_end',
@@ -25,20 +28,271 @@ event_names = [
     'record',
     'record_end',
 ]
+# Highest priority first
+PRIORITY_CLASSES = ['control', 'capture', 'health', 'telemetry']
+DEFAULT_PRIORITY = 'capture'
+EVENT_PRIORITIES = {
+    'record': 'control',
+    'record_end': 'control',
+    'recording_change': 'control',
+    'configuration': 'control',
+    'configuration_end': 'control',
+    'motion_start': 'capture',
+    'motion_end': 'capture',
+    'flush_end': 'capture',
+    'combine_end': 'capture',
+    'capture_image': 'capture',
+    'capture_image_end': 'capture',
+    'capture_video': 'capture',
+    'file_change': 'capture',
+    'health': 'health',
+    'health_end': 'health',
+    'upload_end': 'telemetry',
+}
+QUEUE_POLICIES = ['drop_newest', 'drop_oldest', 'coalesce', 'block']
+DEFAULT_POLICY = 'block'
+EVENT_POLICIES = {
+    # Only the latest of these is worth handling when several are pending
+    'health': 'coalesce',
+    'configuration': 'coalesce',
+    'upload_end': 'drop_oldest',
+    'health_end': 'drop_oldest',
+    'configuration_end': 'drop_oldest',
+    'capture_image_end': 'drop_oldest',
+}
+DEFAULT_QUEUE_SIZE = 1000
+
+
+class EventQueue(queue.Queue):
+    """
+    A queue of events ordered by the priority class of the event name, and
+    in the order they were fired within a class. Each entry keeps the
+    monotonic nanoseconds it was queued at, which `get_timed` returns with
+    the event, so timing never leaks into the event itself.
+
+    When the queue holds `maxsize` events, the policy of the event name
+    decides what happens to a new event:
+    - drop_newest: the new event is dropped
+    - drop_oldest: the oldest pending event of the same name is dropped
+    - coalesce: the newest pending event of the same name and connection
+      is replaced in place, or the new event is dropped when none is
+      pending, so every connection still gets a reply
+    - block: waits up to `block_timeout` seconds for room, then drops it
+    """
+    def __init__(
+            self,
+            priorities=EVENT_PRIORITIES,
+            maxsize=DEFAULT_QUEUE_SIZE,
+            policies=EVENT_POLICIES,
+            block_timeout=5,
+            registry=None):
+        self.priorities = priorities
+        self.policies = policies
+        self.block_timeout = block_timeout
+        self.coalesced = 0
+        self.dropped = 0
+        registry = registry if registry is not None else MetricsRegistry()
+        self.dropped_counter = registry.counter('EventDropped', Operation='EventQueue')
+        self.coalesced_counter = registry.counter('EventCoalesced', Operation='EventQueue')
+        super().__init__(maxsize=maxsize)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.pending = {}
+        self.sequence = 0
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        priority = self.priorities.get(item['name'], DEFAULT_PRIORITY)
+        entry = [PRIORITY_CLASSES.index(priority), self.sequence, item, time.monotonic_ns()]
+        self.sequence += 1
+        heapq.heappush(self.queue, entry)
+        if self.policies.get(item['name'], DEFAULT_POLICY) == 'coalesce':
+            self.pending[self.__pending_key(item)] = entry
+
+    def _get(self):
+        return self.__pop()[2]
+
+    def __pop(self):
+        entry = heapq.heappop(self.queue)
+        key = self.__pending_key(entry[2])
+        if self.pending.get(key) is entry:
+            del self.pending[key]
+        return entry
+
+    def get_timed(self):
+        """
+        Waits for the next event, returning it with the monotonic nanoseconds
+        it was queued at.
+        """
+        with self.not_empty:
+            while not self._qsize():
+                self.not_empty.wait()
+            entry = self.__pop()
+            self.not_full.notify()
+            return entry[2], entry[3]
+
+    def __pending_key(self, item):
+        connection = item.get('connection') or {}
+        return (item['name'], connection.get('id'))
+
+    def __full(self):
+        return 0 < self.maxsize <= self._qsize()
+
+    def __evict(self, name):
+        entries = [e for e in self.queue if e[2]['name'] == name]
+        if not entries:
+            return False
+        self.queue.remove(min(entries, key=lambda e: e[1]))
+        heapq.heapify(self.queue)
+        self.unfinished_tasks -= 1
+        return True
+
+    def __coalesce(self, item):
+        entry = self.pending.get(self.__pending_key(item))
+        if entry is None:
+            return False
+        # Replacing in place keeps the position and the task count
+        entry[2] = item
+        entry[3] = time.monotonic_ns()
+        self.coalesced += 1
+        self.coalesced_counter.add()
+        return True
+
+    def __drop(self):
+        self.dropped += 1
+        self.dropped_counter.add()
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Queues the event, returning False if it was dropped by its policy.
+        """
+        name = item['name']
+        policy = self.policies.get(name, DEFAULT_POLICY)
+        with self.not_full:
+            if self.__full():
+                if policy == 'coalesce' and self.__coalesce(item):
+                    return True
+                if policy == 'drop_oldest' and self.__evict(name):
+                    self.__drop()
+                elif policy == 'block' and block:
+                    timeout = self.block_timeout if timeout is None else timeout
+                    if not self.not_full.wait_for(lambda: not self.__full(), timeout):
+                        self.__drop()
+                        return False
+                else:
+                    self.__drop()
+                    return False
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+
+class HandlerExecutor(threading.Thread):
+    """
+    A dedicated thread for the events of a single handler. Events run in the
+    order they were fired, but off the event thread, so a slow handler does
+    not hold back the others.
+    """
+    def __init__(self, name):
+        super().__init__(daemon=True)
+        self.handler_name = name
+        self.work_queue = queue.Queue()
+        self.running = True
+        self.started = False
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        # Handlers may be added while the event thread starts its executors
+        with self.start_lock:
+            if not self.started:
+                self.started = True
+                super().start()
+
+    def submit(self, work):
+        self.work_queue.put(work)
+
+    def run(self):
+        while self.running:
+            work = self.work_queue.get()
+            try:
+                if work is not None:
+                    work()
+            finally:
+                self.work_queue.task_done()
+
+    def stop(self):
+        self.running = False
+        self.work_queue.put(None)
+
+
+class EventCompletion():
+    """
+    Marks a queued event as done once every handler finished with it, so
+    joining the event queue also waits on threaded handlers.
+    """
+    def __init__(self, event_queue, handlers):
+        self.event_queue = event_queue
+        self.remaining = handlers
+        self.lock = threading.Lock()
+
+    def done(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.event_queue.task_done()
+
+
+class HandlerMetrics():
+    """
+    The registry metrics of one handler for one event name, looked up once
+    when the handler is added rather than on every invocation.
+    """
+    def __init__(self, registry, handler_name, event_name):
+        dimensions = {
+            'Operation': 'EventHandle',
+            'Handler': handler_name,
+            'Event': event_name,
+        }
+        self.processed = registry.counter('EventProcessed', **dimensions)
+        self.failed = registry.counter('EventFailed', **dimensions)
+        self.backlog = registry.histogram('EventBacklog', unit='Count', **dimensions)
+        self.handler_backlog = registry.histogram('HandlerBacklog', unit='Count', **dimensions)
+        self.queue_wait = registry.histogram('QueueWait', **dimensions)
+        self.duration = registry.histogram('Duration', **dimensions)
 
 
 class EventThread(threading.Thread):
     """
     This thread wraps a queue to flush events sequentially. A Handler could be
-    added, or more general anonymous functions.
+    added, or more general anonymous functions. Events are handled by
+    priority through an EventQueue, so a live view `record` request does not
+    wait behind queued health or upload events. Handler metrics are recorded
+    into the MetricsRegistry. Handlers added with
+    `threaded=True` run on their own HandlerExecutor, and an event is only
+    marked done once every handler finished with it.
     """
-    def __init__(self):
+    def __init__(
+            self,
+            priorities=EVENT_PRIORITIES,
+            maxsize=DEFAULT_QUEUE_SIZE,
+            policies=EVENT_POLICIES,
+            registry=None):
         super().__init__(daemon=True)
-        self.event_queue = queue.Queue()
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.event_queue = EventQueue(
+            priorities=priorities,
+            maxsize=maxsize,
+            policies=policies,
+            registry=self.registry)
         self.running = True
         self.handlers = {}
+        self.executors = {}
 
-    def on(self, handler: Handler):
+    def on(self, handler: Handler, threaded=False):
         base_handler = Handler()
         for event_name in event_names:
             method_name = f'on_{event_name}'
@@ -50,75 +304,88 @@ class EventThread(threading.Thread):
             self.on_event(
                 event_name=event_name,
                 handler=partial(method),
-                handler_name=handler.__class__.__name__)
+                handler_name=handler.__class__.__name__,
+                threaded=threaded)
 
-    def on_event(self, event_name, handler, handler_name):
+    def on_event(self, event_name, handler, handler_name, threaded=False):
         if event_name not in self.handlers:
             self.handlers[event_name] = []
+        executor = None
+        if threaded:
+            if handler_name not in self.executors:
+                self.executors[handler_name] = HandlerExecutor(handler_name)
+                if self.is_alive():
+                    self.executors[handler_name].start()
+            executor = self.executors[handler_name]
         self.handlers[event_name].append({
             'handler': handler,
-            'name': handler_name
+            'name': handler_name,
+            'executor': executor,
+            'metrics': HandlerMetrics(self.registry, handler_name, event_name),
         })
 
     def fire_event(self, event_name, context={}):
         event_data = {
             'name': event_name,
-            'timestamp': floor(time.time())
+            'timestamp': floor(time.time()),
         }
         if event_name in self.handlers:
             logger.debug(f'Pushing {event_data["name"]} to event queue')
-            self.event_queue.put(dict(context, **event_data))
+            # Blocking the event thread on its own queue would never return
+            block = threading.current_thread() is not self
+            if not self.event_queue.put(dict(context, **event_data), block=block):
+                logger.debug(f'Dropped {event_name}, the event queue is full')
+
+    def __handle(self, handler, message, backlog, enqueued):
+        handler_backlog = 0
+        if handler['executor'] is not None:
+            handler_backlog = handler['executor'].work_queue.qsize()
+        metrics = handler['metrics']
+        started = time.monotonic_ns()
+        try:
+            handler['handler'](message)
+            metrics.processed.add()
+            logger.debug('Handler %s processed %s', handler['name'], message['name'])
+        except Exception as e:
+            metrics.failed.add()
+            logger.error(f'Failed to handle {message["name"]}: {e}', exc_info=e)
+        metrics.duration.observe((time.monotonic_ns() - started) / 1000000)
+        metrics.queue_wait.observe((started - enqueued) / 1000000)
+        metrics.backlog.observe(backlog)
+        metrics.handler_backlog.observe(handler_backlog)
+
+    def __handle_threaded(self, handler, message, backlog, enqueued, completion):
+        try:
+            self.__handle(handler, message, backlog, enqueued)
+        finally:
+            completion.done()
 
     def run(self):
         logger.info('Starting the event handler thread')
+        for executor in list(self.executors.values()):
+            executor.start()
         while self.running:
-            message = self.event_queue.get()
+            message, enqueued = self.event_queue.get_timed()
             unprocessed_messages = self.event_queue.qsize()
-            if message['name'] in self.handlers:
-                for handler in self.handlers[message['name']]:
-                    emf = {
-                        'CloudWatchMetrics': [
-                            {
-                                'Dimensions': [
-                                    ['ThingName', 'Operation'],
-                                    ['ThingName', 'Event']
-                                ],
-                                'Metrics': [
-                                    {
-                                        'Name': 'EventProcessed',
-                                        'Unit': 'Count',
-                                    },
-                                    {
-                                        'Name': 'EventBacklog',
-                                        'Unit': 'Count',
-                                    },
-                                    {
-                                        'Name': 'Time',
-                                        'Unit': 'Seconds',
-                                    }
-                                ]
-                            }
-                        ],
-                        'Operation': 'EventHandle',
-                        'Handler': handler["name"],
-                        'Event': message['name'],
-                        'EventProcessed': 1,
-                        'EventBacklog': unprocessed_messages,
-                    }
-                    try:
-                        handler['handler'](message)
-                        emf['Time'] = floor(time.time()) - message['timestamp']
-                        logger.info(f'Handler {handler["name"]} processed {message["name"]}',
-                                    extra={'emf': emf})
-                    except Exception as e:
-                        emf['EventProcessed'] = 0
-                        emf['Time'] = floor(time.time()) - message['timestamp']
-                        logger.error(
-                            f'Failed to handle {message["name"]}: {e}',
-                            exc_info=e,
-                            extra={'emf': emf})
-            self.event_queue.task_done()
+            handlers = self.handlers.get(message['name'], [])
+            threaded = [h for h in handlers if h['executor'] is not None]
+            # The event thread holds one share until the inline handlers ran
+            completion = EventCompletion(self.event_queue, len(threaded) + 1)
+            for handler in threaded:
+                handler['executor'].submit(partial(
+                    self.__handle_threaded,
+                    handler,
+                    message,
+                    unprocessed_messages,
+                    enqueued,
+                    completion))
+            for handler in handlers:
+                if handler['executor'] is None:
+                    self.__handle(handler, message, unprocessed_messages, enqueued)
+            completion.done()
 
     def stop(self):
         self.event_queue.join()
         self.running = False
+        for executor in list(self.executors.values()):
+            executor.stop()
@@ -23,6 +23,14 @@ class Handler():
         """
         pass
 
+    def on_motion_end(self, event):
+        """
+        Handle the event signaling when a motion episode has ended.
+        Event fields are `duration` of the episode in seconds and the
+        number of `suppressed` detections during the episode.
+        """
+        pass
+
     def on_upload_end(self, event):
         """
         Handle the event signaling when upload to S3 has finished.
@@ -79,6 +87,9 @@ class Handler():
         - `up_time`: duration in seconds of pinthesky process
         - `recording_status`: whether camera is actively recording
         - `motions_captured`: number of motions captured
+        - `motion_episodes`: number of debounced motion episodes
+        - `motion_suppressed`: detections folded into an active episode
+        - `motion_rejected`: detections never confirmed as an episode
         - `ip_addr`: ip of the default route
         - `version`: version of pinthesky running
         - `disk_free`: disk free in bytes
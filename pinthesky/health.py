@@ -118,6 +118,9 @@ class DeviceHealth(Handler, ShadowConfigHandler):
         self.recording_status = False
         self.emit_health_lock = Lock()
 
+    def add_metric(self, metric: DeviceHealthMetric):
+        self.metrics = [*self.metrics, metric]
+
     def update_document(self) -> ConfigUpdate:
         return ConfigUpdate('health', {
             'interval': self.flush_delta.seconds
@@ -0,0 +1,153 @@
+import threading
+
+from array import array
+
+# Upper bounds of the default histogram buckets, the last catches the rest
+DEFAULT_BUCKETS = [
+    0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500,
+    1000, 2000, 5000, 10000, 30000, 60000, 300000,
+    float('inf'),
+]
+
+
+class Counter():
+    """
+    A count that resets every time the registry is collected.
+    """
+    def __init__(self, name, unit='Count'):
+        self.name = name
+        self.unit = unit
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def add(self, value=1):
+        with self.lock:
+            self.value += value
+
+    def collect(self):
+        with self.lock:
+            value, self.value = self.value, 0
+        return [(self.name, self.unit, value)]
+
+
+class Gauge():
+    """
+    The last value set, reported on every collection.
+    """
+    def __init__(self, name, unit='Count'):
+        self.name = name
+        self.unit = unit
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def collect(self):
+        return [(self.name, self.unit, self.value)]
+
+
+class Histogram():
+    """
+    Counts observations in fixed buckets, so recording never allocates and
+    memory stays flat regardless of volume. Percentiles are reported as the
+    upper bound of the bucket they fall in, capped by the largest value seen.
+    Collection reports the mean, p50, p99 and maximum, then resets, and
+    reports nothing for an interval without observations.
+    """
+    def __init__(self, name, unit='Milliseconds', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.unit = unit
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = array('L', [0] * len(buckets))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        index = 0
+        while value > self.buckets[index]:
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def percentile(self, q):
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.buckets[index], self.max)
+        return self.max
+
+    def collect(self):
+        with self.lock:
+            if self.count == 0:
+                return []
+            values = [
+                (self.name, self.unit, self.total / self.count),
+                (f'{self.name}P50', self.unit, self.percentile(0.5)),
+                (f'{self.name}P99', self.unit, self.percentile(0.99)),
+                (f'{self.name}Max', self.unit, self.max),
+            ]
+            for index in range(0, len(self.counts)):
+                self.counts[index] = 0
+            self.count = 0
+            self.total = 0
+            self.max = 0
+        return values
+
+
+class MetricsRegistry():
+    """
+    The metrics that modules record into between flushes. Each metric is
+    identified by its name and dimensions, and metrics sharing dimensions
+    are collected together into a single group.
+
+    registry.counter('UploadProcessed', Operation='Upload').add()
+    registry.histogram('Duration', Operation='Upload').observe(250)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def __metric(self, factory, name, dimensions, **kwargs):
+        key = (name, tuple(sorted(dimensions.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = factory(name, **kwargs)
+                    self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, unit='Count', **dimensions) -> Counter:
+        return self.__metric(Counter, name, dimensions, unit=unit)
+
+    def gauge(self, name, unit='Count', **dimensions) -> Gauge:
+        return self.__metric(Gauge, name, dimensions, unit=unit)
+
+    def histogram(self, name, unit='Milliseconds', buckets=DEFAULT_BUCKETS, **dimensions) -> Histogram:
+        return self.__metric(Histogram, name, dimensions, unit=unit, buckets=buckets)
+
+    def collect(self):
+        """
+        Drains the registry into one group per set of dimensions, with the
+        metric definitions and the values collected for the interval.
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        groups = {}
+        for (_, dimensions), metric in metrics:
+            for name, unit, value in metric.collect():
+                group = groups.get(dimensions)
+                if group is None:
+                    group = {'dimensions': dict(dimensions), 'metrics': [], 'values': {}}
+                    groups[dimensions] = group
+                group['metrics'].append({'Name': name, 'Unit': unit})
+                group['values'][name] = value
+        return list(groups.values())
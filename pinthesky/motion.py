@@ -0,0 +1,245 @@
+import numpy as np
+import time
+
+from collections import deque
+from pinthesky.health import DeviceHealthMetric
+
+
+# Mirrors picamera.array.motion_dtype so analysis can run without picamera
+motion_dtype = np.dtype([
+    ('x', 'i1'),
+    ('y', 'i1'),
+    ('sad', 'u2'),
+])
+MACROBLOCK_SIZE = 16
+
+
+def zone_weights(shape, zones, block_size=MACROBLOCK_SIZE):
+    """
+    Converts a list of pixel based zones into a weight per macroblock. A
+    zone is a document of `x`, `y`, `width`, `height` and `weight`, where
+    omitted bounds extend to the edge of the frame. Blocks outside of every
+    zone have a weight of zero, and later zones overwrite earlier ones,
+    allowing an excluded region (`weight` of 0) within a larger zone.
+    """
+    if not zones:
+        return None
+    (rows, cols) = shape
+    weights = np.zeros(shape, dtype=np.float32)
+    for zone in zones:
+        x = int(zone.get('x', 0))
+        y = int(zone.get('y', 0))
+        x_end, y_end = cols, rows
+        if zone.get('width') is not None:
+            x_end = -(-(x + int(zone['width'])) // block_size)
+        if zone.get('height') is not None:
+            y_end = -(-(y + int(zone['height'])) // block_size)
+        weight = float(zone.get('weight', 1))
+        weights[y // block_size:y_end, x // block_size:x_end] = weight
+    return weights
+
+
+class VectorAnalysis():
+    """
+    Integer-only analysis of H.264 motion vectors. Rather than computing
+    the vector magnitude in floating point, the squared magnitudes are
+    compared against a squared threshold in int32. Scratch buffers are
+    allocated on the first frame and reused on every frame afterwards.
+    Optional zones are precomputed into a weight per macroblock, so the
+    count is a single masked reduction over the frame.
+
+    analysis = VectorAnalysis(sensitivity=10)
+    if analysis.detect(frame):
+        ...
+    """
+    def __init__(self, sensitivity=10, magnitude=60, zones=None):
+        self.sensitivity = sensitivity
+        self.magnitude = magnitude
+        self.zones = zones
+        # The legacy float calculation truncates the magnitude before the
+        # comparison, so the first vector over the threshold is magnitude + 1
+        self.threshold = (magnitude + 1) ** 2 - 1
+        self.shape = None
+
+    def __allocate(self, shape):
+        self.__x = np.empty(shape, dtype=np.int32)
+        self.__y = np.empty(shape, dtype=np.int32)
+        self.__over = np.empty(shape, dtype=np.bool_)
+        self.__weights = zone_weights(shape, self.zones)
+        self.shape = shape
+
+    def count(self, a):
+        """
+        Counts the macroblocks with a vector over the magnitude threshold,
+        scaled by the weight of the zone containing the macroblock.
+        """
+        if a.shape != self.shape:
+            self.__allocate(a.shape)
+        np.copyto(self.__x, a['x'])
+        np.multiply(self.__x, self.__x, out=self.__x)
+        np.copyto(self.__y, a['y'])
+        np.multiply(self.__y, self.__y, out=self.__y)
+        np.add(self.__x, self.__y, out=self.__x)
+        np.greater(self.__x, self.threshold, out=self.__over)
+        if self.__weights is None:
+            return np.count_nonzero(self.__over)
+        return np.sum(self.__weights, where=self.__over)
+
+    def detect(self, a):
+        return self.count(a) > self.sensitivity
+
+
+class BackgroundAnalysis():
+    """
+    Running average background model over a downscaled luma plane. The
+    background is kept in fixed point int32 (8 fractional bits) and moves
+    towards every frame by 1 / 2 ** learning_shift. Pixels differing from
+    the background by more than the threshold are counted against the
+    sensitivity. All arithmetic happens in place on buffers allocated on
+    the first frame.
+
+    When more than `max_change` of the frame differs at once, the change is
+    treated as global (IR switching, exposure, camera shake) and the model
+    is reseeded from the frame instead of reporting motion.
+
+    analysis = BackgroundAnalysis(sensitivity=10)
+    if analysis.detect(luma):
+        ...
+    """
+    def __init__(
+            self,
+            sensitivity=10,
+            threshold=25,
+            learning_shift=4,
+            max_change=0.8,
+            zones=None,
+            block_size=MACROBLOCK_SIZE):
+        self.sensitivity = sensitivity
+        self.threshold = threshold << 8
+        self.learning_shift = learning_shift
+        self.max_change = max_change
+        self.zones = zones
+        self.block_size = block_size
+        self.shape = None
+
+    def __allocate(self, luma):
+        shape = luma.shape
+        self.__background = np.empty(shape, dtype=np.int32)
+        self.__frame = np.empty(shape, dtype=np.int32)
+        self.__diff = np.empty(shape, dtype=np.int32)
+        self.__over = np.empty(shape, dtype=np.bool_)
+        self.__weights = zone_weights(shape, self.zones, self.block_size)
+        self.__max_changed = int(luma.size * self.max_change)
+        self.shape = shape
+        self.__reseed(luma)
+
+    def __reseed(self, luma):
+        np.copyto(self.__background, luma)
+        np.left_shift(self.__background, 8, out=self.__background)
+
+    def count(self, luma):
+        """
+        Counts the pixels that differ from the background model, scaled by
+        the weight of the zone containing the pixel.
+        """
+        if luma.shape != self.shape:
+            self.__allocate(luma)
+            return 0
+        np.copyto(self.__frame, luma)
+        np.left_shift(self.__frame, 8, out=self.__frame)
+        np.subtract(self.__frame, self.__background, out=self.__diff)
+        np.abs(self.__diff, out=self.__frame)
+        np.greater(self.__frame, self.threshold, out=self.__over)
+        changed = np.count_nonzero(self.__over)
+        if changed > self.__max_changed:
+            self.__reseed(luma)
+            return 0
+        np.right_shift(self.__diff, self.learning_shift, out=self.__diff)
+        np.add(self.__background, self.__diff, out=self.__background)
+        if self.__weights is None:
+            return changed
+        return np.sum(self.__weights, where=self.__over)
+
+    def detect(self, luma):
+        return self.count(luma) > self.sensitivity
+
+
+class MotionState(DeviceHealthMetric):
+    """
+    Debounces per frame detections into motion episodes. An episode starts
+    once `confirm_frames` of the last `window_frames` frames detect motion,
+    and ends after `cooldown` seconds without a detection. Exactly one
+    `motion_start` and one `motion_end` event are fired per episode, and
+    every other detection is counted as suppressed. The state reports its
+    counters as a health metric.
+    """
+    def __init__(
+            self,
+            events,
+            confirm_frames=3,
+            window_frames=5,
+            cooldown=2,
+            clock=time.monotonic):
+        self.events = events
+        self.clock = clock
+        self.active = False
+        self.episodes = 0
+        self.suppressed = 0
+        self.rejected = 0
+        self.configure(confirm_frames, window_frames, cooldown)
+
+    def configure(self, confirm_frames, window_frames, cooldown):
+        """
+        Resets the detection window, ending any active episode.
+        """
+        self.end()
+        self.confirm_frames = max(1, confirm_frames)
+        self.window_frames = max(self.confirm_frames, window_frames)
+        self.cooldown = cooldown
+        self.window = deque(maxlen=self.window_frames)
+        self.detections = 0
+        self.last_detection = None
+
+    def update(self, detected):
+        """
+        Records the detection result of a single frame.
+        """
+        detected = bool(detected)
+        now = self.clock()
+        if len(self.window) == self.window.maxlen:
+            self.detections -= self.window[0]
+        self.window.append(detected)
+        self.detections += detected
+        if detected:
+            self.last_detection = now
+        if not self.active:
+            if self.detections >= self.confirm_frames:
+                self.active = True
+                self.episodes += 1
+                self.episode_start = now
+                self.episode_suppressed = 0
+                self.events.fire_event('motion_start')
+            elif detected:
+                self.rejected += 1
+        elif detected:
+            self.suppressed += 1
+            self.episode_suppressed += 1
+        elif now - self.last_detection >= self.cooldown:
+            self.end()
+
+    def end(self):
+        if self.active:
+            self.active = False
+            self.window.clear()
+            self.detections = 0
+            self.events.fire_event('motion_end', {
+                'duration': self.last_detection - self.episode_start,
+                'suppressed': self.episode_suppressed,
+            })
+
+    def report(self):
+        return {
+            'motion_episodes': self.episodes,
+            'motion_suppressed': self.suppressed,
+            'motion_rejected': self.rejected,
+        }
@@ -1,21 +1,70 @@
-import picamera.array
 import numpy as np
+import picamera.array
+
+from pinthesky.motion import BackgroundAnalysis, MotionState, VectorAnalysis
+from pinthesky.motion import MACROBLOCK_SIZE
 
 
 class MotionDetector(picamera.array.PiMotionAnalysis):
     """
     Adapted motion detection class from the PiCamera documentation.
-    Performs vactor calculation on a sensitivity threshold.
+    Performs vactor calculation on a sensitivity threshold. Detections are
+    debounced through a MotionState before any event is fired.
     """
-    def __init__(self, camera, events, sensitivity=10, size=None):
+    def __init__(
+            self, camera, events, sensitivity=10, size=None,
+            zones=None, state=None):
         super(MotionDetector, self).__init__(camera, size)
         self.events = events
         self.sensitivity = sensitivity
+        self.analysis = VectorAnalysis(sensitivity=sensitivity, zones=zones)
+        self.state = state
+        if self.state is None:
+            self.state = MotionState(events)
+
+    def analyse(self, a):
+        self.state.update(self.analysis.detect(a))
+
+
+class BackgroundMotionDetector(picamera.array.PiAnalysisOutput):
+    """
+    Motion detection on a running average background model. The detector
+    is recorded as unencoded YUV from a splitter port, resized by the GPU
+    to one pixel per macroblock, and only the luma plane is analysed as a
+    view over the frame buffer.
+    """
+    def __init__(
+            self, camera, events, sensitivity=10, size=None,
+            zones=None, state=None):
+        if size is None:
+            (width, height) = camera.resolution
+            size = (
+                -(-width // MACROBLOCK_SIZE),
+                -(-height // MACROBLOCK_SIZE))
+        super(BackgroundMotionDetector, self).__init__(camera, size)
+        self.events = events
+        self.sensitivity = sensitivity
+        self.analysis = BackgroundAnalysis(
+            sensitivity=sensitivity,
+            zones=zones,
+            block_size=camera.resolution[0] // size[0])
+        self.state = state
+        if self.state is None:
+            self.state = MotionState(events)
+        # Unencoded frames are padded to multiples of 32x16
+        (width, height) = size
+        self.padded_width = (width + 31) & ~31
+        self.padded_height = (height + 15) & ~15
+
+    def write(self, b):
+        result = super(BackgroundMotionDetector, self).write(b)
+        (width, height) = self.size
+        luma_size = self.padded_width * self.padded_height
+        if len(b) >= luma_size:
+            luma = np.frombuffer(b, dtype=np.uint8, count=luma_size)
+            luma = luma.reshape((self.padded_height, self.padded_width))
+            self.analyse(luma[:height, :width])
+        return result
 
     def analyse(self, a):
-        a = np.sqrt(
-            np.square(a['x'].astype(np.float)) +
-            np.square(a['y'].astype(np.float))
-            ).clip(0, 255).astype(np.uint8)
-        if (a > 60).sum() > self.sensitivity:
-            self.events.fire_event('motion_start')
+        self.state.update(self.analysis.detect(a))
@@ -0,0 +1,341 @@
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 64 * 1024
+START_CODE = b'\x00\x00\x01'
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+HIGH_PROFILES = [100, 110, 122, 144]
+
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+
+
+def iter_nal_units(f, chunk_size=CHUNK_SIZE):
+    """
+    Yields the NAL units of an Annex-B H.264 stream without start codes.
+    The stream is read in chunks, so at most a single NAL unit and a chunk
+    are held in memory.
+    """
+    buffer = bytearray()
+    start = -1
+    scanned = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if chunk:
+            buffer += chunk
+        while True:
+            index = buffer.find(START_CODE, scanned)
+            if index < 0:
+                break
+            if start >= 0:
+                yield _trim_nal(buffer, start, index)
+            start = scanned = index + len(START_CODE)
+        if not chunk:
+            break
+        # Keep a partial start code for the next chunk
+        scanned = max(scanned, len(buffer) - len(START_CODE) + 1)
+        consumed = start if start >= 0 else scanned
+        del buffer[:consumed]
+        scanned -= consumed
+        start = 0 if start >= 0 else -1
+    if start >= 0 and start < len(buffer):
+        yield _trim_nal(buffer, start, len(buffer))
+
+
+def _trim_nal(buffer, start, end):
+    # Trailing zeros belong to the next four byte start code
+    while end > start and buffer[end - 1] == 0:
+        end -= 1
+    return bytes(buffer[start:end])
+
+
+class BitReader():
+    """
+    Reads the exp-golomb coded fields of a raw byte sequence payload.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def bit(self):
+        byte = self.data[self.position >> 3]
+        value = (byte >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(0, count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.bit() == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def unescape_rbsp(nal):
+    """
+    Removes the emulation prevention bytes from a NAL unit payload.
+    """
+    return nal.replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def parse_sps(nal):
+    """
+    Parses the fields of a sequence parameter set needed for the MP4
+    sample description, most importantly the cropped picture size.
+    """
+    reader = BitReader(unescape_rbsp(nal[1:]))
+    sps = {
+        'profile_idc': reader.bits(8),
+        'constraint_flags': reader.bits(8),
+        'level_idc': reader.bits(8),
+        'chroma_format_idc': 1,
+        'bit_depth_luma': 8,
+        'bit_depth_chroma': 8,
+    }
+    reader.ue()
+    if sps['profile_idc'] in HIGH_PROFILES:
+        _parse_high_profile(reader, sps)
+    reader.ue()
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()
+    elif pic_order_cnt_type == 1:
+        reader.bit()
+        reader.se()
+        reader.se()
+        for _ in range(0, reader.ue()):
+            reader.se()
+    reader.ue()
+    reader.bit()
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bit()
+    if not frame_mbs_only:
+        reader.bit()
+    reader.bit()
+    crop = [0, 0, 0, 0]
+    if reader.bit():
+        crop = [reader.ue() for _ in range(0, 4)]
+    crop_x = 1 if sps['chroma_format_idc'] in [0, 3] else 2
+    crop_y = (1 if sps['chroma_format_idc'] in [0, 2, 3] else 2) * (2 - frame_mbs_only)
+    sps['width'] = width_in_mbs * 16 - crop_x * (crop[0] + crop[1])
+    sps['height'] = (2 - frame_mbs_only) * height_in_map_units * 16 - crop_y * (crop[2] + crop[3])
+    return sps
+
+
+def _parse_high_profile(reader, sps):
+    # High profiles carry the chroma format, bit depths and scaling lists
+    sps['chroma_format_idc'] = reader.ue()
+    if sps['chroma_format_idc'] == 3:
+        reader.bit()
+    sps['bit_depth_luma'] = reader.ue() + 8
+    sps['bit_depth_chroma'] = reader.ue() + 8
+    reader.bit()
+    if reader.bit():
+        for i in range(0, 8 if sps['chroma_format_idc'] != 3 else 12):
+            if reader.bit():
+                _skip_scaling_list(reader, 16 if i < 6 else 64)
+
+
+def _skip_scaling_list(reader, size):
+    last, following = 8, 8
+    for _ in range(0, size):
+        if following != 0:
+            following = (last + reader.se() + 256) % 256
+        last = last if following == 0 else following
+
+
+def box(kind, *payloads):
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def full_box(kind, version, flags, *payloads):
+    return box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+class FragmentedMP4Writer():
+    """
+    Muxes H.264 NAL units into a fragmented MP4 as they arrive. The init
+    segment is written once the parameter sets are known, and a fragment is
+    flushed at every sync sample or after `fragment_samples` samples, so only
+    a single fragment is ever held in memory. Samples are timed from the
+    constant framerate of the camera.
+
+    with open('motion.mp4', 'wb') as output:
+        writer = FragmentedMP4Writer(output, framerate=20)
+        for nal in iter_nal_units(f):
+            writer.write(nal)
+        writer.close()
+    """
+    def __init__(self, output, framerate=30, fragment_samples=None):
+        self.output = output
+        self.timescale = int(round(framerate * 1000))
+        self.sample_duration = 1000
+        self.fragment_samples = fragment_samples or max(1, int(round(framerate)))
+        self.sps = None
+        self.pps = None
+        self.initialized = False
+        self.access_unit = []
+        self.access_unit_sync = False
+        self.access_unit_vcl = False
+        self.samples = []
+        self.sequence = 0
+        self.decode_time = 0
+        self.sample_count = 0
+
+    def write(self, nal):
+        if not nal:
+            return
+        nal_type = nal[0] & 0x1f
+        if nal_type in [NAL_SLICE, NAL_IDR]:
+            # A new picture starts on the first macroblock of a slice
+            if self.access_unit_vcl and nal[1] & 0x80:
+                self.__end_access_unit()
+            self.access_unit_vcl = True
+            self.access_unit_sync |= nal_type == NAL_IDR
+        elif nal_type in [NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD] or 14 <= nal_type <= 18:
+            if self.access_unit_vcl:
+                self.__end_access_unit()
+        if nal_type == NAL_SPS:
+            self.sps = self.sps or nal
+        elif nal_type == NAL_PPS:
+            self.pps = self.pps or nal
+        elif nal_type != NAL_AUD:
+            # Parameter sets live in the sample description
+            self.access_unit.append(nal)
+
+    def __end_access_unit(self):
+        nals = self.access_unit
+        sync = self.access_unit_sync
+        self.access_unit = []
+        self.access_unit_sync = False
+        self.access_unit_vcl = False
+        if not self.initialized:
+            if not sync or self.sps is None or self.pps is None:
+                logger.debug('Dropping a sample before the first sync sample')
+                return
+            self.output.write(self.init_segment())
+            self.initialized = True
+        if sync or len(self.samples) >= self.fragment_samples:
+            self.__flush_fragment()
+        sample = b''.join([struct.pack('>I', len(nal)) + nal for nal in nals])
+        self.samples.append((sample, sync))
+
+    def __flush_fragment(self):
+        if not self.samples:
+            return
+        self.sequence += 1
+        trun_entries = b''.join([
+            struct.pack(
+                '>III',
+                self.sample_duration,
+                len(sample),
+                SYNC_SAMPLE_FLAGS if sync else NON_SYNC_SAMPLE_FLAGS)
+            for sample, sync in self.samples
+        ])
+
+        def moof(data_offset):
+            return box(
+                b'moof',
+                full_box(b'mfhd', 0, 0, struct.pack('>I', self.sequence)),
+                box(
+                    b'traf',
+                    full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),
+                    full_box(b'tfdt', 1, 0, struct.pack('>Q', self.decode_time)),
+                    full_box(
+                        b'trun', 0, 0x000701,
+                        struct.pack('>Ii', len(self.samples), data_offset),
+                        trun_entries)))
+
+        header = moof(0)
+        header = moof(len(header) + 8)
+        mdat_size = 8 + sum([len(sample) for sample, _ in self.samples])
+        self.output.write(header)
+        self.output.write(struct.pack('>I4s', mdat_size, b'mdat'))
+        for sample, _ in self.samples:
+            self.output.write(sample)
+        self.decode_time += self.sample_duration * len(self.samples)
+        self.sample_count += len(self.samples)
+        self.samples = []
+
+    def init_segment(self):
+        sps = parse_sps(self.sps)
+        width, height = sps['width'], sps['height']
+        avcc = [
+            struct.pack(
+                '>BBBBBB',
+                1, sps['profile_idc'], sps['constraint_flags'], sps['level_idc'],
+                0xff, 0xe1),
+            struct.pack('>H', len(self.sps)), self.sps,
+            struct.pack('>BH', 1, len(self.pps)), self.pps,
+        ]
+        if sps['profile_idc'] in HIGH_PROFILES:
+            avcc.append(struct.pack(
+                '>BBBB',
+                0xfc | sps['chroma_format_idc'],
+                0xf8 | (sps['bit_depth_luma'] - 8),
+                0xf8 | (sps['bit_depth_chroma'] - 8),
+                0))
+        avc1 = box(
+            b'avc1',
+            bytes(6), struct.pack('>H', 1), bytes(16),
+            struct.pack('>HHIIIH', width, height, 0x480000, 0x480000, 0, 1),
+            bytes(32), struct.pack('>Hh', 0x18, -1),
+            box(b'avcC', *avcc))
+        stbl = box(
+            b'stbl',
+            full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+            full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+            full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+            full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+            full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+        minf = box(
+            b'minf',
+            full_box(b'vmhd', 0, 1, bytes(8)),
+            box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+            stbl)
+        mdia = box(
+            b'mdia',
+            full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, self.timescale, 0, 0x55c4, 0)),
+            full_box(b'hdlr', 0, 0, bytes(4), b'vide', bytes(12), b'VideoHandler\x00'),
+            minf)
+        trak = box(
+            b'trak',
+            full_box(
+                b'tkhd', 0, 0x3,
+                struct.pack('>IIIII', 0, 0, 1, 0, 0), bytes(8),
+                struct.pack('>hhHH', 0, 0, 0, 0), MATRIX,
+                struct.pack('>II', width << 16, height << 16)),
+            mdia)
+        mvhd = full_box(
+            b'mvhd', 0, 0,
+            struct.pack('>IIIIIH', 0, 0, self.timescale, 0, 0x10000, 0x100),
+            bytes(10), MATRIX, bytes(24), struct.pack('>I', 2))
+        mvex = box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0)))
+        ftyp = box(b'ftyp', b'iso5', struct.pack('>I', 512), b'iso5', b'iso6', b'avc1', b'mp41')
+        return ftyp + box(b'moov', mvhd, trak, mvex)
+
+    def close(self):
+        if self.access_unit_vcl:
+            self.__end_access_unit()
+        self.__flush_fragment()
@@ -1,6 +1,7 @@
 from pinthesky.config import ConfigUpdate, ShadowConfigHandler
 from pinthesky.handler import Handler
 from requests import get, exceptions
+import boto3
 import datetime
 import logging
 import threading
@@ -20,6 +21,8 @@ fields = [
 class Session(Handler, ShadowConfigHandler):
     """
     An auth session wrapper that caches AWS credential material until expiry.
+    Service clients are cached against the credentials that created them, so
+    callers reuse pooled connections until the credentials rotate.
     """
     def __init__(
             self, cert_path, key_path, cacert_path,
@@ -31,6 +34,10 @@ class Session(Handler, ShadowConfigHandler):
         self.role_alias = role_alias
         self.credentials = None
         self.refresh_lock = threading.Lock()
+        self.client_lock = threading.Lock()
+        self.clients = {}
+        self.client_identity = None
+        self.boto_session = None
         self.__set_endpoint(credentials_endpoint)
 
     def __set_endpoint(self, endpoint):
@@ -66,6 +73,36 @@ class Session(Handler, ShadowConfigHandler):
                             self.__set_endpoint(val)
                         else:
                             setattr(self, field, con[field])
+            self.invalidate_clients()
+
+    def invalidate_clients(self):
+        with self.client_lock:
+            self.clients = {}
+            self.client_identity = None
+            self.boto_session = None
+
+    def client(self, service_name, region_name=None, endpoint_url=None):
+        credentials = self.login()
+        if credentials is None:
+            return None
+        identity = (credentials['accessKeyId'], credentials['sessionToken'])
+        key = (service_name, region_name, endpoint_url)
+        # Sessions are not thread safe, but the clients they create are
+        with self.client_lock:
+            if self.client_identity != identity:
+                logger.debug('Credentials rotated, creating new clients')
+                self.clients = {}
+                self.client_identity = identity
+                self.boto_session = boto3.Session(
+                    aws_access_key_id=credentials['accessKeyId'],
+                    aws_secret_access_key=credentials['secretAccessKey'],
+                    aws_session_token=credentials['sessionToken'])
+            if key not in self.clients:
+                self.clients[key] = self.boto_session.client(
+                    service_name,
+                    region_name=region_name,
+                    endpoint_url=endpoint_url)
+            return self.clients[key]
 
     def login(self, force=False):
         ct = datetime.datetime.utcnow()
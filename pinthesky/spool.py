@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from pinthesky.health import DeviceHealthMetric
+
+logger = logging.getLogger(__name__)
+MANIFEST_SUFFIX = '.json'
+
+
+class UploadSpool(DeviceHealthMetric):
+    """
+    A durable directory of pending uploads. Each entry moves its files into
+    the spool next to a JSON manifest of the upload, so pending uploads
+    survive a restart and are picked up again by `load`. The spool is kept
+    under `max_bytes` by evicting the oldest entries first.
+
+    spool_dir/<id>.json
+    spool_dir/<id>/<file>
+    """
+    def __init__(self, spool_dir, max_bytes=None, clock=time.time):
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.entries = []
+        self.in_flight = None
+        self.evicted = 0
+        self.retries = 0
+
+    def __manifest(self, entry_id):
+        return os.path.join(self.spool_dir, f'{entry_id}{MANIFEST_SUFFIX}')
+
+    def __write(self, entry):
+        manifest = self.__manifest(entry['id'])
+        with open(f'{manifest}.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(f'{manifest}.tmp', manifest)
+
+    def __delete(self, entry):
+        for file_name in entry['files']:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        entry_dir = os.path.join(self.spool_dir, entry['id'])
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        manifest = self.__manifest(entry['id'])
+        if os.path.exists(manifest):
+            os.remove(manifest)
+
+    def __evict(self, size):
+        if self.max_bytes is None:
+            return
+        total = sum([entry['size'] for entry in self.entries])
+        for entry in list(self.entries):
+            if total + size <= self.max_bytes:
+                break
+            if self.in_flight is not None and entry['id'] == self.in_flight['id']:
+                continue
+            logger.warning(f'Evicting {entry["name"]} from the upload spool')
+            self.entries.remove(entry)
+            self.__delete(entry)
+            self.evicted += 1
+            total -= entry['size']
+
+    def load(self):
+        """
+        Rescans the spool directory for entries left by a previous run.
+        Entry directories without a manifest were interrupted mid-write
+        and are removed.
+        """
+        # Spooling moves files in before the manifest exists, so hold off
+        # puts while deciding what is orphaned
+        with self.condition:
+            if not os.path.exists(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            entries = []
+            for file_name in os.listdir(self.spool_dir):
+                path = os.path.join(self.spool_dir, file_name)
+                if file_name.endswith(f'{MANIFEST_SUFFIX}.tmp'):
+                    os.remove(path)
+                elif file_name.endswith(MANIFEST_SUFFIX):
+                    try:
+                        with open(path, 'r') as f:
+                            entry = json.load(f)
+                    except (OSError, ValueError) as e:
+                        logger.warning(f'Removing unreadable manifest {path}: {e}')
+                        os.remove(path)
+                        continue
+                    if all([os.path.exists(f) for f in entry['files']]):
+                        entries.append(entry)
+                    else:
+                        logger.warning(f'Removing {entry["name"]} with missing files')
+                        self.__delete(entry)
+            known = set([entry['id'] for entry in entries])
+            for file_name in os.listdir(self.spool_dir):
+                path = os.path.join(self.spool_dir, file_name)
+                if os.path.isdir(path) and file_name not in known:
+                    shutil.rmtree(path)
+            self.entries = sorted(entries, key=lambda e: e['created'])
+            self.condition.notify_all()
+        logger.info(f'Loaded {len(entries)} pending uploads from {self.spool_dir}')
+
+    def put(self, name, files, job):
+        """
+        Moves the files into the spool as a single entry uploaded as `name`.
+        """
+        with self.condition:
+            now = self.clock()
+            entry_id = f'{int(now * 1000)}-{uuid.uuid4().hex[:8]}'
+            entry_dir = os.path.join(self.spool_dir, entry_id)
+            os.makedirs(entry_dir)
+            spooled = []
+            for file_name in files:
+                spooled_name = os.path.join(entry_dir, os.path.basename(file_name))
+                shutil.move(file_name, spooled_name)
+                spooled.append(spooled_name)
+            entry = {
+                'id': entry_id,
+                'name': name,
+                'files': spooled,
+                'size': sum([os.stat(f).st_size for f in spooled]),
+                'job': job,
+                'attempts': 0,
+                'created': now,
+                'next_attempt': now,
+            }
+            self.__evict(entry['size'])
+            self.__write(entry)
+            self.entries.append(entry)
+            self.condition.notify_all()
+            return entry
+
+    def next(self, timeout=None):
+        """
+        Waits for the oldest entry that is due for an attempt, and marks it
+        as in flight so it is not evicted. Returns None on timeout.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.condition:
+            while True:
+                now = self.clock()
+                due = [e for e in self.entries if e['next_attempt'] <= now]
+                if due:
+                    self.in_flight = due[0]
+                    return self.in_flight
+                waits = [e['next_attempt'] - now for e in self.entries]
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    waits.append(deadline - now)
+                self.condition.wait(min(waits) if waits else None)
+
+    def retry(self, entry, delay):
+        with self.condition:
+            entry['attempts'] += 1
+            entry['next_attempt'] = self.clock() + delay
+            self.in_flight = None
+            self.retries += 1
+            if entry in self.entries:
+                self.__write(entry)
+            self.condition.notify_all()
+
+    def checkpoint(self, entry):
+        """
+        Persists progress recorded on an entry in flight, such as the parts
+        of a multipart upload, so a restart resumes rather than restarts.
+        """
+        with self.condition:
+            if entry in self.entries:
+                self.__write(entry)
+
+    def remove(self, entry):
+        with self.condition:
+            self.in_flight = None
+            if entry in self.entries:
+                self.entries.remove(entry)
+            self.__delete(entry)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def report(self):
+        with self.condition:
+            return {
+                'upload_pending': len(self.entries),
+                'upload_spool_bytes': sum([e['size'] for e in self.entries]),
+                'upload_evicted': self.evicted,
+                'upload_retries': self.retries,
+            }
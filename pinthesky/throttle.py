@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+
+from pinthesky.health import DeviceHealthMetric
+
+logger = logging.getLogger(__name__)
+# Highest priority first
+PRIORITIES = ['live', 'control', 'logs', 'uploads']
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 64 * 1024 * 1024
+
+
+class BandwidthThrottle(DeviceHealthMetric):
+    """
+    A token bucket shared by everything that sends data off the device.
+    Tokens are bytes refilled at `rate` bytes per second, up to a burst of
+    one second. Waiters are served strictly by priority, so a clip upload
+    only takes tokens when no live stream, control reply or log shipment is
+    waiting. Without a rate, nothing is throttled but throughput is still
+    measured.
+
+    throttle.acquire(len(data), 'live')
+    """
+    def __init__(self, rate=None, part_seconds=10, clock=time.monotonic):
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.waiting = [0 for _ in PRIORITIES]
+        self.sent = dict([(priority, 0) for priority in PRIORITIES])
+        self.part_seconds = part_seconds
+        self.throughput = None
+        self.configure(rate)
+
+    def configure(self, rate):
+        with self.condition:
+            self.rate = rate
+            self.tokens = rate or 0
+            self.updated = self.clock()
+            self.condition.notify_all()
+
+    def __refill(self):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, size, priority='uploads'):
+        # Transfer callbacks report negative progress when a part is retried
+        if size <= 0:
+            return
+        level = PRIORITIES.index(priority)
+        with self.condition:
+            self.waiting[level] += 1
+            try:
+                while self.rate:
+                    self.__refill()
+                    # Sends larger than the burst go into debt rather than wait forever
+                    needed = min(size, self.rate)
+                    if not any(self.waiting[:level]) and self.tokens >= needed:
+                        self.tokens -= size
+                        break
+                    wait = max(needed - self.tokens, 1) / self.rate
+                    self.condition.wait(min(wait, 1))
+                self.sent[priority] += size
+            finally:
+                self.waiting[level] -= 1
+                self.condition.notify_all()
+
+    def measure(self, size, seconds):
+        """
+        Records the achieved throughput of a transfer as a moving average.
+        """
+        if seconds <= 0:
+            return
+        with self.condition:
+            achieved = size / seconds
+            if self.throughput is None:
+                self.throughput = achieved
+            else:
+                self.throughput = self.throughput * 0.7 + achieved * 0.3
+
+    def part_size(self, default=MIN_PART_SIZE):
+        """
+        Sizes multipart parts to take about `part_seconds` each at the
+        achieved throughput, so a failed part costs a bounded retry on a
+        slow link and fewer requests on a fast one.
+        """
+        with self.condition:
+            throughput = self.throughput
+            if self.rate:
+                throughput = min(throughput or self.rate, self.rate)
+        if throughput is None:
+            return default
+        size = int(throughput * self.part_seconds)
+        size = max(MIN_PART_SIZE, min(MAX_PART_SIZE, size))
+        return size - size % (1024 * 1024)
+
+    def report(self):
+        with self.condition:
+            return {
+                'bandwidth_limit': self.rate,
+                'bandwidth_throughput': self.throughput,
+                **dict([(f'bandwidth_{p}_bytes', self.sent[p]) for p in PRIORITIES]),
+            }
@@ -1,20 +1,76 @@
-import boto3
+import io
 import os
 import logging
+import threading
 import time
 
-from math import floor
+from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from boto3.s3.transfer import TransferConfig
 from pinthesky.config import ConfigUpdate, ShadowConfigHandler
 from pinthesky.handler import Handler
+from pinthesky.metrics import MetricsRegistry
 
 logger = logging.getLogger(__name__)
+MEGABYTE = 1024 * 1024
+# S3 rejects parts smaller than this, other than the last
+MIN_PART_SIZE = 5 * MEGABYTE
+DEFAULT_PART_SIZE = 8 * MEGABYTE
+# Bytes per second from 1KB/s to 64MB/s
+THROUGHPUT_BUCKETS = [1024 * 2 ** power for power in range(0, 17)] + [float('inf')]
 
 
-class S3Upload(Handler, ShadowConfigHandler):
+class ChainedReader(io.RawIOBase):
+    """
+    A read-only file object over several files read back to back, which
+    allows video parts to be uploaded as a single object without combining
+    them on disk first.
+    """
+    def __init__(self, file_names):
+        self.file_names = list(file_names)
+        self.index = 0
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.index < len(self.file_names):
+            if self.current is None:
+                self.current = open(self.file_names[self.index], 'rb', buffering=0)
+            read = self.current.readinto(b)
+            if read:
+                return read
+            self.current.close()
+            self.current = None
+            self.index += 1
+        return 0
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+
+class S3Upload(threading.Thread, Handler, ShadowConfigHandler):
     """
     Handles the `combine_end` to flush the video content to a specific path by
     thing name. Note: if the session is not connected to a remote IoT Thing,
-    then this handle does nothing.
+    then this handle does nothing. Events listing `combine_parts` upload the
+    parts back to back as the object named by `combine_name`.
+
+    Without a spool, uploads run on the event thread and files are removed
+    after a single attempt. With an UploadSpool, handlers only move files
+    into the spool, and this thread uploads them, retrying failures with an
+    exponential backoff. Spooled uploads over the `multipart_threshold` are
+    sent as multipart uploads whose upload ID and completed parts are kept
+    in the spool manifest, so an interrupted clip resumes from the last
+    completed part.
+
+    Without a `part_size`, parts are sized by the throttle to the measured
+    throughput, or 8MB when there is no throttle.
     """
     def __init__(
             self, events,
@@ -22,13 +78,31 @@ class S3Upload(Handler, ShadowConfigHandler):
             bucket_prefix,
             session,
             bucket_image_prefix=None,
-            enaabled=True):
+            enaabled=True,
+            spool=None,
+            retry_backoff=2,
+            retry_backoff_max=300,
+            throttle=None,
+            part_size=None,
+            max_concurrency=2,
+            multipart_threshold=DEFAULT_PART_SIZE,
+            registry=None):
+        super().__init__(daemon=True)
         self.events = events
         self.bucket_name = bucket_name
         self.bucket_prefix = bucket_prefix
         self.session = session
         self.bucket_image_prefix = bucket_image_prefix
         self.enabled = enaabled
+        self.spool = spool
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.throttle = throttle
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.multipart_threshold = multipart_threshold
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.running = True
 
     def update_document(self) -> ConfigUpdate:
         return ConfigUpdate('storage', {
@@ -36,8 +110,17 @@ class S3Upload(Handler, ShadowConfigHandler):
             'bucket_name': self.bucket_name,
             'video_prefix': self.bucket_prefix,
             'image_prefix': self.bucket_image_prefix,
+            'bandwidth_limit': self.__bandwidth_limit(),
+            'part_size': None if self.part_size is None else self.part_size // MEGABYTE,
+            'max_concurrency': self.max_concurrency,
+            'multipart_threshold': self.multipart_threshold // MEGABYTE,
         })
 
+    def __bandwidth_limit(self):
+        if self.throttle is None or not self.throttle.rate:
+            return None
+        return self.throttle.rate // 1024
+
     def on_file_change(self, event):
         if 'current' in event['content']:
             desired = event['content']['current']['state']['desired']
@@ -46,6 +129,208 @@ class S3Upload(Handler, ShadowConfigHandler):
             self.bucket_name = storage.get('bucket_name', self.bucket_name)
             self.bucket_prefix = storage.get('video_prefix', self.bucket_prefix)
             self.bucket_image_prefix = storage.get('image_prefix', self.bucket_image_prefix)
+            limit = storage.get('bandwidth_limit', self.__bandwidth_limit())
+            if self.throttle is not None and limit != self.__bandwidth_limit():
+                self.throttle.configure(int(limit) * 1024 if limit else None)
+            part_size = storage.get(
+                'part_size',
+                None if self.part_size is None else self.part_size // MEGABYTE)
+            if part_size is not None and part_size * MEGABYTE < MIN_PART_SIZE:
+                logger.warning(f'Ignoring storage part_size {part_size}, the minimum is 5 MB')
+            else:
+                self.part_size = None if part_size is None else int(part_size) * MEGABYTE
+            max_concurrency = storage.get('max_concurrency', self.max_concurrency)
+            if int(max_concurrency) < 1:
+                logger.warning(f'Ignoring storage max_concurrency {max_concurrency}')
+            else:
+                self.max_concurrency = int(max_concurrency)
+            threshold = storage.get('multipart_threshold')
+            if threshold is not None:
+                self.multipart_threshold = max(MIN_PART_SIZE, int(threshold) * MEGABYTE)
+            if self.spool is not None:
+                # New storage settings may unblock pending uploads
+                self.spool.notify()
+
+    def __part_size(self):
+        if self.part_size is not None:
+            return self.part_size
+        if self.throttle is not None:
+            return self.throttle.part_size(DEFAULT_PART_SIZE)
+        return DEFAULT_PART_SIZE
+
+    def __read_part(self, f, size):
+        # Chained readers return short reads at file boundaries
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def __upload_part(self, s3, state, number, data):
+        if self.throttle is not None:
+            self.throttle.acquire(len(data), 'uploads')
+        resp = s3.upload_part(
+            Bucket=state['bucket_name'],
+            Key=state['key'],
+            UploadId=state['upload_id'],
+            PartNumber=number,
+            Body=data)
+        return {'PartNumber': number, 'ETag': resp['ETag']}
+
+    def __record_parts(self, futures, state, entry):
+        error = None
+        for future in futures:
+            try:
+                state['parts'].append(future.result())
+            except Exception as e:
+                error = e
+        self.spool.checkpoint(entry)
+        if error is not None:
+            raise error
+
+    def __abort_multipart(self, s3, entry):
+        state = entry.pop('multipart', None)
+        if state is None:
+            return
+        try:
+            s3.abort_multipart_upload(
+                Bucket=state['bucket_name'],
+                Key=state['key'],
+                UploadId=state['upload_id'])
+        except Exception as e:
+            logger.warning(f'Failed to abort multipart upload of {state["key"]}: {e}')
+
+    def __upload_parts(self, s3, f, state, entry):
+        """
+        Uploads the parts not completed yet, at most `max_concurrency` at a
+        time, checkpointing each part as it completes.
+        """
+        completed = set([part['PartNumber'] for part in state['parts']])
+        pending = set()
+        number = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            while True:
+                data = self.__read_part(f, state['part_size'])
+                if not data:
+                    break
+                number += 1
+                if number in completed:
+                    continue
+                if len(pending) >= self.max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self.__record_parts(done, state, entry)
+                pending.add(pool.submit(self.__upload_part, s3, state, number, data))
+            done, pending = wait(pending)
+            self.__record_parts(done, state, entry)
+
+    def __upload_multipart(self, s3, f, loc, entry, extra_args):
+        state = entry.get('multipart')
+        if state is not None and (state['bucket_name'], state['key']) != (self.bucket_name, loc):
+            logger.info(f'Restarting multipart upload of {entry["name"]} to a new location')
+            self.__abort_multipart(s3, entry)
+            state = None
+        if state is None:
+            resp = s3.create_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=loc,
+                **(extra_args or {}))
+            # The part size is fixed for the upload so completed parts line up on resume
+            state = {
+                'bucket_name': self.bucket_name,
+                'key': loc,
+                'upload_id': resp['UploadId'],
+                'part_size': self.__part_size(),
+                'parts': [],
+            }
+            entry['multipart'] = state
+            self.spool.checkpoint(entry)
+        elif state['parts']:
+            logger.info(f'Resuming upload of {entry["name"]} after {len(state["parts"])} parts')
+        try:
+            self.__upload_parts(s3, f, state, entry)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                # Expired or aborted remotely, the next attempt starts over
+                entry.pop('multipart', None)
+                self.spool.checkpoint(entry)
+            raise
+        s3.complete_multipart_upload(
+            Bucket=state['bucket_name'],
+            Key=state['key'],
+            UploadId=state['upload_id'],
+            MultipartUpload={
+                'Parts': sorted(state['parts'], key=lambda part: part['PartNumber']),
+            })
+        entry.pop('multipart', None)
+
+    def __upload(self, name, files, job, entry=None):
+        """
+        Uploads the files back to back as a single object. Returns None when
+        nothing could be attempted, otherwise whether the upload succeeded.
+        """
+        if self.bucket_name is None:
+            return None
+        source = job['source']
+        loc = f'{job["prefix"]}/{self.session.thing_name}/{name}'
+        dimensions = {'Operation': 'Upload', 'FileType': job['file_type']}
+        size = 0
+        try:
+            if self.session.login() is None:
+                return None
+            logger.debug(f"Uploading to s3://{self.bucket_name}/{loc}")
+            size = sum([os.stat(part).st_size for part in files])
+            s3 = self.session.client('s3')
+            reader = open(files[0], 'rb') if len(files) == 1 else ChainedReader(files)
+            with reader as f:
+                if self.enabled:
+                    started = time.monotonic()
+                    if entry is not None and size > self.multipart_threshold:
+                        self.__upload_multipart(s3, f, loc, entry, job['extra_args'])
+                    else:
+                        transfer = {}
+                        if self.throttle is not None:
+                            transfer['Callback'] = partial(self.throttle.acquire, priority='uploads')
+                        s3.upload_fileobj(
+                            f, self.bucket_name, loc,
+                            ExtraArgs=job['extra_args'],
+                            Config=TransferConfig(
+                                multipart_threshold=self.multipart_threshold,
+                                multipart_chunksize=self.__part_size(),
+                                max_concurrency=self.max_concurrency,
+                                use_threads=self.max_concurrency > 1),
+                            **transfer)
+                    elapsed = time.monotonic() - started
+                    if self.throttle is not None:
+                        self.throttle.measure(size, elapsed)
+                    self.registry.counter('UploadProcessed', **dimensions).add()
+                    self.registry.counter('Size', unit='Bytes', **dimensions).add(size)
+                    self.registry.histogram('Duration', **dimensions).observe(elapsed * 1000)
+                    if elapsed > 0:
+                        self.registry.histogram(
+                            'Throughput',
+                            unit='Bytes/Second',
+                            buckets=THROUGHPUT_BUCKETS,
+                            **dimensions).observe(size / elapsed)
+                    self.events.fire_event('upload_end', {
+                        'start_time': source['start_time'],
+                        'upload': {
+                            'bucket_name': self.bucket_name,
+                            'bucket_key': loc
+                        },
+                        **source,
+                    })
+                self.registry.histogram('Time', unit='Seconds', **dimensions).observe(
+                    time.time() - source['start_time'])
+                logger.info(f'Uploaded {size} bytes to s3://{self.bucket_name}/{loc}')
+            return True
+        except Exception as e:
+            self.registry.counter('UploadFailed', **dimensions).add()
+            logger.error(f'Failed to upload to s3://{self.bucket_name}/{loc}: {e}', exc_info=e)
+            return False
 
     def __upload_to_bucket(
             self,
@@ -53,78 +338,63 @@ class S3Upload(Handler, ShadowConfigHandler):
             file_obj,
             source,
             extra_args=None,
-            file_type=None):
-        creds = self.session.login()
-        if self.bucket_name is not None and creds is not None:
-            video = os.path.basename(file_obj)
-            loc = f'{prefix}/{self.session.thing_name}/{video}'
-            logger.debug(f"Uploading to s3://{self.bucket_name}/{loc}")
-            session = boto3.Session(
-                creds['accessKeyId'],
-                creds['secretAccessKey'],
-                creds['sessionToken'])
-            stat = os.stat(file_obj)
-            emf = {
-                'CloudWatchMetrics': [
-                    {
-                        'Dimensions': [
-                            ['ThingName', 'Operation'],
-                            ['ThingName', 'FileType'],
-                        ],
-                        'Metrics': [
-                            {
-                                'Name': 'Size',
-                                'Unit': 'Bytes',
-                            },
-                            {
-                                'Name': 'UploadProcessed',
-                                'Unit': 'Count',
-                            },
-                            {
-                                'Name': 'Time',
-                                'Unit': 'Seconds',
-                            }
-                        ]
-                    }
-                ],
-                'Size': stat.st_size,
-                'Operation': 'Upload',
-                'UploadProcessed': 0,
-                'File': video,
-                'FileType': file_type,
-                'Source': source['name'],
-            }
+            file_type=None,
+            parts=None):
+        name = os.path.basename(file_obj)
+        files = [file_obj] if parts is None else parts
+        job = {
+            'prefix': prefix,
+            'source': source,
+            'extra_args': extra_args,
+            'file_type': file_type,
+        }
+        if self.spool is not None:
+            if self.bucket_name is not None:
+                self.spool.put(name, files, job)
+            return
+        if self.__upload(name, files, job) is not None:
+            for part in files:
+                if os.path.exists(part):
+                    os.remove(part)
+
+    def run(self):
+        if self.spool is None:
+            return
+        self.spool.load()
+        while self.running:
+            entry = self.spool.next(timeout=1)
+            if entry is None:
+                continue
             try:
-                s3 = session.client('s3')
-                with open(file_obj, 'rb') as f:
-                    if self.enabled:
-                        s3.upload_fileobj(f, self.bucket_name, loc, ExtraArgs=extra_args)
-                        emf['UploadProcessed'] = 1
-                        self.events.fire_event('upload_end', {
-                            'start_time': source['start_time'],
-                            'upload': {
-                                'bucket_name': self.bucket_name,
-                                'bucket_key': loc
-                            },
-                            **source,
-                        })
-                    end_timestamp = floor(time.time())
-                    emf['Time'] = end_timestamp - source['start_time']
-                    logger.info(f'Uploaded to s3://{self.bucket_name}/{loc}', extra={
-                        'emf': emf,
-                    })
-            except RuntimeError as e:
-                end_timestamp = floor(time.time())
-                emf['Time'] = end_timestamp - source['start_time']
-                logger.error(
-                    f'Failed to upload to s3://{self.bucket_name}/{loc}: {e}',
-                    exc_info=e,
-                    extra={
-                        'emf': emf
-                    })
-            finally:
-                # TODO: add a failure strategy / retry attempt here
-                os.remove(file_obj)
+                self.__upload_entry(entry)
+            except Exception as e:
+                # The worker has to outlive any single broken entry
+                logger.error(f'Failed to process upload of {entry["name"]}: {e}', exc_info=e)
+                self.__retry_entry(entry)
+
+    def __upload_entry(self, entry):
+        missing = [f for f in entry['files'] if not os.path.exists(f)]
+        if missing:
+            logger.error(f'Removing upload of {entry["name"]}, missing {missing}')
+            if 'multipart' in entry and self.session.login() is not None:
+                self.__abort_multipart(self.session.client('s3'), entry)
+            self.spool.remove(entry)
+        elif self.__upload(entry['name'], entry['files'], entry['job'], entry=entry):
+            self.spool.remove(entry)
+        else:
+            self.__retry_entry(entry)
+
+    def __retry_entry(self, entry):
+        delay = min(
+            self.retry_backoff_max,
+            self.retry_backoff * 2 ** entry['attempts'])
+        logger.info(f'Retrying upload of {entry["name"]} in {delay} seconds')
+        self.spool.retry(entry, delay)
+
+    def stop(self):
+        self.running = False
+        if self.spool is not None:
+            self.spool.notify()
 
     def on_capture_image_end(self, event):
         if self.bucket_image_prefix is not None:
@@ -135,13 +405,19 @@ class S3Upload(Handler, ShadowConfigHandler):
                 file_type='image')
 
     def on_combine_end(self, event):
+        extra_args = {
+            'Metadata': {
+                'trigger': event['trigger']
+            }
+        }
+        # Uncombined parts have a name but no combined file
+        file_obj = event.get('combine_video', event.get('combine_name'))
+        if file_obj.endswith('.mp4'):
+            extra_args['ContentType'] = 'video/mp4'
         self.__upload_to_bucket(
             self.bucket_prefix,
-            event['combine_video'],
+            file_obj,
             event,
             file_type='video',
-            extra_args={
-                'Metadata': {
-                    'trigger': event['trigger']
-                }
-            })
+            parts=event.get('combine_parts'),
+            extra_args=extra_args)
@@ -1,3 +1,8 @@
+import struct
+import subprocess
+import threading
+
+from datetime import datetime
 from time import sleep
 from unittest import mock
 import pinthesky
@@ -35,6 +40,14 @@ def test_configuration_change():
                             'buffer': '20',
                             'buffer_size': '2000000',
                             'sensitivity': '20',
+                            'motion_zones': [
+                                {'x': 0, 'y': 0, 'width': 320, 'height': 240},
+                                {'x': 64, 'y': 64, 'width': 32, 'height': 32, 'weight': 0},
+                            ],
+                            'motion_detection': 'background',
+                            'motion_confirm_frames': '2',
+                            'motion_window_frames': '4',
+                            'motion_cooldown': '0.5',
                             'recording_window': '12-20',
                             'rotation': '180',
                             'resolution': '320x240',
@@ -52,6 +65,11 @@ def test_configuration_change():
     assert camera.recording_window == '12-20'
     assert camera.buffer == 20
     assert camera.sensitivity == 20
+    assert len(camera.motion_zones) == 2
+    assert camera.motion_detection == 'background'
+    assert camera.motion_confirm_frames == 2
+    assert camera.motion_window_frames == 4
+    assert camera.motion_cooldown == 0.5
     assert camera.encoding_bitrate == 5000000
     assert camera.buffer_size == 2000000
     assert camera.encoding_level == '2.1'
@@ -63,6 +81,57 @@ def test_configuration_change():
     assert camera.camera.start_recording.is_called
 
 
+def test_configuration_unknown_motion_detection():
+    events = EventThread()
+    camera = CameraThread(
+        events=events,
+        camera_class=mock.MagicMock(),
+        stream_class=mock.MagicMock(),
+        motion_detection_class=mock.MagicMock(),
+        recording_window="0-23")
+    camera.on_file_change({
+        'content': {
+            'current': {
+                'state': {
+                    'desired': {
+                        'camera': {
+                            'motion_detection': 'backgroud',
+                            'sensitivity': '15',
+                        }
+                    }
+                }
+            }
+        }
+    })
+    assert camera.motion_detection == 'vector'
+    assert camera.sensitivity == 15
+
+
+def test_background_motion_detection():
+    camera_class = mock.MagicMock()
+    camera_class.return_value.recording = False
+    stream_class = mock.MagicMock()
+    motion_class = mock.MagicMock()
+    events = EventThread()
+    camera = CameraThread(
+        events=events,
+        camera_class=camera_class,
+        stream_class=stream_class,
+        motion_detection_class=motion_class,
+        motion_detection='background')
+    assert camera.resume()
+    assert camera.camera.start_recording.call_count == 2
+    _, kwargs = camera.camera.start_recording.call_args_list[0]
+    assert kwargs['motion_output'] is None
+    camera.camera.start_recording.assert_called_with(
+        motion_class.return_value,
+        format='yuv',
+        splitter_port=2,
+        resize=motion_class.return_value.size)
+    _, kwargs = motion_class.call_args
+    assert kwargs['state'] is camera.motion_state
+
+
 def test_capture_image():
     camera_class = mock.MagicMock()
     stream_class = mock.MagicMock()
@@ -184,11 +253,400 @@ def test_configuration_update():
         'buffer': 15,
         'buffer_size': None,
         'sensitivity': 10,
+        'motion_zones': None,
+        'motion_detection': 'vector',
+        'motion_confirm_frames': 3,
+        'motion_window_frames': 5,
+        'motion_cooldown': 2,
         'rotation': 270,
         'resolution': '640x480',
         'framerate': 20,
         'recording_window': '0-23',
+        'max_clip_duration': 60,
         'encoding_level': camera.encoding_level,
         'encoding_profile': camera.encoding_profile,
         'encoding_bitrate': camera.encoding_bitrate
     })
+
+
+def test_camera_flush_non_blocking():
+    camera_class = mock.MagicMock()
+    stream_class = mock.MagicMock()
+    motion_class = mock.MagicMock()
+    device_health = mock.MagicMock()
+    test_handler = TestHandler()
+    events = EventThread()
+    camera = CameraThread(
+        events=events,
+        camera_class=camera_class,
+        stream_class=stream_class,
+        motion_detection_class=motion_class,
+        device_health=device_health,
+        buffer=5,
+        recording_window="0-23"
+    )
+    events.on(camera)
+    events.on(test_handler)
+    events.start()
+    try:
+        camera.start()
+        events.fire_event('motion_start')
+        sleep(0.1)
+        assert camera.flushing_deadline is not None
+        # The run loop keeps ticking and the lock is free during the flush
+        health_calls = device_health.emit_health.call_count
+        sleep(0.1)
+        assert device_health.emit_health.call_count > health_calls
+        assert camera.configuration_lock.acquire(timeout=0.1)
+        try:
+            # Pausing mid flush closes the clip early
+            camera.pause()
+        finally:
+            camera.configuration_lock.release()
+        events.event_queue.join()
+        assert test_handler.calls['flush_end'] == 1
+        assert not camera.flushing_stream
+        assert camera.flushing_deadline is None
+    finally:
+        camera.stop()
+
+
+def new_flush_camera(events, buffer, max_clip_duration):
+    stream_object = mock.MagicMock()
+    stream_class = mock.MagicMock(return_value=stream_object)
+    camera_class = mock.MagicMock()
+    # Block like the real camera so the run loop does not hog the lock
+    camera_class.return_value.wait_recording.side_effect = lambda timeout: sleep(min(timeout, 0.01))
+    return CameraThread(
+        events=events,
+        camera_class=camera_class,
+        stream_class=stream_class,
+        motion_detection_class=mock.MagicMock(),
+        device_health=mock.MagicMock(),
+        buffer=buffer,
+        max_clip_duration=max_clip_duration,
+        recording_window="0-23"
+    )
+
+
+def test_camera_flush_extended():
+    test_handler = TestHandler()
+    events = EventThread()
+    camera = new_flush_camera(events, buffer=0.3, max_clip_duration=10)
+    events.on(camera)
+    events.on(test_handler)
+    events.start()
+    try:
+        camera.start()
+        events.fire_event('capture_video', {'duration': 0.3})
+        sleep(0.2)
+        events.fire_event('capture_video', {'duration': 0.3})
+        sleep(0.2)
+        # The second trigger extended the clip rather than being dropped
+        assert 'flush_end' not in getattr(test_handler, 'calls', {})
+        sleep(0.4)
+        assert test_handler.calls['flush_end'] == 1
+    finally:
+        camera.stop()
+
+
+def test_camera_flush_chained():
+    flushes = []
+    events = EventThread()
+    camera = new_flush_camera(events, buffer=0.1, max_clip_duration=0.3)
+    events.on_event('flush_end', flushes.append, 'Flushes')
+    events.on(camera)
+    events.start()
+    try:
+        camera.start()
+        events.fire_event('capture_video', {'duration': 0.5})
+        sleep(0.4)
+        # The duration past the max is chained into a new clip
+        assert len(flushes) == 1
+        assert camera.flushing_stream
+        sleep(0.4)
+        assert len(flushes) == 2
+        assert flushes[1]['start_time'] > flushes[0]['start_time']
+        camera.camera.split_recording.assert_any_call(
+            f'{flushes[1]["start_time"]}.after.h264')
+        assert not camera.flushing_stream
+    finally:
+        camera.stop()
+
+
+def test_camera_flush_motion_episode():
+    flushes = []
+    events = EventThread()
+    camera = new_flush_camera(events, buffer=0.1, max_clip_duration=10)
+    events.on_event('flush_end', flushes.append, 'Flushes')
+    events.on(camera)
+    events.start()
+    try:
+        camera.start()
+        camera.motion_state.active = True
+        events.fire_event('motion_start')
+        sleep(0.4)
+        # The clip is extended for as long as the episode is active
+        assert len(flushes) == 0
+        camera.motion_state.active = False
+        events.fire_event('motion_end')
+        sleep(0.4)
+        assert len(flushes) == 1
+    finally:
+        camera.stop()
+
+
+def test_camera_pause_drops_pending_flush():
+    events = EventThread()
+    camera = new_flush_camera(events, buffer=0.1, max_clip_duration=1)
+    camera.on_capture_video({'timestamp': 1, 'duration': 0.1})
+    assert camera.flushing_stream
+    assert camera.flushing_deadline is None
+    # A live stream pauses the camera before the run loop began the flush
+    camera.camera.recording = True
+    assert camera.pause()
+    assert not camera.flushing_stream
+    camera.camera.split_recording.assert_not_called()
+
+
+@mock.patch('pinthesky.camera.ConnectionThread')
+@mock.patch('pinthesky.conversion.Popen')
+def test_camera_record_decimation(popen, connection_thread):
+    popen.return_value.stdout.read1.return_value = b''
+    popen.return_value.poll.return_value = 0
+    camera_class = mock.MagicMock()
+    camera_class.return_value.recording = False
+    events = EventThread()
+    camera = CameraThread(
+        events=events,
+        camera_class=camera_class,
+        stream_class=mock.MagicMock(),
+        motion_detection_class=mock.MagicMock(),
+        connection_manager=mock.MagicMock(),
+        resolution=(1280, 720))
+    assert camera.record({
+        'session': {'start': True, 'scale': '2', 'skip': 'bad', 'resizer': 'gpu'},
+        'connection': {'id': 'abc'},
+    })
+    args, kwargs = camera.camera.start_recording.call_args
+    assert kwargs['format'] == 'yuv'
+    assert kwargs['splitter_port'] == 3
+    assert kwargs['resize'] == (640, 360)
+    conversion = args[0]
+    assert conversion.resolution == (640, 360)
+    assert conversion.decimation.skip == 1
+    connection_thread.return_value.start.assert_called_once()
+
+
+@mock.patch('pinthesky.camera.ConnectionThread')
+@mock.patch('pinthesky.conversion.Popen')
+def test_camera_record_viewers(popen, connection_thread):
+    popen.return_value.stdout.read1.return_value = b''
+    popen.return_value.poll.return_value = 0
+    connection_thread.side_effect = lambda **kwargs: mock.MagicMock(buffer=kwargs['buffer'])
+    camera_class = mock.MagicMock()
+    camera_class.return_value.recording = False
+    events = EventThread()
+    camera = CameraThread(
+        events=events,
+        camera_class=camera_class,
+        stream_class=mock.MagicMock(),
+        motion_detection_class=mock.MagicMock(),
+        connection_manager=mock.MagicMock())
+    live_camera = camera.camera
+
+    def record(connection_id, start=True):
+        return {
+            'session': {'start': start, 'stop': not start},
+            'connection': {'id': connection_id},
+        }
+
+    camera.on_record(record('first'))
+    camera.on_record(record('second'))
+    camera.on_record(record('second'))
+    # Viewers share the encoder started for the first
+    assert live_camera.start_recording.call_count == 1
+    assert connection_thread.call_count == 2
+    # Each viewer reports to the broadcast, never straight to the encoder
+    for _, kwargs in connection_thread.call_args_list:
+        assert kwargs['feedback'] == kwargs['buffer'].report
+    assert camera.live_broadcast.feedback == camera.live_conversion.adapt
+    assert list(camera.live_viewers.keys()) == ['first', 'second']
+    assert camera.connection_manager.post_to_connection.call_count == 2
+    camera.on_record(record('first', start=False))
+    live_camera.close.assert_not_called()
+    assert list(camera.live_viewers.keys()) == ['second']
+    camera.on_record_end(record('second', start=False))
+    live_camera.stop_recording.assert_called_once_with(splitter_port=3)
+    live_camera.close.assert_not_called()
+    assert camera.live_broadcast is None
+    assert camera.live_viewers == {}
+
+
+class FakeCamera:
+    """
+    Produces numbered frames on every active splitter port the way picamera
+    does, until closed. Each frame is written to the outputs recording at
+    that moment, so gaps on any output are lost frames.
+    """
+    FRAME = struct.Struct('>I')
+
+    def __init__(self):
+        self.resolution = (32, 16)
+        self.framerate = 200
+        self.rotation = 0
+        self.lock = threading.Lock()
+        self.ports = {}
+        self.closes = 0
+        self.frame = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.__produce, daemon=True)
+        self.thread.start()
+
+    @property
+    def recording(self):
+        return len(self.ports) > 0
+
+    def __produce(self):
+        while self.running:
+            with self.lock:
+                frame = self.FRAME.pack(self.frame)
+                for format, outputs in self.ports.values():
+                    if format == 'yuv':
+                        # A whole 32x16 YUV420 frame, numbered throughout
+                        frame = frame * (32 * 16 * 3 // 2 // self.FRAME.size)
+                    for output in outputs:
+                        output.write(frame)
+                    frame = frame[:self.FRAME.size]
+                self.frame += 1
+            sleep(1 / self.framerate)
+
+    def start_recording(self, output, format, splitter_port=1, motion_output=None, **kwargs):
+        with self.lock:
+            assert splitter_port not in self.ports
+            outputs = [output] if motion_output is None else [output, motion_output]
+            self.ports[splitter_port] = (format, outputs)
+
+    def stop_recording(self, splitter_port=1):
+        with self.lock:
+            _, outputs = self.ports.pop(splitter_port)
+        for output in outputs:
+            output.flush()
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        assert splitter_port in self.ports
+        sleep(min(timeout, 0.01))
+
+    def close(self):
+        self.closes += 1
+        for splitter_port in list(self.ports.keys()):
+            self.stop_recording(splitter_port)
+        self.running = False
+
+
+class FrameOutput:
+    def __init__(self, *args, **kwargs):
+        self.frames = []
+
+    def write(self, b):
+        self.frames.append(FakeCamera.FRAME.unpack(b[:FakeCamera.FRAME.size])[0])
+
+    def flush(self):
+        pass
+
+
+def assert_no_lost_frames(frames):
+    assert len(frames) > 0
+    assert frames == list(range(frames[0], frames[0] + len(frames)))
+
+
+@mock.patch('pinthesky.conversion.Popen')
+def test_camera_live_alongside_motion(popen):
+    # Echo the raw frames back in place of the conversion to MPEG1
+    popen.side_effect = lambda args, **kwargs: subprocess.Popen(['cat'], stdin=kwargs['stdin'], stdout=kwargs['stdout'])
+    posts = {}
+    manager = mock.MagicMock()
+    manager.post_to_connection = lambda connection_id, data, binary: posts.setdefault(connection_id, []).append(data) or True
+    motion_outputs = []
+    events = EventThread()
+    camera = CameraThread(
+        events=events,
+        camera_class=FakeCamera,
+        stream_class=FrameOutput,
+        motion_detection_class=lambda *args, **kwargs: motion_outputs.append(FrameOutput()) or motion_outputs[-1],
+        connection_manager=manager,
+        resolution=(32, 16),
+        framerate=200)
+    events.on(camera)
+    events.start()
+    fake_camera = camera.camera
+    assert camera.resume()
+    sleep(0.1)
+    events.fire_event('record', {'session': {'start': True}, 'connection': {'id': 'viewer'}})
+    sleep(0.2)
+    events.fire_event('record', {'session': {'stop': True, 'start': False}, 'connection': {'id': 'viewer'}})
+    events.event_queue.join()
+    sleep(0.1)
+    camera.stop()
+    events.stop()
+    # Motion recording never stopped for the live view
+    assert fake_camera.closes == 1
+    assert len(motion_outputs) == 1
+    assert_no_lost_frames(camera.historical_stream.frames)
+    assert motion_outputs[0].frames == camera.historical_stream.frames
+    header, *stream = posts['viewer']
+    assert header == b'jsmp' + struct.pack('>HH', 32, 16)
+    stream = b''.join(stream)
+    frame_size = 32 * 16 * 3 // 2
+    assert len(stream) % frame_size == 0
+    live_frames = [
+        FakeCamera.FRAME.unpack_from(stream, offset)[0]
+        for offset in range(0, len(stream), frame_size)
+    ]
+    assert_no_lost_frames(live_frames)
+    assert live_frames[0] > camera.historical_stream.frames[0]
+    assert live_frames[-1] < camera.historical_stream.frames[-1]
+
+
+@mock.patch('pinthesky.conversion.Popen')
+def test_camera_window_while_live(popen):
+    popen.side_effect = lambda args, **kwargs: subprocess.Popen(['cat'], stdin=kwargs['stdin'], stdout=kwargs['stdout'])
+    manager = mock.MagicMock()
+    manager.post_to_connection.return_value = True
+    events = EventThread()
+    outside_hour = (datetime.now().hour + 1) % 24
+    camera = CameraThread(
+        events=events,
+        camera_class=FakeCamera,
+        stream_class=FrameOutput,
+        motion_detection_class=lambda *args, **kwargs: FrameOutput(),
+        device_health=mock.MagicMock(),
+        connection_manager=manager,
+        resolution=(32, 16),
+        framerate=200,
+        recording_window=f'{outside_hour}-{outside_hour}')
+    events.on(camera)
+    events.start()
+    fake_camera = camera.camera
+    camera.start()
+    try:
+        events.fire_event('record', {'session': {'start': True}, 'connection': {'id': 'viewer'}})
+        events.event_queue.join()
+        sleep(0.1)
+        # Outside the window only the live port records
+        assert list(fake_camera.ports.keys()) == [3]
+        assert not camera.motion_recording
+        camera.start_hour, camera.end_hour = 0, 23
+        sleep(0.3)
+        assert sorted(fake_camera.ports.keys()) == [1, 3]
+        assert camera.motion_recording
+        camera.start_hour, camera.end_hour = outside_hour, outside_hour
+        sleep(0.3)
+        assert list(fake_camera.ports.keys()) == [3]
+        assert not camera.motion_recording
+        # The live recording carried on throughout
+        assert fake_camera.closes == 0
+        assert 'viewer' in camera.live_viewers
+    finally:
+        camera.stop()
+        events.stop()
@@ -2,13 +2,17 @@ import logging
 import time
 import json
 import boto3
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
 from pinthesky import VERSION
 from pinthesky.events import EventThread
 from pinthesky.session import Session
-from pinthesky.cloudwatch import CloudWatchManager, CloudWatchEventFilter, CloudWatchEventFormat, CloudWatchLoggingStream, ThreadedStream
+from pinthesky.cloudwatch import (
+    CloudWatchManager, CloudWatchEventFilter, CloudWatchEventFormat,
+    CloudWatchLoggingStream, ThreadedStream, MAX_BATCH_EVENTS,
+)
 from pinthesky.config import ConfigUpdate
+from pinthesky.metrics import MetricsRegistry
 
 
 class CaptureHandler(logging.Handler):
@@ -30,6 +34,10 @@ class CaptureStream():
         if self.sleep:
             time.sleep(0.01)
 
+    def write_batch(self, logs):
+        for log in logs:
+            self.write(log['message'], log['timestamp'])
+
 
 def test_cloudwatch_manager():
     session = Session(
@@ -294,3 +302,128 @@ def test_cloudwatch_logging_stream():
         logs.put_log_events.assert_called_once()
 
     mock_method.assert_called_once()
+
+
+def test_cloudwatch_logging_stream_batch():
+    session = Session(
+        cacert_path="capath",
+        cert_path="cert_path",
+        key_path="key_path",
+        role_alias="role_alias",
+        thing_name="thing_name",
+        credentials_endpoint="credentials_endpoint")
+    now = datetime.now()
+    next_year = datetime(year=now.year + 1, month=now.month, day=1)
+    session.credentials = {
+        'accessKeyId': 'abc',
+        'secretAccessKey': 'efg',
+        'sessionToken': '123',
+        'expiration': next_year.strftime("%Y-%m-%dT%H:%M:%SZ")
+    }
+    logs = MagicMock()
+    logs.describe_log_streams.return_value = {'logStreams': []}
+    logging_stream = CloudWatchLoggingStream(
+        session=session,
+        enabled=True,
+        delineate_stream=False,
+        log_group_name='Pits/Device')
+    today = datetime(year=2023, month=1, day=1, hour=23)
+    batch = [
+        {'message': f'Message {i}\n', 'timestamp': today}
+        for i in range(0, MAX_BATCH_EVENTS + 1)
+    ]
+    batch.append({'message': 'Tomorrow', 'timestamp': today + timedelta(hours=2)})
+    with patch.object(boto3.Session, 'client', return_value=logs) as mock_method:
+        logging_stream.write_batch(batch)
+
+    mock_method.assert_called_once()
+    calls = logs.put_log_events.call_args_list
+    assert [len(c.kwargs['logEvents']) for c in calls] == [MAX_BATCH_EVENTS, 1, 1]
+    assert [c.kwargs['logStreamName'] for c in calls] == [
+        '2023/01/01', '2023/01/01', '2023/01/02'
+    ]
+    assert calls[0].kwargs['logEvents'][0]['message'] == 'Message 0'
+
+
+def test_threaded_stream_batches():
+    batches = []
+
+    class BatchStream():
+        def write_batch(self, logs):
+            batches.append([log['message'] for log in logs])
+
+    stream_thread = ThreadedStream(stream=BatchStream(), max_batch_events=10)
+    for i in range(0, 25):
+        stream_thread.write(f'Message {i}')
+    stream_thread.start()
+    stream_thread.stop()
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert batches[0][0] == 'Message 0'
+    report = stream_thread.metrics.report()
+    assert report['log_batches'] == 3
+    assert report['log_batch_events_max'] == 10
+    assert report['log_dropped'] == 0
+
+
+def test_threaded_stream_overflow():
+    stream = CaptureStream(sleep=False)
+    stream_thread = ThreadedStream(stream=stream, max_queue_size=2)
+    for i in range(0, 5):
+        stream_thread.write(f'Message {i}')
+    stream_thread.start()
+    stream_thread.stop()
+    assert stream.messages == ['Message 0', 'Message 1']
+    assert stream_thread.metrics.report()['log_dropped'] == 3
+
+
+def test_threaded_stream_age():
+    stream = CaptureStream(sleep=False)
+    stream_thread = ThreadedStream(stream=stream, max_batch_age=0.05)
+    stream_thread.start()
+    stream_thread.write('Message')
+    time.sleep(0.2)
+    assert stream.messages == ['Message']
+    stream_thread.stop()
+
+
+def test_cloudwatch_manager_flushes_metrics():
+    session = Session(
+        cacert_path="capath",
+        cert_path="cert_path",
+        key_path="key_path",
+        role_alias="role_alias",
+        thing_name="thing_name",
+        credentials_endpoint="credentials_endpoint")
+    registry = MetricsRegistry()
+    manager = CloudWatchManager(session=session, registry=registry)
+    registry.counter('UploadProcessed', Operation='Upload', FileType='video').add(2)
+    registry.histogram('Duration', Operation='Upload', FileType='video').observe(40)
+    # Without EMF enabled, the interval is drained and nothing is written
+    manager.on_health_end({})
+    assert registry.collect()[0]['values']['UploadProcessed'] == 0
+    stream = CaptureStream(sleep=False)
+    manager.event_handler = logging.StreamHandler(stream=stream)
+    manager.event_handler.setFormatter(CloudWatchEventFormat(session=session))
+    registry.counter('UploadProcessed', Operation='Upload', FileType='video').add(3)
+    registry.histogram('Duration', Operation='Upload', FileType='video').observe(40)
+    manager.on_health_end({})
+    assert len(stream.messages) == 1
+    document = json.loads(stream.messages[0])
+    assert document['_aws']['CloudWatchMetrics'] == [
+        {
+            'Namespace': 'Pits/Device',
+            'Dimensions': [['ThingName', 'FileType'], ['ThingName', 'Operation']],
+            'Metrics': [
+                {'Name': 'UploadProcessed', 'Unit': 'Count'},
+                {'Name': 'Duration', 'Unit': 'Milliseconds'},
+                {'Name': 'DurationP50', 'Unit': 'Milliseconds'},
+                {'Name': 'DurationP99', 'Unit': 'Milliseconds'},
+                {'Name': 'DurationMax', 'Unit': 'Milliseconds'},
+            ]
+        }
+    ]
+    assert document['ThingName'] == 'thing_name'
+    assert document['Operation'] == 'Upload'
+    assert document['FileType'] == 'video'
+    assert document['UploadProcessed'] == 3
+    assert document['DurationP99'] == 40
@@ -1,9 +1,10 @@
 from math import floor
 import os
 import time
-from pinthesky.combiner import VideoCombiner
+from pinthesky.combiner import VideoCombiner, append_file
 from pinthesky.events import EventThread
 from test_handler import TestHandler
+from test_mp4 import boxes, h264_stream
 
 
 def test_combiner():
@@ -31,3 +32,142 @@ def test_combiner():
         os.remove(motion_file)
     finally:
         os.removedirs(combine_dir)
+
+
+def test_combiner_chained():
+    combine_dir = "combine_dir"
+    handler = TestHandler()
+    events = EventThread()
+    combiner = VideoCombiner(events, combine_dir)
+    events.on(handler)
+    events.on(combiner)
+    events.start()
+    start_time = floor(time.time())
+    with open(f'{start_time}.after.h264', 'w') as f:
+        f.write("World!")
+    events.fire_event("flush_end", {
+        'start_time': start_time,
+        'trigger': 'motion',
+    })
+    events.event_queue.join()
+    motion_file = f'{combine_dir}/{start_time}.motion.h264'
+    try:
+        assert handler.calls['combine_end'] == 1
+        with open(motion_file, 'r') as f:
+            assert f.read() == "World!"
+        os.remove(motion_file)
+    finally:
+        os.removedirs(combine_dir)
+
+
+def test_combiner_append():
+    combine_dir = "combine_dir"
+    events = EventThread()
+    combiner = VideoCombiner(events, combine_dir, combine_strategy='append')
+    start_time = floor(time.time())
+    with open(f'{start_time}.before.h264', 'w') as f:
+        f.write("Hello ")
+    with open(f'{start_time}.after.h264', 'w') as f:
+        f.write("World!")
+    combiner.on_flush_end({
+        'start_time': start_time,
+        'trigger': 'motion',
+    })
+    motion_file = f'{combine_dir}/{start_time}.motion.h264'
+    try:
+        with open(motion_file, 'r') as f:
+            assert f.read() == "Hello World!"
+        assert not os.path.exists(f'{start_time}.before.h264')
+        assert not os.path.exists(f'{start_time}.after.h264')
+        os.remove(motion_file)
+    finally:
+        os.removedirs(combine_dir)
+
+
+def test_append_file_fallback():
+    part_name = 'test_part.h264'
+    output_name = 'test_output.h264'
+    content = os.urandom(10000)
+    with open(part_name, 'wb') as f:
+        f.write(content)
+
+    def unsupported(in_fd, out_fd, count):
+        raise OSError('not supported')
+
+    try:
+        for copies in [None, [unsupported], []]:
+            with open(output_name, 'wb', buffering=0) as o:
+                o.write(b'head')
+                append_file(part_name, o, chunk_size=4096, copies=copies)
+            with open(output_name, 'rb') as f:
+                assert f.read() == b'head' + content
+    finally:
+        os.remove(part_name)
+        os.remove(output_name)
+
+
+def test_combiner_parts():
+    combine_dir = "combine_dir"
+    combined = []
+    events = EventThread()
+    events.on_event('combine_end', combined.append, 'Combined')
+    combiner = VideoCombiner(events, combine_dir, combine_strategy='parts')
+    events.start()
+    start_time = floor(time.time())
+    parts = [f'{start_time}.before.h264', f'{start_time}.after.h264']
+    for part in parts:
+        with open(part, 'w') as f:
+            f.write("Hello")
+    combiner.on_flush_end({
+        'start_time': start_time,
+        'trigger': 'motion',
+    })
+    events.event_queue.join()
+    try:
+        assert 'combine_video' not in combined[0]
+        assert combined[0]['combine_name'] == f'{start_time}.motion.h264'
+        assert combined[0]['combine_parts'] == parts
+        assert not os.path.exists(f'{combine_dir}/{start_time}.motion.h264')
+    finally:
+        for part in parts:
+            os.remove(part)
+        os.removedirs(combine_dir)
+
+
+def test_combiner_mp4():
+    combine_dir = "combine_dir"
+    handler = TestHandler()
+    events = EventThread()
+    combiner = VideoCombiner(events, combine_dir, combine_container='mp4')
+    events.on(handler)
+    events.on(combiner)
+    events.start()
+    start_time = floor(time.time())
+    with open(f'{start_time}.before.h264', 'wb') as f:
+        f.write(h264_stream(1, 10))
+    with open(f'{start_time}.after.h264', 'wb') as f:
+        f.write(h264_stream(2, 10))
+    events.fire_event("flush_end", {
+        'start_time': start_time,
+        'trigger': 'motion',
+        'framerate': 20.0,
+    })
+    events.event_queue.join()
+    motion_file = f'{combine_dir}/{start_time}.motion.mp4'
+    try:
+        assert handler.calls['combine_end'] == 1
+        assert not os.path.exists(f'{start_time}.before.h264')
+        assert not os.path.exists(f'{start_time}.after.h264')
+        with open(motion_file, 'rb') as f:
+            data = f.read()
+        assert [kind for kind, _ in boxes(data)][:2] == [b'ftyp', b'moov']
+        assert len([kind for kind, _ in boxes(data) if kind == b'moof']) == 3
+        os.remove(motion_file)
+    finally:
+        os.removedirs(combine_dir)
+
+
+def test_combiner_warns_parts_mp4(caplog):
+    combiner = VideoCombiner(EventThread(), 'combine_dir', combine_strategy='parts', combine_container='mp4')
+    assert combiner.combine_strategy == 'parts'
+    assert 'ignoring the mp4 container' in caplog.text
@@ -2,13 +2,28 @@ import boto3
 import json
 from botocore.exceptions import ClientError
 from functools import partial
-from pinthesky.connection import ConnectionThread, ConnectionHandler, ConnectionManager, ProcessBuffer, ProtocolData
+from pinthesky.connection import (
+    BroadcastBuffer, ConnectionBuffer, ConnectionThread, ConnectionHandler,
+    ConnectionManager, ProcessBuffer, ProtocolData,
+)
+from pinthesky.metrics import MetricsRegistry
 from pinthesky.config import ConfigUpdate
 from pinthesky.events import EventThread
+from pinthesky.session import Session
 from unittest.mock import patch, MagicMock
 from test_handler import TestHandler
 
 
+def new_session():
+    return Session(
+        cert_path="cert_path",
+        key_path="key_path",
+        cacert_path="cacert_path",
+        thing_name="thing_name",
+        role_alias="role_alias",
+        credentials_endpoint=None)
+
+
 def test_connection_thread():
     manager = MagicMock()
     process = MagicMock()
@@ -91,6 +106,110 @@ def test_connection_thread_manager_failed():
     assert handler.calls['record_end'] == 1
 
 
+class ChunkBuffer(ConnectionBuffer):
+    def __init__(self, chunks) -> None:
+        self.chunks = list(chunks)
+        self.closed = False
+
+    def read1(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def poll(self):
+        return None if self.chunks else 0
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_thread_coalesces_reads():
+    events = EventThread()
+    handler = TestHandler()
+    manager = MagicMock()
+    posts = []
+    manager.post_to_connection = lambda connection_id, data, binary: posts.append(data) or True
+    buffer = ChunkBuffer([b'abcd', b'efgh', b'ijkl', b'mn'])
+    connection_thread = ConnectionThread(
+        events=events,
+        manager=manager,
+        buffer=buffer,
+        event_data={
+            'connection': {
+                'id': '$connectionId',
+            }
+        },
+        max_batch_size=10,
+        max_batch_delay=1)
+    events.on(handler)
+    events.start()
+    connection_thread.start()
+    connection_thread.join(5)
+    events.event_queue.join()
+    assert posts == [b'abcdefgh', b'ijklmn']
+    assert connection_thread.posts == 2
+    assert connection_thread.posted_bytes == 14
+    assert buffer.closed
+    assert handler.calls['record_end'] == 1
+
+
+def test_broadcast_buffer_fans_out():
+    events = EventThread()
+    handler = TestHandler()
+    manager = MagicMock()
+    posts = []
+    manager.post_to_connection = lambda connection_id, data, binary: posts.append(data) or True
+    registry = MetricsRegistry()
+    buffer = ChunkBuffer([b'abcd', b'efgh', b'ijkl', b'mn'])
+    broadcast = BroadcastBuffer(buffer, window=3, registry=registry)
+    viewer = ConnectionThread(
+        events=events,
+        manager=manager,
+        buffer=broadcast.subscribe(),
+        event_data={'connection': {'id': '$connectionId'}},
+        max_batch_size=4)
+    slow = broadcast.subscribe()
+    leaving = broadcast.subscribe()
+    leaving.close()
+    assert leaving.poll() == 0
+    events.on(handler)
+    events.start()
+    # Viewers that fall behind keep only the newest chunks
+    broadcast.start()
+    broadcast.join(5)
+    viewer.start()
+    viewer.join(5)
+    events.event_queue.join()
+    assert posts == [b'efgh', b'ijkl', b'mn']
+    assert slow.read1(100) == b'efgh'
+    assert slow.read1(100) == b'ijkl'
+    assert slow.read1(2) == b'mn'
+    assert slow.poll() == 0
+    assert buffer.closed
+    assert broadcast.subscribe().poll() == 0
+    assert handler.calls['record_end'] == 1
+    values = dict([(name, value) for g in registry.collect() for name, value in g['values'].items()])
+    assert values['LiveChunksDropped'] == 2
+    assert values['LiveViewers'] == 0
+
+
+def test_broadcast_buffer_feedback_follows_median_viewer():
+    signals = []
+    broadcast = BroadcastBuffer(ChunkBuffer([]), feedback=lambda *args: signals.append(args))
+    fast, slow = broadcast.subscribe(), broadcast.subscribe()
+    slow.report(2.0, 0.9)
+    assert signals[-1] == (2.0, 0.9)
+    # One lagging viewer of two does not degrade the shared encoder
+    fast.report(0.1, 0)
+    slow.report(3.0, 1.0)
+    assert signals[-1] == (0.1, 0)
+    third = broadcast.subscribe()
+    third.report(1.0, 0.5)
+    assert signals[-1] == (1.0, 0.5)
+    slow.close()
+    third.close()
+    fast.report(0.05, 0)
+    assert signals[-1] == (0.05, 0)
+
+
 def test_connection_manager_no_url():
     session = MagicMock()
     manager = ConnectionManager(
@@ -133,7 +252,7 @@ def test_connection_manager_no_url():
 
 
 def test_connection_manager_no_credentials():
-    session = MagicMock()
+    session = new_session()
     manager = ConnectionManager(
         session=session,
         endpoint_url="http://example.com",
@@ -153,7 +272,7 @@ def test_connection_manager_no_credentials():
 
 
 def test_connection_manager_happy_path():
-    session = MagicMock()
+    session = new_session()
     manager = ConnectionManager(
         session=session,
         endpoint_url="http://example.com",
@@ -186,7 +305,7 @@ def test_connection_manager_happy_path():
 
 
 def test_connection_manager_post_failed():
-    session = MagicMock()
+    session = new_session()
     manager = ConnectionManager(
         session=session,
         endpoint_url="http://example.com",
@@ -273,3 +392,45 @@ def test_protocol_data():
     manager.post_to_connection = post_to_connection
 
     assert data.send()
+
+
+def test_connection_manager_reuses_client():
+    session = new_session()
+    manager = ConnectionManager(
+        session=session,
+        endpoint_url="http://example.com",
+        enabled=True
+    )
+    credentials = {
+        'accessKeyId': 'accessKeyId',
+        'secretAccessKey': 'secretAccessKey',
+        'sessionToken': 'sessionToken',
+    }
+
+    def login():
+        return credentials
+
+    session.login = login
+    with patch.object(boto3.Session, 'client') as mock_client:
+        assert manager.post_to_connection("$connectionId", {})
+        assert manager.post_to_connection("$connectionId", {})
+        mock_client.assert_called_once()
+        # Rotated credentials create a new client
+        credentials = {**credentials, 'sessionToken': 'rotated'}
+        assert manager.post_to_connection("$connectionId", {})
+        assert mock_client.call_count == 2
+        manager.post_to_connection("$connectionId", {}, endpoint_override="http://other.com")
+        assert mock_client.call_count == 3
+        session.on_file_change({
+            'content': {
+                'current': {
+                    'state': {
+                        'desired': {
+                            'cloud_connection': {}
+                        }
+                    }
+                }
+            }
+        })
+        assert manager.post_to_connection("$connectionId", {})
+        assert mock_client.call_count == 4
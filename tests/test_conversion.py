@@ -0,0 +1,134 @@
+import numpy as np
+
+from unittest.mock import MagicMock, patch
+from pinthesky.conversion import ConversionBuffer, FrameDecimation, VideoConversion
+from pinthesky.metrics import MetricsRegistry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def new_conversion(registry, clock):
+    camera = MagicMock()
+    camera.framerate = 20
+    camera.resolution = (640, 480)
+    return VideoConversion(camera, registry=registry, clock=clock)
+
+
+@patch('pinthesky.conversion.Popen')
+def test_conversion_adapts_tiers(popen):
+    popen.side_effect = lambda *args, **kwargs: MagicMock()
+    clock = FakeClock()
+    registry = MetricsRegistry()
+    conversion = new_conversion(registry, clock)
+    assert '800k' in popen.call_args[0][0]
+    # Falling behind within the cooldown is not enough to step down
+    conversion.adapt(1, 0)
+    assert conversion.target_tier == 0
+    clock.now = 2
+    conversion.adapt(1, 0)
+    assert conversion.target_tier == 1
+    first = conversion.process
+    for frame in range(0, 4):
+        conversion.write(b'frame')
+    # The encoder restarted at half the framerate, dropping every other frame
+    args = popen.call_args[0][0]
+    assert args[args.index('-b') + 1] == '500k'
+    assert args[args.index('-r') + 1] == '10.0'
+    first.stdin.close.assert_called_once()
+    assert conversion.process.stdin.write.call_count == 2
+    values = dict([(name, value) for g in registry.collect() for name, value in g['values'].items()])
+    assert values['LiveTier'] == 1
+    assert values['LiveFramesDropped'] == 2
+    # Keeping up steps back up after the recovery period
+    clock.now = 3
+    conversion.adapt(0.1, 0)
+    clock.now = 12
+    conversion.adapt(0.1, 0)
+    assert conversion.target_tier == 1
+    clock.now = 13
+    conversion.adapt(0.1, 0)
+    assert conversion.target_tier == 0
+
+
+@patch('pinthesky.conversion.Popen')
+def test_conversion_buffer_follows_restart(popen):
+    processes = []
+
+    def new_process(*args, **kwargs):
+        process = MagicMock()
+        process.poll.return_value = None
+        process.stdout.read1.side_effect = [f'{len(processes)}'.encode(), b'']
+        processes.append(process)
+        return process
+
+    popen.side_effect = new_process
+    clock = FakeClock()
+    conversion = new_conversion(MetricsRegistry(), clock)
+    buffer = ConversionBuffer(conversion)
+    assert buffer.read1(10) == b'0'
+    clock.now = 2
+    conversion.adapt(1, 1)
+    conversion.write(b'frame')
+    assert buffer.poll() is None
+    # The drained process is closed and reading moves to its replacement
+    assert buffer.read1(10) == b'1'
+    processes[0].wait.assert_called_once()
+    processes[1].poll.return_value = 0
+    assert buffer.poll() == 0
+
+
+def padded_frame(width, height):
+    # Planes hold their row index, so the rows kept are visible in the output
+    padded_width, padded_height = (width + 31) & ~31, (height + 15) & ~15
+    luma = np.repeat(np.arange(padded_height, dtype=np.uint8), padded_width)
+    chroma = np.repeat(np.arange(padded_height // 2, dtype=np.uint8), padded_width // 2)
+    return np.concatenate([luma, chroma, chroma + 100]).tobytes()
+
+
+def test_frame_decimation_stride():
+    decimation = FrameDecimation((1920, 1080), scale=2, skip=2, resizer='stride')
+    assert decimation.size == (960, 540)
+    assert decimation.resize is None
+    frame = decimation.decimate(padded_frame(1920, 1080))
+    assert len(frame) == 960 * 540 * 3 // 2
+    luma = frame[:960 * 540].reshape((540, 960))
+    assert (luma[:, 0] == np.arange(0, 1080, 2, dtype=np.uint8)).all()
+    chroma = frame[960 * 540:].reshape((2, 270, 480))
+    assert (chroma[0, :, 0] == np.arange(0, 540, 2, dtype=np.uint8)).all()
+    assert (chroma[1, :, 0] == np.arange(100, 640, 2, dtype=np.uint8)).all()
+
+
+def test_frame_decimation_gpu():
+    decimation = FrameDecimation((1920, 1080), scale=3)
+    # The camera resizes, leaving the padding of 640x360 to remove
+    assert decimation.resize == (640, 360)
+    frame = decimation.decimate(padded_frame(640, 360))
+    luma = frame[:640 * 360].reshape((360, 640))
+    assert (luma[:, 0] == np.arange(0, 360, dtype=np.uint8)).all()
+    passthrough = FrameDecimation((640, 480))
+    b = padded_frame(640, 480)
+    assert passthrough.decimate(b) is b
+
+
+@patch('pinthesky.conversion.Popen')
+def test_conversion_decimation(popen):
+    camera = MagicMock()
+    camera.framerate = 20
+    camera.resolution = (1280, 720)
+    decimation = FrameDecimation(camera.resolution, scale=2, skip=2, resizer='stride')
+    conversion = VideoConversion(camera, decimation=decimation, registry=MetricsRegistry())
+    args = popen.call_args[0][0]
+    assert args[args.index('-s') + 1] == '640x360'
+    assert args[args.index('-r') + 1] == '10.0'
+    assert conversion.resolution == (640, 360)
+    for frame in range(0, 4):
+        conversion.write(padded_frame(1280, 720))
+    writes = conversion.process.stdin.write.call_args_list
+    assert len(writes) == 2
+    assert len(writes[0][0][0]) == 640 * 360 * 3 // 2
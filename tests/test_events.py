@@ -0,0 +1,229 @@
+import threading
+import time
+from pinthesky.events import EventQueue, EventThread
+from pinthesky.metrics import MetricsRegistry
+
+
+def test_threaded_handler():
+    events = EventThread()
+    release = threading.Event()
+    slow_calls = []
+    fast_calls = []
+
+    def slow(event):
+        release.wait(2)
+        slow_calls.append(event['index'])
+
+    events.on_event('combine_end', slow, 'Slow', threaded=True)
+    events.on_event('health', lambda e: fast_calls.append(e['name']), 'Fast')
+    events.start()
+    for index in range(0, 3):
+        events.fire_event('combine_end', {'index': index})
+    events.fire_event('health')
+    # The slow handler no longer holds back the rest of the events
+    while not fast_calls:
+        pass
+    assert slow_calls == []
+    assert events.event_queue.unfinished_tasks == 3
+    release.set()
+    events.event_queue.join()
+    assert slow_calls == [0, 1, 2]
+    assert fast_calls == ['health']
+    events.stop()
+
+
+def test_threaded_handler_failure():
+    events = EventThread()
+    calls = []
+
+    def fail(event):
+        calls.append(event['name'])
+        raise RuntimeError('failed')
+
+    events.on_event('upload_end', fail, 'Failing', threaded=True)
+    events.on_event('upload_end', lambda e: calls.append('inline'), 'Inline')
+    events.start()
+    events.fire_event('upload_end')
+    events.fire_event('upload_end')
+    events.event_queue.join()
+    assert sorted(calls) == ['inline', 'inline', 'upload_end', 'upload_end']
+    events.stop()
+
+
+def test_threaded_handler_added_while_running():
+    events = EventThread()
+    calls = []
+    events.on_event('health', calls.append, 'First', threaded=True)
+    events.start()
+    events.on_event('health', calls.append, 'Second', threaded=True)
+    events.executors['First'].start()
+    events.fire_event('health')
+    events.event_queue.join()
+    assert len(calls) == 2
+    events.stop()
+
+
+def test_event_queue_priority():
+    event_queue = EventQueue()
+    for name in ['upload_end', 'health', 'file_change', 'record', 'combine_end']:
+        event_queue.put({'name': name})
+    names = [event_queue.get()['name'] for _ in range(0, 5)]
+    assert names == ['record', 'file_change', 'combine_end', 'health', 'upload_end']
+
+
+def test_event_queue_coalesce():
+    events = EventThread(maxsize=4)
+    calls = []
+    events.on_event('health', calls.append, 'Health')
+    events.on_event('upload_end', calls.append, 'Upload')
+    for index in range(0, 3):
+        events.fire_event('health', {'index': index})
+        events.fire_event('upload_end', {'index': index})
+    assert events.event_queue.qsize() == 4
+    assert events.event_queue.coalesced == 1
+    events.start()
+    events.event_queue.join()
+    assert [(e['name'], e['index']) for e in calls] == [
+        ('health', 0),
+        ('health', 2),
+        ('upload_end', 1),
+        ('upload_end', 2),
+    ]
+    # Once handled, the next event is queued again
+    events.fire_event('health', {'index': 3})
+    events.event_queue.join()
+    assert calls[-1]['index'] == 3
+    events.stop()
+
+
+def test_event_queue_coalesce_only_when_full():
+    event_queue = EventQueue()
+    for index in range(0, 3):
+        event_queue.put({'name': 'health', 'index': index})
+    assert event_queue.coalesced == 0
+    assert [event_queue.get()['index'] for _ in range(0, 3)] == [0, 1, 2]
+
+
+def test_event_queue_coalesce_per_connection():
+    event_queue = EventQueue(maxsize=2)
+    event_queue.put({'name': 'health', 'connection': {'id': 'a'}, 'index': 0})
+    event_queue.put({'name': 'health', 'connection': {'id': 'b'}, 'index': 1})
+    assert event_queue.put({'name': 'health', 'connection': {'id': 'a'}, 'index': 2})
+    assert not event_queue.put({'name': 'health', 'connection': {'id': 'c'}})
+    events = [event_queue.get() for _ in range(0, 2)]
+    assert [(e['connection']['id'], e['index']) for e in events] == [('a', 2), ('b', 1)]
+
+
+def test_event_queue_keeps_motion_episodes():
+    event_queue = EventQueue(maxsize=3)
+    for name in ['motion_start', 'motion_end', 'motion_start']:
+        assert event_queue.put({'name': name})
+    names = [event_queue.get()['name'] for _ in range(0, 3)]
+    assert names == ['motion_start', 'motion_end', 'motion_start']
+
+
+def test_event_queue_policies():
+    event_queue = EventQueue(
+        maxsize=2,
+        policies={
+            'upload_end': 'drop_oldest',
+            'health': 'coalesce',
+            'combine_end': 'drop_newest',
+            'record': 'block',
+        },
+        block_timeout=0.01)
+    assert event_queue.put({'name': 'upload_end', 'index': 0})
+    assert event_queue.put({'name': 'upload_end', 'index': 1})
+    assert event_queue.put({'name': 'upload_end', 'index': 2})
+    assert not event_queue.put({'name': 'combine_end'})
+    assert not event_queue.put({'name': 'health'})
+    assert not event_queue.put({'name': 'record'})
+    assert not event_queue.put({'name': 'record'}, block=False)
+    assert event_queue.dropped == 5
+    assert event_queue.unfinished_tasks == 2
+    assert [event_queue.get()['index'] for _ in range(0, 2)] == [1, 2]
+
+
+def test_event_queue_block():
+    event_queue = EventQueue(maxsize=1, block_timeout=2)
+    event_queue.put({'name': 'record', 'index': 0})
+    blocked = threading.Thread(
+        target=event_queue.put,
+        args=[{'name': 'record', 'index': 1}],
+        daemon=True)
+    blocked.start()
+    assert event_queue.get()['index'] == 0
+    blocked.join(2)
+    assert event_queue.get()['index'] == 1
+    assert event_queue.dropped == 0
+
+
+def test_event_thread_reports_drops():
+    registry = MetricsRegistry()
+    events = EventThread(maxsize=1, policies={'record': 'block'}, registry=registry)
+    calls = []
+
+    def record(event):
+        calls.append(event)
+        # Firing on a full queue from the event thread must not block
+        events.fire_event('record')
+        events.fire_event('record')
+        if len(calls) == 3:
+            events.running = False
+
+    events.on_event('record', record, 'Record')
+    events.start()
+    events.fire_event('record')
+    events.join(2)
+    assert not events.is_alive()
+    assert events.event_queue.dropped == 3
+    assert registry.counter('EventDropped', Operation='EventQueue').value == 3
+
+
+def test_event_thread_records_metrics():
+    registry = MetricsRegistry()
+    events = EventThread(registry=registry)
+
+    def fail(event):
+        raise RuntimeError('failed')
+
+    events.on_event('upload_end', lambda e: None, 'Upload')
+    events.on_event('upload_end', fail, 'Failing')
+    events.start()
+    for _ in range(0, 3):
+        events.fire_event('upload_end')
+    events.event_queue.join()
+    events.stop()
+    groups = dict([(g['dimensions']['Handler'], g) for g in registry.collect() if 'Handler' in g['dimensions']])
+    assert groups['Upload']['dimensions'] == {
+        'Operation': 'EventHandle',
+        'Handler': 'Upload',
+        'Event': 'upload_end',
+    }
+    assert groups['Upload']['values']['EventProcessed'] == 3
+    assert groups['Upload']['values']['EventFailed'] == 0
+    assert groups['Failing']['values']['EventProcessed'] == 0
+    assert groups['Failing']['values']['EventFailed'] == 3
+    assert 'DurationP99' in groups['Upload']['values']
+
+
+def test_event_thread_splits_queue_wait():
+    registry = MetricsRegistry()
+    events = EventThread(registry=registry)
+    events.on_event('combine_end', lambda e: time.sleep(0.05), 'Slow')
+    for index in range(0, 2):
+        events.fire_event('combine_end', {'index': index})
+    event, enqueued = events.event_queue.get_timed()
+    # Timing stays on the queue entry, out of the event handlers forward
+    assert 'monotonic' not in event
+    assert 0 < enqueued <= time.monotonic_ns()
+    events.event_queue.task_done()
+    events.fire_event('combine_end')
+    events.start()
+    events.event_queue.join()
+    events.stop()
+    values = [g['values'] for g in registry.collect() if g['dimensions'].get('Handler') == 'Slow'][0]
+    # The second event waited on the queue while the first was handled
+    assert values['QueueWaitMax'] >= 50
+    assert values['DurationMax'] >= 50
+    assert values['DurationP50'] < 1000
@@ -22,6 +22,9 @@ class TestHandler(Handler):
     def on_motion_start(self, event):
         self.__on_event('motion_start', event)
 
+    def on_motion_end(self, event):
+        self.__on_event('motion_end', event)
+
     def on_file_change(self, event):
         self.__on_event('file_change', event)
 
@@ -4,7 +4,7 @@ import os
 from pinthesky import VERSION
 from pinthesky.config import ConfigUpdate
 from pinthesky.events import EventThread
-from pinthesky.health import DeviceHealth, DeviceOperatingSystem
+from pinthesky.health import DeviceHealth, DeviceHealthMetric, DeviceOperatingSystem
 from pinthesky.output import Output
 from test_handler import TestHandler
 
@@ -115,3 +115,14 @@ def test_unknown_os():
     reported = os_metric.report()
     for key, value in reported.items():
         assert value == 'unknown'
+
+
+def test_add_metric():
+    class TestMetric(DeviceHealthMetric):
+        def report(self):
+            return {'test_metric': 1}
+
+    events = EventThread()
+    device_health = DeviceHealth(events=events, metrics=[])
+    device_health.add_metric(TestMetric())
+    assert device_health._DeviceHealth__flush_metrics()['test_metric'] == 1
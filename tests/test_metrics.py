@@ -0,0 +1,48 @@
+from pinthesky.metrics import Histogram, MetricsRegistry
+
+
+def test_histogram():
+    histogram = Histogram('Duration', buckets=[10, 100, 1000, float('inf')])
+    for value in [1] * 50 + [50] * 45 + [500] * 4 + [5000]:
+        histogram.observe(value)
+    assert histogram.collect() == [
+        ('Duration', 'Milliseconds', 93.0),
+        ('DurationP50', 'Milliseconds', 10),
+        ('DurationP99', 'Milliseconds', 1000),
+        ('DurationMax', 'Milliseconds', 5000),
+    ]
+    # Collecting resets for the next interval
+    assert histogram.collect() == []
+    histogram.observe(3)
+    assert histogram.collect()[1:] == [
+        ('DurationP50', 'Milliseconds', 3),
+        ('DurationP99', 'Milliseconds', 3),
+        ('DurationMax', 'Milliseconds', 3),
+    ]
+
+
+def test_registry_collect():
+    registry = MetricsRegistry()
+    upload = registry.counter('UploadProcessed', Operation='Upload', FileType='video')
+    assert registry.counter('UploadProcessed', FileType='video', Operation='Upload') is upload
+    upload.add()
+    upload.add()
+    registry.counter('Size', unit='Bytes', Operation='Upload', FileType='video').add(1024)
+    registry.histogram('Duration', Operation='Upload', FileType='video')
+    registry.gauge('Pending', Operation='Spool').set(3)
+    assert registry.collect() == [
+        {
+            'dimensions': {'FileType': 'video', 'Operation': 'Upload'},
+            'metrics': [
+                {'Name': 'UploadProcessed', 'Unit': 'Count'},
+                {'Name': 'Size', 'Unit': 'Bytes'},
+            ],
+            'values': {'UploadProcessed': 2, 'Size': 1024},
+        },
+        {
+            'dimensions': {'Operation': 'Spool'},
+            'metrics': [{'Name': 'Pending', 'Unit': 'Count'}],
+            'values': {'Pending': 3},
+        },
+    ]
+    assert registry.collect()[0]['values'] == {'UploadProcessed': 0, 'Size': 0}
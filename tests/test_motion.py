@@ -0,0 +1,186 @@
+import numpy as np
+from pinthesky.motion import BackgroundAnalysis, MotionState, VectorAnalysis, motion_dtype, zone_weights
+
+
+def legacy_count(a):
+    a = np.sqrt(
+        np.square(a['x'].astype(np.float64)) +
+        np.square(a['y'].astype(np.float64))
+        ).clip(0, 255).astype(np.uint8)
+    return (a > 60).sum()
+
+
+def random_frame(rows=30, cols=41, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((rows, cols), dtype=motion_dtype)
+    frame['x'] = rng.integers(-128, 128, size=(rows, cols))
+    frame['y'] = rng.integers(-128, 128, size=(rows, cols))
+    return frame
+
+
+def test_vector_analysis_matches_legacy():
+    analysis = VectorAnalysis(sensitivity=10)
+    for seed in range(0, 10):
+        frame = random_frame(seed=seed)
+        assert analysis.count(frame) == legacy_count(frame)
+
+
+def test_vector_analysis_boundary():
+    analysis = VectorAnalysis(sensitivity=0)
+    frame = np.zeros((1, 4), dtype=motion_dtype)
+    # Magnitudes of 60, ~60.8, 61 and the largest possible vector
+    frame['x'] = [60, 36, 61, -128]
+    frame['y'] = [0, 49, 0, -128]
+    assert analysis.count(frame) == legacy_count(frame) == 2
+
+
+def test_vector_analysis_detect():
+    analysis = VectorAnalysis(sensitivity=2)
+    frame = np.zeros((2, 2), dtype=motion_dtype)
+    frame['x'][0] = 100
+    assert not analysis.detect(frame)
+    frame['y'][1][0] = 100
+    assert analysis.detect(frame)
+
+
+def test_vector_analysis_reuses_buffers():
+    analysis = VectorAnalysis()
+    analysis.count(random_frame(seed=1))
+    buffers = analysis._VectorAnalysis__x
+    analysis.count(random_frame(seed=2))
+    assert analysis._VectorAnalysis__x is buffers
+    analysis.count(random_frame(rows=15, cols=21))
+    assert analysis.shape == (15, 21)
+
+
+def test_zone_weights():
+    assert zone_weights((30, 41), None) is None
+    weights = zone_weights((30, 41), [
+        {'x': 0, 'y': 0, 'width': 320, 'height': 240, 'weight': 2},
+        {'x': 64, 'y': 64, 'width': 20, 'height': 16, 'weight': 0},
+        {'x': 600, 'y': 400},
+    ])
+    assert weights.shape == (30, 41)
+    assert weights[0][0] == 2
+    assert weights[14][19] == 2
+    assert weights[15][20] == 0
+    # Partial macroblocks are included in the zone
+    assert weights[4][4] == 0
+    assert weights[4][5] == 0
+    assert weights[4][6] == 2
+    assert weights[29][40] == 1
+    assert weights[20][20] == 0
+
+
+def test_vector_analysis_zones():
+    frame = np.zeros((30, 41), dtype=motion_dtype)
+    # Motion in the excluded half of the frame
+    frame['x'][:, 30:] = 100
+    analysis = VectorAnalysis(sensitivity=10)
+    assert analysis.detect(frame)
+    analysis = VectorAnalysis(sensitivity=10, zones=[
+        {'x': 0, 'y': 0, 'width': 320},
+    ])
+    assert analysis.count(frame) == 0
+    assert not analysis.detect(frame)
+    frame['x'][0:2, 0:3] = 100
+    assert analysis.count(frame) == 6
+    analysis = VectorAnalysis(sensitivity=10, zones=[
+        {'x': 0, 'y': 0, 'width': 320, 'weight': 2},
+    ])
+    assert analysis.detect(frame)
+
+
+class FakeEvents():
+    def __init__(self):
+        self.fired = []
+
+    def fire_event(self, event_name, context={}):
+        self.fired.append((event_name, context))
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_motion_state_episode():
+    events = FakeEvents()
+    clock = FakeClock()
+    state = MotionState(
+        events=events,
+        confirm_frames=2,
+        window_frames=3,
+        cooldown=1,
+        clock=clock)
+    # Isolated detections are rejected as noise
+    for detected in [True, False, False, True, False, False]:
+        state.update(detected)
+        clock.now += 0.05
+    assert events.fired == []
+    assert state.rejected == 2
+    # Sustained motion is a single episode
+    for _ in range(0, 20):
+        state.update(True)
+        clock.now += 0.05
+    assert [name for name, _ in events.fired] == ['motion_start']
+    assert state.active
+    for _ in range(0, 19):
+        state.update(False)
+        clock.now += 0.05
+    assert state.active
+    clock.now += 0.1
+    state.update(False)
+    assert not state.active
+    assert [name for name, _ in events.fired] == ['motion_start', 'motion_end']
+    assert events.fired[1][1]['suppressed'] == 18
+    assert state.report() == {
+        'motion_episodes': 1,
+        'motion_suppressed': 18,
+        'motion_rejected': 3,
+    }
+
+
+def test_motion_state_configure():
+    events = FakeEvents()
+    state = MotionState(events=events, confirm_frames=1, window_frames=1)
+    state.update(True)
+    assert state.active
+    state.configure(confirm_frames=5, window_frames=2, cooldown=1)
+    assert not state.active
+    assert state.window_frames == 5
+    assert [name for name, _ in events.fired] == ['motion_start', 'motion_end']
+
+
+def test_background_analysis():
+    rng = np.random.default_rng(0)
+    scene = rng.integers(40, 150, size=(30, 40), dtype=np.uint8)
+    analysis = BackgroundAnalysis(sensitivity=10)
+    # Seeds the model from the first frame
+    assert analysis.count(scene) == 0
+    for _ in range(0, 10):
+        noise = rng.integers(-5, 6, size=scene.shape)
+        assert not analysis.detect((scene + noise).astype(np.uint8))
+    moving = scene.copy()
+    moving[10:20, 10:20] = 255 - moving[10:20, 10:20] // 4
+    assert analysis.count(moving) == 100
+    assert analysis.detect(moving)
+    # A global change in brightness reseeds instead of detecting
+    assert analysis.count(scene // 3) == 0
+    assert analysis.count(scene // 3) == 0
+
+
+def test_background_analysis_zones():
+    scene = np.full((30, 40), 100, dtype=np.uint8)
+    analysis = BackgroundAnalysis(sensitivity=10, zones=[
+        {'x': 0, 'y': 0, 'width': 320},
+    ])
+    analysis.count(scene)
+    moving = scene.copy()
+    moving[:, 20:] = 200
+    assert analysis.count(moving) == 0
+    moving[0:2, 0:10] = 200
+    assert analysis.count(moving) == 20
@@ -0,0 +1,149 @@
+import io
+import struct
+from pinthesky.mp4 import FragmentedMP4Writer, iter_nal_units, parse_sps, unescape_rbsp
+
+
+class BitWriter():
+    def __init__(self):
+        self.bits = []
+
+    def write(self, value, count):
+        self.bits.extend([(value >> i) & 1 for i in range(count - 1, -1, -1)])
+
+    def ue(self, value):
+        value += 1
+        self.write(0, value.bit_length() - 1)
+        self.write(value, value.bit_length())
+
+    def rbsp(self):
+        self.bits.append(1)
+        while len(self.bits) % 8:
+            self.bits.append(0)
+        return bytes([
+            int(''.join(map(str, self.bits[i:i + 8])), 2)
+            for i in range(0, len(self.bits), 8)
+        ])
+
+
+def sps_nal(width, height, profile_idc=66):
+    writer = BitWriter()
+    writer.write(profile_idc, 8)
+    writer.write(0xc0, 8)
+    writer.write(31, 8)
+    writer.ue(0)
+    if profile_idc == 100:
+        writer.ue(1)
+        writer.ue(0)
+        writer.ue(0)
+        writer.write(0, 2)
+    writer.ue(0)
+    writer.ue(2)
+    writer.ue(1)
+    writer.write(0, 1)
+    width_in_mbs = (width + 15) // 16
+    height_in_mbs = (height + 15) // 16
+    writer.ue(width_in_mbs - 1)
+    writer.ue(height_in_mbs - 1)
+    writer.write(0b11, 2)
+    crop_right = (width_in_mbs * 16 - width) // 2
+    crop_bottom = (height_in_mbs * 16 - height) // 2
+    if crop_right or crop_bottom:
+        writer.write(1, 1)
+        for crop in [0, crop_right, 0, crop_bottom]:
+            writer.ue(crop)
+    else:
+        writer.write(0, 1)
+    writer.write(0, 1)
+    return b'\x67' + writer.rbsp()
+
+
+def h264_stream(gops, gop_size, width=640, height=480, slice_size=64):
+    """
+    Builds an Annex-B stream of parameter sets and slices without any start
+    code emulation in the slice payloads.
+    """
+    stream = bytearray()
+    for gop in range(0, gops):
+        stream += b'\x00\x00\x00\x01' + sps_nal(width, height)
+        stream += b'\x00\x00\x00\x01\x68\xce\x38\x80'
+        for frame in range(0, gop_size):
+            header = b'\x65' if frame == 0 else b'\x41'
+            payload = bytes([0x80 | (frame % 0x7f)]) + bytes([1 + (gop + frame) % 254]) * slice_size
+            stream += b'\x00\x00\x00\x01' + header + payload
+    return bytes(stream)
+
+
+def boxes(data, offset=0, end=None):
+    end = len(data) if end is None else end
+    while offset < end:
+        size, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        yield kind, data[offset + 8:offset + size]
+        offset += size
+
+
+def find_box(data, *path):
+    for kind, payload in boxes(data):
+        if kind == path[0]:
+            return payload if len(path) == 1 else find_box(payload, *path[1:])
+
+
+def test_iter_nal_units():
+    stream = b'\x00\x00\x00\x01\x67\x42\x00\x00\x01\x68\xce\x00\x00\x01\x65\x88\x84'
+    for chunk_size in [1, 2, 3, 5, 1024]:
+        nals = list(iter_nal_units(io.BytesIO(stream), chunk_size=chunk_size))
+        assert nals == [b'\x67\x42', b'\x68\xce', b'\x65\x88\x84']
+
+
+def test_unescape_rbsp():
+    assert unescape_rbsp(b'\x00\x00\x03\x01\x00\x00\x03\x00') == b'\x00\x00\x01\x00\x00\x00'
+
+
+def test_parse_sps():
+    sps = parse_sps(sps_nal(1920, 1080))
+    assert sps['profile_idc'] == 66
+    assert sps['level_idc'] == 31
+    assert (sps['width'], sps['height']) == (1920, 1080)
+    sps = parse_sps(sps_nal(640, 480, profile_idc=100))
+    assert sps['profile_idc'] == 100
+    assert sps['chroma_format_idc'] == 1
+    assert (sps['width'], sps['height']) == (640, 480)
+
+
+def test_fragmented_mp4_writer():
+    output = io.BytesIO()
+    writer = FragmentedMP4Writer(output, framerate=20)
+    # Slices before the first sync sample can not be decoded
+    writer.write(b'\x41\x80\x01')
+    for nal in iter_nal_units(io.BytesIO(h264_stream(2, 10)), chunk_size=100):
+        writer.write(nal)
+    writer.close()
+    data = output.getvalue()
+    assert [kind for kind, _ in boxes(data)] == [
+        b'ftyp', b'moov', b'moof', b'mdat', b'moof', b'mdat'
+    ]
+    assert writer.sample_count == 20
+    mdhd = find_box(data, b'moov', b'trak', b'mdia', b'mdhd')
+    assert struct.unpack('>I', mdhd[12:16])[0] == 20000
+    tkhd = find_box(data, b'moov', b'trak', b'tkhd')
+    assert struct.unpack('>II', tkhd[-8:]) == (640 << 16, 480 << 16)
+    avcc = find_box(data, b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stsd')
+    assert sps_nal(640, 480) in avcc
+    fragments = [payload for kind, payload in boxes(data) if kind == b'moof']
+    decode_times = []
+    for fragment in fragments:
+        tfdt = find_box(fragment, b'traf', b'tfdt')
+        decode_times.append(struct.unpack('>Q', tfdt[4:])[0])
+        trun = find_box(fragment, b'traf', b'trun')
+        count, _ = struct.unpack('>Ii', trun[4:12])
+        assert count == 10
+        duration, size, flags = struct.unpack('>III', trun[12:24])
+        assert duration == 1000
+        assert size == 4 + 66
+        assert flags == 0x02000000
+        assert struct.unpack('>III', trun[24:36])[2] == 0x01010000
+    assert decode_times == [0, 10000]
+    # The data offset of each run points at the first sample in the mdat
+    offset = len(find_box(data, b'ftyp')) + 8 + len(find_box(data, b'moov')) + 8
+    trun = find_box(fragments[0], b'traf', b'trun')
+    data_offset = struct.unpack('>i', trun[8:12])[0]
+    assert data[offset + data_offset:offset + data_offset + 5] == b'\x00\x00\x00\x42\x65'
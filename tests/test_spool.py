@@ -0,0 +1,71 @@
+import os
+from pinthesky.spool import UploadSpool
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+def write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def test_spool_put_load(tmp_path):
+    spool_dir = str(tmp_path / 'spool')
+    spool = UploadSpool(spool_dir)
+    spool.load()
+    parts = [
+        write_file(tmp_path / 'clip.before.h264', 'Hello '),
+        write_file(tmp_path / 'clip.after.h264', 'World!'),
+    ]
+    entry = spool.put('clip.motion.h264', parts, {'prefix': 'motion_videos'})
+    assert not any([os.path.exists(part) for part in parts])
+    assert entry['size'] == 12
+    # Interrupted writes leave a directory without a manifest
+    os.makedirs(os.path.join(spool_dir, 'orphan'))
+    restarted = UploadSpool(spool_dir)
+    restarted.load()
+    assert not os.path.exists(os.path.join(spool_dir, 'orphan'))
+    loaded = restarted.next(timeout=0)
+    assert loaded['name'] == 'clip.motion.h264'
+    assert loaded['job'] == {'prefix': 'motion_videos'}
+    assert [os.path.basename(f) for f in loaded['files']] == [
+        'clip.before.h264', 'clip.after.h264'
+    ]
+    restarted.remove(loaded)
+    assert os.listdir(spool_dir) == []
+    assert restarted.report()['upload_pending'] == 0
+
+
+def test_spool_retry(tmp_path):
+    clock = Clock()
+    spool = UploadSpool(str(tmp_path / 'spool'), clock=clock)
+    spool.load()
+    spool.put('image.jpg', [write_file(tmp_path / 'image.jpg', 'image')], {})
+    entry = spool.next(timeout=0)
+    spool.retry(entry, 10)
+    assert spool.next(timeout=0) is None
+    clock.now += 10
+    entry = spool.next(timeout=0)
+    assert entry['attempts'] == 1
+    assert spool.report()['upload_retries'] == 1
+
+
+def test_spool_evict(tmp_path):
+    clock = Clock()
+    spool = UploadSpool(str(tmp_path / 'spool'), max_bytes=10, clock=clock)
+    spool.load()
+    for i in range(0, 3):
+        clock.now += 1
+        spool.put(f'{i}.h264', [write_file(tmp_path / f'{i}.h264', 'abcd')], {})
+    # The oldest entry is evicted to stay in the budget
+    assert [entry['name'] for entry in spool.entries] == ['1.h264', '2.h264']
+    report = spool.report()
+    assert report['upload_evicted'] == 1
+    assert report['upload_spool_bytes'] == 8
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from pinthesky.throttle import BandwidthThrottle, MIN_PART_SIZE, MAX_PART_SIZE
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_throttle_unlimited():
+    throttle = BandwidthThrottle()
+    throttle.acquire(1024 * 1024, 'uploads')
+    throttle.acquire(0, 'uploads')
+    throttle.acquire(-10, 'uploads')
+    assert throttle.report() == {
+        'bandwidth_limit': None,
+        'bandwidth_throughput': None,
+        'bandwidth_live_bytes': 0,
+        'bandwidth_control_bytes': 0,
+        'bandwidth_logs_bytes': 0,
+        'bandwidth_uploads_bytes': 1024 * 1024,
+    }
+
+
+def test_throttle_debt():
+    clock = FakeClock()
+    throttle = BandwidthThrottle(rate=100, clock=clock)
+    # Larger than the burst goes through and leaves the bucket in debt
+    throttle.acquire(250, 'uploads')
+    assert throttle.tokens == -150
+    released = threading.Event()
+
+    def send():
+        throttle.acquire(10, 'logs')
+        released.set()
+
+    thread = threading.Thread(target=send, daemon=True)
+    thread.start()
+    assert not released.wait(0.1)
+    clock.now = 2
+    with throttle.condition:
+        throttle.condition.notify_all()
+    assert released.wait(2)
+    thread.join()
+
+
+def test_throttle_priority():
+    clock = FakeClock()
+    throttle = BandwidthThrottle(rate=100, clock=clock)
+    throttle.acquire(100, 'control')
+    order = []
+
+    def send(priority):
+        throttle.acquire(100, priority)
+        order.append(priority)
+
+    upload = threading.Thread(target=send, args=['uploads'], daemon=True)
+    upload.start()
+    while not throttle.waiting[3]:
+        time.sleep(0.01)
+    live = threading.Thread(target=send, args=['live'], daemon=True)
+    live.start()
+    while not throttle.waiting[0]:
+        time.sleep(0.01)
+    # Only enough tokens for one send, which goes to the live stream
+    clock.now = 1
+    with throttle.condition:
+        throttle.condition.notify_all()
+    live.join(2)
+    assert order == ['live']
+    clock.now = 2
+    with throttle.condition:
+        throttle.condition.notify_all()
+    upload.join(2)
+    assert order == ['live', 'uploads']
+    assert throttle.report()['bandwidth_live_bytes'] == 100
+    assert throttle.report()['bandwidth_control_bytes'] == 100
+
+
+def test_throttle_part_size():
+    throttle = BandwidthThrottle(part_seconds=10)
+    assert throttle.part_size() == MIN_PART_SIZE
+    throttle.measure(1024 * 1024, 1)
+    assert throttle.part_size() == 10 * 1024 * 1024
+    throttle.measure(100 * 1024 * 1024, 1)
+    assert throttle.part_size() == MAX_PART_SIZE
+    throttle.configure(100 * 1024)
+    assert throttle.part_size() == MIN_PART_SIZE
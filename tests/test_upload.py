@@ -1,12 +1,15 @@
 from datetime import datetime
 from math import floor
 import os
-from time import time
+from time import sleep, time
 from unittest.mock import patch
 from pinthesky.config import ConfigUpdate
-from pinthesky.upload import S3Upload
+from pinthesky.upload import ChainedReader, S3Upload
 from pinthesky.events import EventThread
+from pinthesky.metrics import MetricsRegistry
 from pinthesky.session import Session
+from pinthesky.spool import UploadSpool
+from pinthesky.throttle import BandwidthThrottle
 from test_handler import TestHandler
 import boto3
 
@@ -185,4 +188,342 @@ def test_configuration_changes():
         'bucket_name': 'fartso-bucket',
         'video_prefix': 'motion_videos',
         'image_prefix': 'capture-images',
+        'bandwidth_limit': None,
+        'part_size': None,
+        'max_concurrency': 2,
+        'multipart_threshold': 8,
     })
+
+
+def test_upload_bandwidth_limit():
+    events = EventThread()
+    throttle = BandwidthThrottle()
+    upload = S3Upload(
+        events=events,
+        bucket_name="bucket_name",
+        bucket_prefix="motion-videos",
+        session=None,
+        throttle=throttle)
+    upload.on_file_change({
+        'content': {
+            'current': {
+                'state': {
+                    'desired': {
+                        'storage': {
+                            'bandwidth_limit': 256,
+                        }
+                    }
+                }
+            }
+        }
+    })
+    assert throttle.rate == 256 * 1024
+    assert upload.update_document().body['bandwidth_limit'] == 256
+    upload.on_file_change({
+        'content': {
+            'current': {
+                'state': {
+                    'desired': {
+                        'storage': {
+                            'bandwidth_limit': None,
+                        }
+                    }
+                }
+            }
+        }
+    })
+    assert throttle.rate is None
+
+
+@patch('boto3.Session')
+def test_upload_parts(bsession):
+    events = EventThread()
+    session = Session(
+        cert_path="cert_path",
+        key_path="key_path",
+        cacert_path="cacert_path",
+        thing_name="thing_name",
+        role_alias="role_alias",
+        credentials_endpoint="example.com")
+    registry = MetricsRegistry()
+    upload = S3Upload(
+        events=events,
+        bucket_name="bucket_name",
+        bucket_prefix="motion-videos",
+        session=session,
+        registry=registry)
+    now = datetime.now()
+    next_year = datetime(year=now.year + 1, month=now.month, day=1)
+    session.credentials = {
+        'accessKeyId': 'abc',
+        'secretAccessKey': 'efg',
+        'sessionToken': '123',
+        'expiration': next_year.strftime("%Y-%m-%dT%H:%M:%SZ")
+    }
+    uploaded = {}
+
+    def upload_fileobj(f, bucket_name, key, ExtraArgs=None, **kwargs):
+        uploaded[key] = f.read()
+
+    s3 = bsession.return_value.client.return_value
+    s3.upload_fileobj = upload_fileobj
+    start_time = floor(time())
+    parts = [f'{start_time}.before.h264', f'{start_time}.after.h264']
+    for part, content in zip(parts, ['Hello ', 'World!']):
+        with open(part, 'w') as f:
+            f.write(content)
+    upload.on_combine_end({
+        'name': 'combine_end',
+        'start_time': start_time,
+        'trigger': 'motion',
+        'combine_name': f'{start_time}.motion.h264',
+        'combine_parts': parts,
+    })
+    assert uploaded == {
+        f'motion-videos/thing_name/{start_time}.motion.h264': b'Hello World!'
+    }
+    for part in parts:
+        assert not os.path.exists(part)
+    values = registry.collect()[0]['values']
+    assert values['UploadProcessed'] == 1
+    assert values['Size'] == 12
+    assert values['ThroughputMax'] > 0
+    assert 0 <= values['Time'] < 5
+
+
+def test_chained_reader():
+    parts = ['test_part_0.data', 'test_part_1.data', 'test_part_2.data']
+    for part, content in zip(parts, [b'abc', b'', b'defgh']):
+        with open(part, 'wb') as f:
+            f.write(content)
+    try:
+        with ChainedReader(parts) as reader:
+            assert reader.read(2) == b'ab'
+            assert reader.read() == b'cdefgh'
+            assert reader.read() == b''
+    finally:
+        for part in parts:
+            os.remove(part)
+
+
+@patch('boto3.Session')
+def test_upload_spool_retry(bsession, tmp_path):
+    test_handler = TestHandler()
+    events = EventThread()
+    session = Session(
+        cert_path="cert_path",
+        key_path="key_path",
+        cacert_path="cacert_path",
+        thing_name="thing_name",
+        role_alias="role_alias",
+        credentials_endpoint="example.com")
+    spool = UploadSpool(str(tmp_path / 'spool'))
+    upload = S3Upload(
+        events=events,
+        bucket_name="bucket_name",
+        bucket_prefix="motion-videos",
+        session=session,
+        spool=spool,
+        retry_backoff=0.05)
+    now = datetime.now()
+    next_year = datetime(year=now.year + 1, month=now.month, day=1)
+    session.credentials = {
+        'accessKeyId': 'abc',
+        'secretAccessKey': 'efg',
+        'sessionToken': '123',
+        'expiration': next_year.strftime("%Y-%m-%dT%H:%M:%SZ")
+    }
+    uploaded = {}
+    attempts = []
+
+    def upload_fileobj(f, bucket_name, key, ExtraArgs=None, **kwargs):
+        attempts.append(key)
+        if len(attempts) == 1:
+            raise ConnectionError('uplink is down')
+        uploaded[key] = f.read()
+
+    s3 = bsession.return_value.client.return_value
+    s3.upload_fileobj = upload_fileobj
+    events.on(test_handler)
+    events.start()
+    start_time = floor(time())
+    video = str(tmp_path / f'{start_time}.motion.h264')
+    with open(video, 'w') as f:
+        f.write('Hello World!')
+    upload.on_combine_end({
+        'name': 'combine_end',
+        'start_time': start_time,
+        'trigger': 'motion',
+        'combine_video': video,
+    })
+    assert not os.path.exists(video)
+    upload.start()
+    try:
+        deadline = time() + 2
+        while spool.report()['upload_pending'] > 0 and time() < deadline:
+            sleep(0.01)
+        events.event_queue.join()
+        assert len(attempts) == 2
+        assert uploaded == {
+            f'motion-videos/thing_name/{start_time}.motion.h264': b'Hello World!'
+        }
+        assert test_handler.calls['upload_end'] == 1
+        assert spool.report()['upload_retries'] == 1
+    finally:
+        upload.stop()
+
+
+@patch('boto3.Session')
+def test_upload_spool_missing_files(bsession, tmp_path):
+    events = EventThread()
+    session = Session(
+        cert_path="cert_path",
+        key_path="key_path",
+        cacert_path="cacert_path",
+        thing_name="thing_name",
+        role_alias="role_alias",
+        credentials_endpoint="example.com")
+    spool = UploadSpool(str(tmp_path / 'spool'))
+    upload = S3Upload(
+        events=events,
+        bucket_name="bucket_name",
+        bucket_prefix="motion-videos",
+        session=session,
+        spool=spool)
+    now = datetime.now()
+    next_year = datetime(year=now.year + 1, month=now.month, day=1)
+    session.credentials = {
+        'accessKeyId': 'abc',
+        'secretAccessKey': 'efg',
+        'sessionToken': '123',
+        'expiration': next_year.strftime("%Y-%m-%dT%H:%M:%SZ")
+    }
+    uploaded = []
+    s3 = bsession.return_value.client.return_value
+    s3.upload_fileobj = lambda f, bucket_name, key, ExtraArgs=None, **kwargs: uploaded.append(key)
+    start_time = floor(time())
+    upload.start()
+    while not os.path.exists(spool.spool_dir):
+        sleep(0.01)
+    # Hold the worker off until a spooled file is lost from under it
+    with spool.condition:
+        for index in range(0, 2):
+            video = str(tmp_path / f'{start_time}.{index}.motion.h264')
+            with open(video, 'w') as f:
+                f.write('Hello World!')
+            upload.on_combine_end({
+                'name': 'combine_end',
+                'start_time': start_time,
+                'trigger': 'motion',
+                'combine_video': video,
+            })
+        os.remove(spool.entries[0]['files'][0])
+    try:
+        deadline = time() + 2
+        while spool.report()['upload_pending'] > 0 and time() < deadline:
+            sleep(0.01)
+        assert upload.is_alive()
+        assert uploaded == [f'motion-videos/thing_name/{start_time}.1.motion.h264']
+        assert spool.report()['upload_pending'] == 0
+    finally:
+        upload.stop()
+
+
+@patch('boto3.Session')
+def test_upload_spool_resumes_multipart(bsession, tmp_path):
+    session = Session(
+        cert_path="cert_path",
+        key_path="key_path",
+        cacert_path="cacert_path",
+        thing_name="thing_name",
+        role_alias="role_alias",
+        credentials_endpoint="example.com")
+    now = datetime.now()
+    next_year = datetime(year=now.year + 1, month=now.month, day=1)
+    session.credentials = {
+        'accessKeyId': 'abc',
+        'secretAccessKey': 'efg',
+        'sessionToken': '123',
+        'expiration': next_year.strftime("%Y-%m-%dT%H:%M:%SZ")
+    }
+    parts = {}
+    completed = []
+    failures = []
+
+    def upload_part(Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == 2 and not failures:
+            failures.append(PartNumber)
+            raise ConnectionError('uplink is down')
+        parts[PartNumber] = Body
+        return {'ETag': f'etag-{PartNumber}'}
+
+    s3 = bsession.return_value.client.return_value
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-id'}
+    s3.upload_part = upload_part
+    s3.complete_multipart_upload = lambda **kwargs: completed.append(kwargs)
+
+    def new_upload(spool):
+        return S3Upload(
+            events=EventThread(),
+            bucket_name="bucket_name",
+            bucket_prefix="motion-videos",
+            session=session,
+            spool=spool,
+            retry_backoff=60,
+            part_size=4,
+            max_concurrency=1,
+            multipart_threshold=4)
+
+    spool_dir = str(tmp_path / 'spool')
+    spool = UploadSpool(spool_dir)
+    upload = new_upload(spool)
+    start_time = floor(time())
+    video = str(tmp_path / f'{start_time}.motion.h264')
+    with open(video, 'w') as f:
+        f.write('Hello World!')
+    upload.start()
+    while not os.path.exists(spool_dir):
+        sleep(0.01)
+    upload.on_combine_end({
+        'name': 'combine_end',
+        'start_time': start_time,
+        'trigger': 'motion',
+        'combine_video': video,
+    })
+    try:
+        deadline = time() + 2
+        while spool.report()['upload_retries'] == 0 and time() < deadline:
+            sleep(0.01)
+    finally:
+        upload.stop()
+        upload.join()
+    assert parts == {1: b'Hell'}
+    assert spool.entries[0]['multipart']['parts'] == [{'PartNumber': 1, 'ETag': 'etag-1'}]
+
+    # A restart picks the upload back up from the manifest once it is due
+    entry = spool.entries[0]
+    entry['next_attempt'] = 0
+    spool.checkpoint(entry)
+    spool = UploadSpool(spool_dir)
+    upload = new_upload(spool)
+    upload.start()
+    try:
+        deadline = time() + 2
+        while not completed and time() < deadline:
+            sleep(0.01)
+    finally:
+        upload.stop()
+    s3.create_multipart_upload.assert_called_once()
+    assert parts == {1: b'Hell', 2: b'o Wo', 3: b'rld!'}
+    assert completed == [{
+        'Bucket': 'bucket_name',
+        'Key': f'motion-videos/thing_name/{start_time}.motion.h264',
+        'UploadId': 'upload-id',
+        'MultipartUpload': {
+            'Parts': [
+                {'PartNumber': 1, 'ETag': 'etag-1'},
+                {'PartNumber': 2, 'ETag': 'etag-2'},
+                {'PartNumber': 3, 'ETag': 'etag-3'},
+            ]
+        }
+    }]